@@ -1,8 +1,17 @@
 from django.contrib import admin
-from .models import User, Specialization, Clinic, Appointment, Availability
+from .models import (
+    User, Specialization, Clinic, Appointment, Availability, AvailabilityException, SlotHold, DoctorStats, Task,
+    Reminder, DoctorProfile,
+)
 
 admin.site.register(User)
 admin.site.register(Specialization)
 admin.site.register(Clinic)
 admin.site.register(Appointment)
-admin.site.register(Availability)
\ No newline at end of file
+admin.site.register(Availability)
+admin.site.register(AvailabilityException)
+admin.site.register(SlotHold)
+admin.site.register(DoctorStats)
+admin.site.register(DoctorProfile)
+admin.site.register(Task)
+admin.site.register(Reminder)
@@ -0,0 +1,223 @@
+"""
+Utilization and capacity analytics for a clinic.
+
+Appointments are streamed out of the database as integer columns (doctor,
+start time in epoch seconds, status code), a chunk at a time, into a NumPy
+array; every figure is then a vectorized bucketing of that array with
+``np.bincount``: weekday x hour heatmaps of booked slots against the capacity
+of the doctors' working hours, per-doctor utilization, and cancellation and
+no-show rates. Capacity is derived from the doctors' current weekly hours and
+dated exceptions, so past ranges are measured against today's schedule.
+
+Reports are cached per clinic and date range in the versioned catalog cache;
+appointment changes at the clinic bump its own entity (see ``clinic.signals``).
+NumPy is optional: without it ``clinic_report`` raises ``AnalyticsUnavailable``.
+"""
+
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Case, Func, IntegerField, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import catalog
+from .models import Appointment, Availability, AvailabilityException, User
+from .slots import SLOT_MINUTES, WEEKDAYS, working_hours
+
+
+ANALYTICS_TIMEOUT = getattr(settings, 'CLINIC_ANALYTICS_TIMEOUT', 15 * 60)
+DEFAULT_DAYS = 28
+MAX_DAYS = 366
+CHUNK_SIZE = 50000
+
+SCHEDULED, COMPLETED, CANCELLED = range(3)
+STATUS_CODES = {'Scheduled': SCHEDULED, 'Completed': COMPLETED, 'Cancelled': CANCELLED}
+DAY_NAMES = sorted(WEEKDAYS, key=WEEKDAYS.get)
+
+
+class AnalyticsUnavailable(Exception):
+    """NumPy is not installed."""
+
+
+class EpochSeconds(Func):
+    """Whole seconds since 1970 of a datetime column, computed by the database."""
+    output_field = IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="CAST(STRFTIME('%%%%s', %(expressions)s) AS INTEGER)",
+                           **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='CAST(EXTRACT(EPOCH FROM %(expressions)s) AS BIGINT)',
+                           **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='UNIX_TIMESTAMP(%(expressions)s)', **extra_context)
+
+
+def appointments_entity(clinic_id):
+    """Catalog entity bumped whenever an appointment at ``clinic_id`` changes."""
+    return f'appointments.{clinic_id}'
+
+
+def date_range(first=None, last=None):
+    """The inclusive ``(first_day, last_day)`` asked for, by default the last four weeks."""
+    last_day = parse_date(last) if last else timezone.localdate()
+    first_day = parse_date(first) if first else last_day - timedelta(days=DEFAULT_DAYS - 1)
+    if first_day is None or last_day is None:
+        raise ValueError('Dates must be given as YYYY-MM-DD.')
+    if first_day > last_day:
+        raise ValueError('"from" must not be after "to".')
+    if (last_day - first_day).days >= MAX_DAYS:
+        raise ValueError(f'At most {MAX_DAYS} days can be analysed at once.')
+    return first_day, last_day
+
+
+def clinic_report(clinic_id, first_day, last_day):
+    """Utilization of ``clinic_id`` from ``first_day`` to ``last_day`` inclusive, as JSON-ready data."""
+    if np is None:
+        raise AnalyticsUnavailable('Clinic analytics need NumPy, which is not installed.')
+    return catalog.get_or_build(
+        'clinic_analytics', ('doctors', 'clinics', 'availability', appointments_entity(clinic_id)),
+        lambda: _build(clinic_id, first_day, last_day),
+        key=f'{clinic_id}:{first_day}:{last_day}', timeout=ANALYTICS_TIMEOUT)
+
+
+def _columns(queryset, width):
+    """Stream the integer ``values_list`` rows of ``queryset`` into a ``(rows, width)`` array."""
+    rows = queryset.iterator(chunk_size=CHUNK_SIZE)
+    chunks = []
+    while chunk := list(islice(rows, CHUNK_SIZE)):
+        chunks.append(np.array(chunk, dtype=np.int64))
+    return np.concatenate(chunks) if chunks else np.empty((0, width), dtype=np.int64)
+
+
+def _buckets(epochs, midnights, first_weekday):
+    """The weekday x hour cell (0-167, local time) each of ``epochs`` falls in."""
+    day = np.searchsorted(midnights, epochs, side='right') - 1
+    hour = np.minimum((epochs - midnights[day]) // 3600, 23)  # a DST day can have 25 hours
+    return (first_weekday + day) % 7 * 24 + hour
+
+
+def _slot_starts(intervals, slot_seconds):
+    """Start of every whole slot in ``intervals`` (``(start, end, owner)`` epochs), with its owner."""
+    if not intervals:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    bounds = np.array(intervals, dtype=np.int64)
+    counts = np.maximum((bounds[:, 1] - bounds[:, 0]) // slot_seconds, 0)
+    # Position of each slot within its interval, without a Python loop over the slots.
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(bounds[:, 0], counts) + offsets * slot_seconds, np.repeat(bounds[:, 2], counts)
+
+
+def _ratio(numerator, denominator):
+    return round(float(numerator) / float(denominator), 4) if denominator else None
+
+
+def _ratios(numerators, denominators):
+    return [_ratio(n, d) for n, d in zip(numerators.tolist(), denominators.tolist())]
+
+
+def _capacity_intervals(clinic_id, doctors, first_day, last_day):
+    """``(start, end, doctor index)`` epochs of the hours each doctor works at ``clinic_id``."""
+    weekly, exceptions = {}, {}
+    for doctor_id, day, start_time, end_time, hours_clinic in Availability.objects.filter(
+            doctor_id__in=doctors).values_list('doctor_id', 'day', 'start_time', 'end_time', 'clinic_id'):
+        weekly.setdefault(doctor_id, {}).setdefault(WEEKDAYS[day], []).append((start_time, end_time, hours_clinic))
+    for doctor_id, date, *row in AvailabilityException.objects.filter(
+            doctor_id__in=doctors, date__gte=first_day, date__lte=last_day).values_list(
+            'doctor_id', 'date', 'start_time', 'end_time', 'available', 'clinic_id'):
+        exceptions.setdefault(doctor_id, {}).setdefault(date, []).append(tuple(row))
+
+    intervals = []
+    for index, doctor_id in enumerate(doctors):
+        day = first_day
+        while day <= last_day:
+            for start, end, hours_clinic in working_hours(weekly.get(doctor_id, {}), exceptions.get(doctor_id, {}),
+                                                          day):
+                if hours_clinic in (None, clinic_id):
+                    intervals.append((int(start.timestamp()), int(end.timestamp()), index))
+            day += timedelta(days=1)
+    return intervals
+
+
+def _build(clinic_id, first_day, last_day):
+    days = (last_day - first_day).days + 1
+    midnights = [timezone.make_aware(datetime.combine(first_day + timedelta(days=i), datetime.min.time()))
+                 for i in range(days + 1)]
+    edges = np.array([int(midnight.timestamp()) for midnight in midnights], dtype=np.int64)
+
+    names = dict(User.objects.filter(clinics=clinic_id).values_list('id', 'name'))
+    status = Case(*[When(status=name, then=Value(code)) for name, code in STATUS_CODES.items()],
+                  output_field=IntegerField())
+    appointments = _columns(
+        Appointment.objects.filter(clinic_id=clinic_id, appointment_datetime__gte=midnights[0],
+                                   appointment_datetime__lt=midnights[-1])
+        .order_by().values_list('doctor_id', EpochSeconds('appointment_datetime'), status), 3)
+    doctor_ids, epochs, codes = appointments.T
+
+    # Doctors who have since left the clinic still count for the appointments they had there.
+    missing = set(np.unique(doctor_ids).tolist()) - names.keys()
+    if missing:
+        names.update(User.objects.filter(id__in=missing).values_list('id', 'name'))
+    doctors = np.array(sorted(names), dtype=np.int64)
+    owners = np.searchsorted(doctors, doctor_ids)
+
+    slot_starts, slot_owners = _slot_starts(
+        _capacity_intervals(clinic_id, doctors.tolist(), first_day, last_day), SLOT_MINUTES * 60)
+
+    first_weekday = first_day.weekday()
+    booked = codes != CANCELLED
+    no_show = (codes == SCHEDULED) & (epochs < int(timezone.now().timestamp()))
+    cells = _buckets(epochs, edges, first_weekday)
+    booked_map = np.bincount(cells[booked], minlength=7 * 24)
+    capacity_map = np.bincount(_buckets(slot_starts, edges, first_weekday), minlength=7 * 24)
+
+    n = len(doctors)
+    per_doctor = {
+        'booked': np.bincount(owners[booked], minlength=n),
+        'capacity': np.bincount(slot_owners, minlength=n),
+        'completed': np.bincount(owners[codes == COMPLETED], minlength=n),
+        'cancelled': np.bincount(owners[codes == CANCELLED], minlength=n),
+        'no_show': np.bincount(owners[no_show], minlength=n),
+    }
+    counts = np.bincount(codes, minlength=3)
+    total, no_shows = int(len(codes)), int(no_show.sum())
+    return {
+        'clinic': clinic_id,
+        'from': first_day.isoformat(),
+        'to': last_day.isoformat(),
+        'slot_minutes': SLOT_MINUTES,
+        'totals': {
+            'appointments': total,
+            'scheduled': int(counts[SCHEDULED]) - no_shows,
+            'completed': int(counts[COMPLETED]),
+            'cancelled': int(counts[CANCELLED]),
+            'no_show': no_shows,
+            'booked_slots': int(booked.sum()),
+            'capacity_slots': int(len(slot_starts)),
+            'utilization': _ratio(booked.sum(), len(slot_starts)),
+            'cancellation_rate': _ratio(counts[CANCELLED], total),
+            # Past appointments that were never marked completed, out of all past ones that were kept.
+            'no_show_rate': _ratio(no_shows, counts[COMPLETED] + no_shows),
+        },
+        'heatmap': {
+            'weekdays': DAY_NAMES,
+            'booked': booked_map.reshape(7, 24).tolist(),
+            'capacity': capacity_map.reshape(7, 24).tolist(),
+            'utilization': [_ratios(b, c) for b, c in zip(booked_map.reshape(7, 24), capacity_map.reshape(7, 24))],
+        },
+        'doctors': [
+            dict({'doctor': doctor_id, 'name': names[doctor_id],
+                  'utilization': _ratio(per_doctor['booked'][i], per_doctor['capacity'][i])},
+                 **{name: int(values[i]) for name, values in per_doctor.items()})
+            for i, doctor_id in enumerate(doctors.tolist())
+        ],
+    }
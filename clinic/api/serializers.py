@@ -1,8 +1,62 @@
-from rest_framework.serializers import ModelSerializer
-from ..models import Clinic
+from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField, SerializerMethodField
 
+from ..models import Appointment, Availability, Clinic, Specialization, User
+
+
+class SparseFieldsMixin:
+    """Limit the serialized fields to a comma-separated ``?fields=`` query parameter."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        fields = request.query_params.get('fields') if request is not None else None
+        if fields:
+            wanted = {name.strip() for name in fields.split(',')}
+            for name in set(self.fields) - wanted:
+                self.fields.pop(name)
+
+
+class SpecializationSerializer(ModelSerializer):
+    class Meta:
+        model = Specialization
+        fields = ['id', 'name']
+
+
+class ClinicSerializer(SparseFieldsMixin, ModelSerializer):
+    specialization = SpecializationSerializer(read_only=True)
+    doctors = PrimaryKeyRelatedField(many=True, read_only=True)
 
-class ClinicSerializer(ModelSerializer):
     class Meta:
         model = Clinic
-        fields = '__all__'
\ No newline at end of file
+        fields = ['id', 'name', 'description', 'specialization', 'latitude', 'longitude', 'host', 'doctors', 'updated',
+                  'created']
+
+
+class DoctorSerializer(SparseFieldsMixin, ModelSerializer):
+    clinics = PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = User
+        fields = ['id', 'name', 'username', 'bio', 'avatar', 'clinics']
+
+
+class AvailabilitySerializer(SparseFieldsMixin, ModelSerializer):
+    class Meta:
+        model = Availability
+        fields = ['id', 'doctor', 'clinic', 'day', 'start_time', 'end_time']
+
+
+class AppointmentSerializer(SparseFieldsMixin, ModelSerializer):
+    doctor_name = SerializerMethodField()
+    clinic_name = SerializerMethodField()
+
+    class Meta:
+        model = Appointment
+        fields = ['id', 'doctor', 'doctor_name', 'patient', 'clinic', 'clinic_name',
+                  'appointment_datetime', 'reason', 'status', 'description', 'updated_at']
+
+    def get_doctor_name(self, appointment):
+        return appointment.doctor.name
+
+    def get_clinic_name(self, appointment):
+        return appointment.clinic.name
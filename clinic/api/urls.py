@@ -1,8 +1,11 @@
-from django.urls import path
+from rest_framework.routers import DefaultRouter
+
 from . import views
 
-urlpatterns = [
-    path('',  views.getRoutes),
-    path('rooms/', views.getRooms),
-    path('rooms/<str:pk>/', views.getRoom),
-]
+router = DefaultRouter()
+router.register('clinics', views.ClinicViewSet, basename='api-clinic')
+router.register('doctors', views.DoctorViewSet, basename='api-doctor')
+router.register('availability', views.AvailabilityViewSet, basename='api-availability')
+router.register('appointments', views.AppointmentViewSet, basename='api-appointment')
+
+urlpatterns = router.urls
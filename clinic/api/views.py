@@ -1,29 +1,105 @@
-from rest_framework.decorators import api_view
-from rest_framework.response import Response
-from ..models import Room
-from .serializers import RoomSerializer
-from ..api import serializers
-
-
-@api_view(['GET'])
-def getRoutes(request):
-    routes = [
-        'GET /api',
-        'GET /api/rooms',
-        'GET /api/rooms/:id'
-    ]
-    return Response(routes)
-
-
-@api_view(['GET'])
-def getRooms(request):
-    rooms = Room.objects.all()
-    serializer = RoomSerializer(rooms, many=True)
-    return Response(serializer.data)
-
-
-@api_view(['GET'])
-def getRoom(request, pk):
-    room = Room.objects.get(id=pk)
-    serializer = RoomSerializer(room, many=False)
-    return Response(serializer.data)
+from django.db.models import Prefetch
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.viewsets import ReadOnlyModelViewSet
+
+from ..models import Appointment, Availability, Clinic, User
+from .serializers import AppointmentSerializer, AvailabilitySerializer, ClinicSerializer, DoctorSerializer
+
+
+def _id_param(request, name):
+    """The integer id passed as ``?name=``, or None; anything else is a 400."""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    if not (value.isascii() and value.isdigit()):
+        raise ValidationError({name: 'Expected an id.'})
+    return int(value)
+
+
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class AppointmentCursorPagination(IdCursorPagination):
+    ordering = ('-appointment_datetime', '-id')
+
+
+class ConditionalGetMixin:
+    """
+    Tag every successful GET with an ETag of its body and answer a matching
+    ``If-None-Match`` with an empty 304, so polling clients only download
+    data that actually changed.
+    """
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return response
+        response.render()
+        set_response_etag(response)
+        patch_cache_control(response, no_cache=True)
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+class ClinicViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
+    serializer_class = ClinicSerializer
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = Clinic.objects.select_related('specialization').prefetch_related(
+            Prefetch('doctors', queryset=User.objects.only('id')))
+        specialization = _id_param(self.request, 'specialization')
+        if specialization is not None:
+            queryset = queryset.filter(specialization_id=specialization)
+        return queryset
+
+
+class DoctorViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
+    serializer_class = DoctorSerializer
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = User.objects.filter(role='doctor', is_active=True).prefetch_related(
+            Prefetch('clinics', queryset=Clinic.objects.only('id')))
+        clinic = _id_param(self.request, 'clinic')
+        if clinic is not None:
+            queryset = queryset.filter(clinics=clinic)
+        specialization = _id_param(self.request, 'specialization')
+        if specialization is not None:
+            queryset = queryset.filter(clinics__specialization=specialization).distinct()
+        return queryset
+
+
+class AvailabilityViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
+    serializer_class = AvailabilitySerializer
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = Availability.objects.all()
+        doctor = _id_param(self.request, 'doctor')
+        if doctor is not None:
+            queryset = queryset.filter(doctor_id=doctor)
+        return queryset
+
+
+class AppointmentViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
+    serializer_class = AppointmentSerializer
+    pagination_class = AppointmentCursorPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        user = self.request.user
+        if user.role == 'doctor':
+            queryset = Appointment.objects.filter(doctor=user)
+        else:
+            queryset = Appointment.objects.filter(patient=user)
+        status = self.request.query_params.get('status')
+        if status:
+            queryset = queryset.filter(status=status)
+        return queryset.select_related('doctor', 'clinic')
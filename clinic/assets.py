@@ -0,0 +1,136 @@
+"""
+Static and media asset pipeline.
+
+``CompressedManifestStaticFilesStorage`` gives every collected file a
+content-hashed name (``main.3f2a9c1b7d4e.css``) and writes gzip and, when the
+optional ``brotli`` package is installed, brotli copies next to compressible
+ones. ``serve`` then delivers static and media files from the application
+process: it picks the precompressed copy the client accepts, marks hashed
+names as immutable for a year, answers conditional requests with 304, and
+streams through ``FileResponse`` so WSGI servers with ``wsgi.file_wrapper``
+can use ``sendfile``.
+"""
+
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.svg', '.html', '.txt', '.json', '.map', '.xml', '.ico')
+MIN_SIZE = 256
+# Compressed copies must save at least this fraction of the original to be kept.
+MIN_SAVING = 0.05
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_MAX_AGE = 60 * 60
+
+# Names written by ManifestStaticFilesStorage and by clinic.images.
+HASHED_STATIC = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+HASHED_MEDIA = re.compile(r'^avatars/[0-9a-f]{16}-\d+\.\w+$')
+
+# (Accept-Encoding token, suffix of the precompressed copy), in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _compress(data):
+    yield '.gz', gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in self.hashed_files.values():
+            if name.endswith(COMPRESSIBLE):
+                self._write_compressed(name)
+
+    def _write_compressed(self, name):
+        with self.open(name) as f:
+            data = f.read()
+        if len(data) < MIN_SIZE:
+            return
+        for suffix, compressed in _compress(data):
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+
+
+def _accepted(request):
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        token, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def serve(request, path, document_root, immutable=None):
+    """Serve ``path`` below ``document_root``, preferring a precompressed copy the client accepts."""
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(document_root, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        st = os.stat(fullpath)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+    served, content_encoding = fullpath, None
+    if encoding is None:
+        accepted = _accepted(request)
+        for token, suffix in ENCODINGS:
+            if token in accepted and os.path.isfile(fullpath + suffix):
+                served, content_encoding = fullpath + suffix, token
+                break
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}{"-" + content_encoding if content_encoding else ""}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is None:
+        response = FileResponse(open(served, 'rb'), content_type=content_type, filename=os.path.basename(path))
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+        # Assets are displayed inline, so there is no file name to suggest.
+        response.headers.pop('Content-Disposition', None)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(st.st_mtime)
+    response['Vary'] = 'Accept-Encoding'
+    if immutable is not None and immutable.search(path):
+        response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={DEFAULT_MAX_AGE}'
+    return response
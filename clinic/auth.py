@@ -0,0 +1,97 @@
+"""
+Per-process cache of authenticated users.
+
+Django's ``AuthenticationMiddleware`` loads the session and then the user on
+every request. ``CachedAuthenticationMiddleware`` keeps the user it loaded in
+memory for ``CLINIC_USER_CACHE_SECONDS``, keyed by the session key, the user id
+and the password hash recorded in the session, so a logout or password change
+never matches an old entry. Saving a user drops its entries in this process
+(see ``clinic.signals``); other processes notice within the timeout. Each
+request gets its own copy, so changes a view makes to ``request.user`` never
+leak into another request.
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.utils.functional import SimpleLazyObject
+
+
+USER_CACHE_SECONDS = getattr(settings, 'CLINIC_USER_CACHE_SECONDS', 30)
+USER_CACHE_SIZE = getattr(settings, 'CLINIC_USER_CACHE_SIZE', 10000)
+
+
+class UserCache:
+
+    def __init__(self, timeout=USER_CACHE_SECONDS, size=USER_CACHE_SIZE):
+        self.timeout = timeout
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, user), least recently used first
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, user):
+        if self.timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def forget_user(self, user_id):
+        with self._lock:
+            for key in [key for key, (_, user) in self._entries.items() if user.pk == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def get_user(request):
+    """``django.contrib.auth.get_user``, served from ``user_cache`` when the session still matches."""
+    session = request.session
+    user_id = session.get(auth.SESSION_KEY)
+    if user_id is None:
+        return auth.get_user(request)
+    key = (session.session_key, user_id, session.get(auth.BACKEND_SESSION_KEY),
+           session.get(auth.HASH_SESSION_KEY))
+    user = user_cache.get(key)
+    if user is None:
+        user = auth.get_user(request)
+        if not user.is_authenticated:
+            return user
+        user_cache.set(key, user)
+    return copy.copy(user)
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+
+    def process_request(self, request):
+        super().process_request(request)
+
+        def load():
+            if not hasattr(request, '_cached_user'):
+                request._cached_user = get_user(request)
+            return request._cached_user
+
+        request.user = SimpleLazyObject(load)
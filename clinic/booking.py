@@ -0,0 +1,136 @@
+"""
+Contention-safe booking.
+
+A patient first places a short-lived hold on a slot while filling in the
+booking form; competing patients are turned away as soon as they try to hold
+or book the same slot instead of racing each other to the commit. Only future
+slots of the doctor's working hours can be held, and only a few at a time per
+patient. The final booking runs in a single transaction, which checks again
+that the time is one of the doctor's slots at that clinic, and is retried when
+SQLite reports that the database is busy.
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.utils import timezone
+
+from .models import Appointment, SlotHold
+from .slots import slot_index
+
+
+HOLD_MINUTES = getattr(settings, 'CLINIC_HOLD_MINUTES', 5)
+MAX_HOLDS = getattr(settings, 'CLINIC_MAX_HOLDS', 3)
+BOOKING_RETRIES = getattr(settings, 'CLINIC_BOOKING_RETRIES', 5)
+RETRY_BACKOFF = 0.02
+
+
+class SlotUnavailable(Exception):
+    """The slot is already booked or held by another patient."""
+
+
+class BookingBusy(Exception):
+    """The database stayed locked for every retry attempt."""
+
+
+class InvalidSlot(Exception):
+    """The time is in the past or not the start of one of the doctor's slots."""
+
+
+class TooManyHolds(Exception):
+    """The patient already holds ``MAX_HOLDS`` other slots."""
+
+
+def _with_retries(operation):
+    for attempt in range(BOOKING_RETRIES):
+        try:
+            return operation()
+        except OperationalError:
+            if attempt == BOOKING_RETRIES - 1:
+                raise BookingBusy()
+            time.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+
+def _slot_taken(doctor_id, when):
+    return Appointment.objects.filter(
+        doctor_id=doctor_id, appointment_datetime=when
+    ).exclude(status='Cancelled').exists()
+
+
+def check_slot(clinic, doctor, when):
+    """Raise ``InvalidSlot`` unless ``when`` starts a future slot of ``doctor`` at ``clinic``."""
+    if (when <= timezone.now() or not slot_index.is_slot(doctor.id, when, clinic.id)
+            or not clinic.doctors.filter(pk=doctor.pk).exists()):
+        raise InvalidSlot()
+
+
+def place_hold(patient, doctor_id, when):
+    """Reserve ``when`` with ``doctor_id`` for ``patient`` and return the hold."""
+    if when <= timezone.now() or not slot_index.is_slot(doctor_id, when):
+        raise InvalidSlot()
+
+    def attempt():
+        now = timezone.now()
+        expires_at = now + timedelta(minutes=HOLD_MINUTES)
+        with transaction.atomic():
+            SlotHold.objects.filter(doctor_id=doctor_id, starts_at=when, expires_at__lte=now).delete()
+            if _slot_taken(doctor_id, when):
+                raise SlotUnavailable()
+            others = SlotHold.objects.filter(patient=patient, expires_at__gt=now).exclude(
+                doctor_id=doctor_id, starts_at=when)
+            if others.count() >= MAX_HOLDS:
+                raise TooManyHolds()
+            try:
+                with transaction.atomic():
+                    hold, created = SlotHold.objects.get_or_create(
+                        doctor_id=doctor_id, starts_at=when,
+                        defaults={'patient': patient, 'expires_at': expires_at},
+                    )
+            except IntegrityError:
+                raise SlotUnavailable()
+            if not created:
+                if hold.patient_id != patient.id:
+                    raise SlotUnavailable()
+                hold.expires_at = expires_at
+                hold.save(update_fields=['expires_at'])
+        return hold
+
+    return _with_retries(attempt)
+
+
+def release_hold(patient, doctor_id, when):
+    SlotHold.objects.filter(doctor_id=doctor_id, starts_at=when, patient=patient).delete()
+
+
+def book(patient, clinic, doctor, when, reason):
+    """
+    Create a scheduled appointment, raising ``InvalidSlot`` when ``when`` is
+    not one of the doctor's slots at ``clinic``, ``SlotUnavailable`` when
+    another patient holds or owns the slot and ``BookingBusy`` when the
+    database could not be written within the retry budget.
+    """
+    held_by_other = SlotHold.objects.filter(
+        doctor=doctor, starts_at=when, expires_at__gt=timezone.now()
+    ).exclude(patient=patient).exists()
+    if held_by_other:
+        raise SlotUnavailable()
+
+    def attempt():
+        try:
+            with transaction.atomic():
+                check_slot(clinic, doctor, when)
+                appointment = Appointment.objects.create(
+                    patient=patient,
+                    clinic=clinic,
+                    doctor=doctor,
+                    appointment_datetime=when,
+                    reason=reason,
+                )
+                SlotHold.objects.filter(doctor=doctor, starts_at=when).delete()
+        except IntegrityError:
+            raise SlotUnavailable()
+        return appointment
+
+    return _with_retries(attempt)
@@ -0,0 +1,297 @@
+"""
+Streaming bulk import and export of doctors, patients, availability and appointments.
+
+Records are read one line at a time, validated, and written with ``bulk_create``
+in fixed-size batches, so memory use does not grow with the size of the input.
+Users are referenced by email (or id) so that an export from one installation
+can be imported into another. Export walks a server-side iterator and yields
+one line per row.
+"""
+
+import csv
+import io
+import json
+from datetime import time
+
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_time
+
+from .models import Appointment, Availability, Clinic, User
+
+
+KINDS = ('doctor', 'patient', 'availability', 'appointment')
+FORMATS = ('csv', 'jsonl')
+
+EXPORT_FIELDS = {
+    'availability': ('doctor', 'day', 'start_time', 'end_time', 'clinic'),
+    'appointment': ('doctor', 'patient', 'clinic', 'appointment_datetime', 'reason', 'status', 'description'),
+}
+
+DAYS = {day for day, _ in Availability.DAY_CHOICES}
+STATUSES = {status for status, _ in Appointment.STATUS_CHOICES}
+
+
+class RecordError(ValueError):
+    pass
+
+
+def read_records(stream, fmt, kind=None):
+    """
+    Yield ``(line_number, kind, record)`` from a text stream. JSONL lines carry
+    their own ``type``; CSV files hold a single ``kind`` given by the caller.
+    """
+    if fmt == 'csv':
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, row.get('type') or kind, row
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, RecordError(f'invalid JSON: {e}')
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, RecordError('expected a JSON object')
+                continue
+            yield line_number, record.pop('type', kind), record
+
+
+def _required(record, field):
+    value = record.get(field)
+    if value in (None, ''):
+        raise RecordError(f'missing {field}')
+    return value
+
+
+def _time(record, field):
+    value = _required(record, field)
+    try:
+        parsed = value if isinstance(value, time) else parse_time(str(value))
+    except ValueError:  # well-formed but out of range, such as 25:00
+        parsed = None
+    if parsed is None:
+        raise RecordError(f'invalid {field}: {value!r}')
+    return parsed
+
+
+def _datetime(record, field):
+    value = _required(record, field)
+    try:
+        parsed = parse_datetime(str(value))
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise RecordError(f'invalid {field}: {value!r}')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Importer:
+    """
+    Accumulates validated records per kind and flushes each kind with one
+    ``bulk_create`` once ``batch_size`` records are pending. References to
+    users and clinics are resolved with one query per batch. With
+    ``ignore_conflicts`` rows that already exist are skipped silently, so
+    ``accepted`` counts valid records rather than inserted rows.
+    """
+
+    def __init__(self, batch_size=1000, ignore_conflicts=True):
+        self.batch_size = batch_size
+        self.ignore_conflicts = ignore_conflicts
+        self.pending = {kind: [] for kind in KINDS}
+        self.accepted = {kind: 0 for kind in KINDS}
+        self.errors = []
+        self.doctor_ids = set()
+        self._unusable_password = make_password(None)
+
+    def add(self, line_number, kind, record):
+        if isinstance(record, RecordError):
+            self.errors.append((line_number, str(record)))
+            return
+        if kind not in KINDS:
+            self.errors.append((line_number, f'unknown record type {kind!r}'))
+            return
+        self.pending[kind].append((line_number, record))
+        if len(self.pending[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def finish(self):
+        # Users first, so that availability and appointments in the same file can refer to them.
+        for kind in KINDS:
+            self.flush(kind)
+
+    def flush(self, kind):
+        batch, self.pending[kind] = self.pending[kind], []
+        if not batch:
+            return
+        if kind in ('availability', 'appointment'):
+            self.flush('doctor')
+            self.flush('patient')
+
+        build = getattr(self, f'_build_{kind}')
+        context = self._resolve(kind, batch)
+        objects = []
+        for line_number, record in batch:
+            try:
+                objects.append(build(record, context))
+            except RecordError as e:
+                self.errors.append((line_number, str(e)))
+
+        getattr(self, f'_model_{kind}').objects.bulk_create(
+            objects, batch_size=self.batch_size, ignore_conflicts=self.ignore_conflicts)
+        self.accepted[kind] += len(objects)
+        if kind == 'doctor':
+            # Rows skipped as conflicts get no pk back, so look the batch up by email.
+            self.doctor_ids.update(User.objects.filter(
+                email__in=[doctor.email for doctor in objects], role='doctor').values_list('id', flat=True))
+
+    _model_doctor = _model_patient = User
+    _model_availability = Availability
+    _model_appointment = Appointment
+
+    def _resolve(self, kind, batch):
+        if kind in ('doctor', 'patient'):
+            candidates = set()
+            for _, record in batch:
+                email = str(record.get('email') or '')
+                candidates.update((record.get('username') or '', email.split('@')[0], email))
+            # username -> email of whoever has it, so that batch rows can claim them too.
+            return {'usernames': dict(User.objects.filter(username__in=candidates).values_list('username', 'email'))}
+        refs = set()
+        clinic_ids = set()
+        for _, record in batch:
+            refs.add(str(record.get('doctor', '')))
+            if kind == 'appointment':
+                refs.add(str(record.get('patient', '')))
+            clinic_ids.add(str(record.get('clinic') or ''))
+
+        emails = {ref for ref in refs if '@' in ref}
+        ids = {int(ref) for ref in refs if ref.isdigit()}
+        users = {}
+        for pk, email, role in User.objects.filter(email__in=emails).values_list('id', 'email', 'role'):
+            users[email] = (pk, role)
+        for pk, role in User.objects.filter(id__in=ids).values_list('id', 'role'):
+            users[str(pk)] = (pk, role)
+
+        clinics = set()
+        if clinic_ids:
+            clinics = set(Clinic.objects.filter(
+                id__in=[int(pk) for pk in clinic_ids if pk.isdigit()]).values_list('id', flat=True))
+        return {'users': users, 'clinics': clinics}
+
+    def _user(self, record, field, context, role=None):
+        ref = str(_required(record, field))
+        if ref not in context['users']:
+            raise RecordError(f'unknown {field} {ref!r}')
+        pk, user_role = context['users'][ref]
+        if role and user_role != role:
+            raise RecordError(f'{field} {ref!r} is not a {role}')
+        return pk
+
+    def _username(self, record, email, context):
+        """
+        The given username, or else the local part of the email, or the whole
+        email when another user already has the local part.
+        """
+        taken = context['usernames']
+        if record.get('username'):
+            candidates = [record['username']]
+        else:
+            candidates = [email.split('@')[0], email]
+        for username in candidates:
+            if taken.get(username, email) == email:
+                taken[username] = email
+                return username
+        raise RecordError(f'username {candidates[0]!r} is taken')
+
+    def _build_user(self, record, role, context):
+        email = _required(record, 'email')
+        return User(
+            email=email,
+            username=self._username(record, email, context),
+            name=record.get('name') or None,
+            bio=record.get('bio') or None,
+            role=role,
+            password=self._unusable_password,
+        )
+
+    def _build_doctor(self, record, context):
+        return self._build_user(record, 'doctor', context)
+
+    def _build_patient(self, record, context):
+        return self._build_user(record, 'patient', context)
+
+    def _build_availability(self, record, context):
+        day = _required(record, 'day')
+        if day not in DAYS:
+            raise RecordError(f'invalid day {day!r}')
+        start_time, end_time = _time(record, 'start_time'), _time(record, 'end_time')
+        if start_time >= end_time:
+            raise RecordError('start_time must be before end_time')
+        clinic = str(record.get('clinic') or '')
+        if clinic and (not clinic.isdigit() or int(clinic) not in context['clinics']):
+            raise RecordError(f'unknown clinic {clinic!r}')
+        doctor_id = self._user(record, 'doctor', context, role='doctor')
+        self.doctor_ids.add(doctor_id)
+        return Availability(doctor_id=doctor_id, day=day, start_time=start_time, end_time=end_time,
+                            clinic_id=int(clinic) if clinic else None)
+
+    def _build_appointment(self, record, context):
+        status = record.get('status') or 'Scheduled'
+        if status not in STATUSES:
+            raise RecordError(f'invalid status {status!r}')
+        clinic = str(_required(record, 'clinic'))
+        if not clinic.isdigit() or int(clinic) not in context['clinics']:
+            raise RecordError(f'unknown clinic {clinic!r}')
+        doctor_id = self._user(record, 'doctor', context, role='doctor')
+        self.doctor_ids.add(doctor_id)
+        return Appointment(
+            doctor_id=doctor_id,
+            patient_id=self._user(record, 'patient', context),
+            clinic_id=int(clinic),
+            appointment_datetime=_datetime(record, 'appointment_datetime'),
+            reason=_required(record, 'reason'),
+            status=status,
+            description=record.get('description') or None,
+        )
+
+
+def export_queryset(kind, doctor=None):
+    if kind == 'availability':
+        queryset = Availability.objects.order_by('id').values_list(
+            'doctor__email', 'day', 'start_time', 'end_time', 'clinic_id')
+    else:
+        queryset = Appointment.objects.order_by('id').values_list(
+            'doctor__email', 'patient__email', 'clinic_id', 'appointment_datetime',
+            'reason', 'status', 'description')
+    if doctor is not None:
+        queryset = queryset.filter(doctor=doctor)
+    return queryset
+
+
+def export_lines(kind, rows, fmt):
+    """Yield the export of ``rows`` (tuples in ``EXPORT_FIELDS[kind]`` order) line by line."""
+    fields = EXPORT_FIELDS[kind]
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        for row in rows:
+            writer.writerow([value.isoformat() if hasattr(value, 'isoformat') else value for value in row])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    else:
+        for row in rows:
+            record = {'type': kind}
+            for field, value in zip(fields, row):
+                record[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+            yield json.dumps(record) + '\n'
@@ -0,0 +1,147 @@
+"""
+Versioned cache for catalog data that changes rarely: doctors, their weekly
+availability, specializations and clinics.
+
+Every cached value is stored under a key that embeds the current version of
+each entity it was built from. Saving or deleting one of those models bumps
+the entity's version (see ``clinic.signals``), so stale entries are never read
+again and age out on their own; nothing has to know which keys to delete.
+Versions live in the same cache as the data, so every process sharing that
+cache sees an invalidation at once.
+"""
+
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Availability, Clinic, Specialization, User
+from .slots import WEEKDAYS
+
+
+ENTITIES = ('doctors', 'availability', 'specializations', 'clinics', 'directory')
+CATALOG_TIMEOUT = getattr(settings, 'CLINIC_CATALOG_TIMEOUT', 60 * 60)
+
+DOCTOR_FIELDS = ('id', 'name', 'username', 'bio', 'avatar', 'avatar_variants', 'role', 'profile__specialization_name')
+
+_MISSING = object()
+
+# name -> {'hits', 'misses'} for this process
+counters = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+
+def _version_key(entity):
+    return f'clinic:catalog:version:{entity}'
+
+
+def _new_version():
+    # Time based, so a version that was evicted never comes back at a value already used.
+    return time.time_ns() // 1000
+
+
+def bump(entity):
+    try:
+        cache.incr(_version_key(entity))
+    except ValueError:
+        cache.set(_version_key(entity), _new_version(), None)
+
+
+def _resolve_versions(keys, found):
+    missing = [key for key in keys if key not in found]
+    for key in missing:
+        cache.add(key, _new_version(), None)
+    if missing:
+        found.update(cache.get_many(missing))
+    return found
+
+
+def _data_key(name, entities, versions, key):
+    stamp = '.'.join(f'{entity}{versions[_version_key(entity)]}' for entity in entities)
+    return f'clinic:catalog:{name}:{key}:{stamp}'
+
+
+def _count(name, hit):
+    counters[name]['hits' if hit else 'misses'] += 1
+
+
+def get_or_build(name, entities, build, key='', timeout=CATALOG_TIMEOUT):
+    """Return the cached value for ``name``/``key``, calling ``build()`` when any of ``entities`` changed."""
+    version_keys = [_version_key(entity) for entity in entities]
+    versions = _resolve_versions(version_keys, cache.get_many(version_keys))
+    data_key = _data_key(name, entities, versions, key)
+    value = cache.get(data_key, _MISSING)
+    _count(name, value is not _MISSING)
+    if value is _MISSING:
+        value = build()
+        cache.set(data_key, value, timeout)
+    return value
+
+
+async def aget_or_build(name, entities, build, key='', timeout=CATALOG_TIMEOUT):
+    """``get_or_build`` for async views; ``build`` is a coroutine function."""
+    version_keys = [_version_key(entity) for entity in entities]
+    found = await cache.aget_many(version_keys)
+    if len(found) < len(version_keys):
+        found = _resolve_versions(version_keys, found)
+    data_key = _data_key(name, entities, found, key)
+    value = await cache.aget(data_key, _MISSING)
+    _count(name, value is not _MISSING)
+    if value is _MISSING:
+        value = await build()
+        await cache.aset(data_key, value, timeout)
+    return value
+
+
+def stats():
+    """Hit/miss counters per cached value, with hit rates."""
+    result = {}
+    for name, counts in sorted(counters.items()):
+        total = counts['hits'] + counts['misses']
+        result[name] = dict(counts, hit_rate=round(counts['hits'] / total, 3) if total else None)
+    return result
+
+
+def specializations():
+    return get_or_build('specializations', ('specializations',),
+                        lambda: list(Specialization.objects.order_by('name')))
+
+
+def clinics():
+    return get_or_build('clinics', ('clinics', 'specializations', 'doctors'),
+                        lambda: list(Clinic.objects.select_related('specialization', 'host')))
+
+
+def clinic_names():
+    """``{id: name}`` of every clinic, for labels that do not need the whole model."""
+    return get_or_build('clinic_names', ('clinics',), lambda: dict(Clinic.objects.values_list('id', 'name')))
+
+
+def clinic(pk):
+    """The clinic with id ``pk``; raises ``Clinic.DoesNotExist`` like ``Clinic.objects.get``."""
+    return get_or_build('clinic', ('clinics', 'specializations'),
+                        lambda: Clinic.objects.select_related('specialization').get(pk=pk), key=pk)
+
+
+def doctors():
+    return get_or_build('doctors', ('doctors',),
+                        lambda: list(User.objects.filter(role='doctor').select_related('profile').only(*DOCTOR_FIELDS)))
+
+
+async def _doctors_with_availability():
+    doctors = [doctor async for doctor in User.objects.filter(role='doctor', is_active=True)
+               .select_related('profile').only(*DOCTOR_FIELDS)]
+    by_doctor = {doctor.id: doctor for doctor in doctors}
+    for doctor in doctors:
+        doctor.weekly_availability = []
+    # prefetch_related() is not available to async iteration in Django 4.2, so group by hand.
+    async for slot in Availability.objects.filter(doctor__in=by_doctor).select_related('clinic').order_by('id'):
+        by_doctor[slot.doctor_id].weekly_availability.append(slot)
+    for doctor in doctors:
+        doctor.weekly_availability.sort(key=lambda slot: (WEEKDAYS[slot.day], slot.start_time))
+    return doctors
+
+
+async def adoctors_with_availability():
+    """Active doctors, each with a ``weekly_availability`` list in weekday and time order."""
+    return await aget_or_build('doctor_list', ('doctors', 'availability', 'clinics'), _doctors_with_availability)
@@ -0,0 +1,70 @@
+"""
+Cached patient dashboard summary.
+
+The summary cards and upcoming-appointment table are rendered once per patient
+and cached until that patient's appointments change (see ``clinic.signals``)
+or the next upcoming appointment starts, whichever comes first. A cache miss
+costs three queries regardless of how long the patient's history is.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import Appointment, User
+
+
+SUMMARY_TIMEOUT = 300
+UPCOMING_LIMIT = 10
+
+
+def summary_key(patient_id):
+    return f'clinic:patient-summary:{patient_id}'
+
+
+def invalidate_patient(patient_id):
+    cache.delete(summary_key(patient_id))
+
+
+def patient_summary(user):
+    key = summary_key(user.id)
+    html = cache.get(key)
+    if html is not None:
+        return html
+
+    now = timezone.now()
+    # Cancelled appointments are neither upcoming nor completed visits.
+    appointments = Appointment.objects.filter(patient=user).exclude(status='Cancelled')
+    counts = appointments.aggregate(
+        upcoming=Count('id', filter=Q(appointment_datetime__gte=now)),
+        completed=Count('id', filter=Q(appointment_datetime__lt=now)),
+    )
+    upcoming = list(
+        appointments.filter(appointment_datetime__gte=now)
+        .select_related('doctor', 'Specialization')
+        .order_by('appointment_datetime')[:UPCOMING_LIMIT]
+    )
+    doctor_count = User.objects.filter(role='doctor', is_active=True).count()
+
+    html = render_to_string('clinic/patient_summary.html', {
+        'upcoming_count': counts['upcoming'],
+        'completed_visits_count': counts['completed'],
+        'doctor_count': doctor_count,
+        'upcoming_appointments': upcoming,
+    })
+
+    timeout = SUMMARY_TIMEOUT
+    if upcoming:
+        # The first upcoming appointment turns into a completed visit when it starts.
+        timeout = max(1, min(timeout, int((upcoming[0].appointment_datetime - now).total_seconds())))
+    cache.set(key, html, timeout)
+    return html
+
+
+async def apatient_summary(user):
+    html = await cache.aget(summary_key(user.id))
+    if html is None:
+        html = await sync_to_async(patient_summary)(user)
+    return html
@@ -0,0 +1,226 @@
+"""
+Doctor directory: denormalized profiles and faceted filtering.
+
+``DoctorProfile`` holds what the directory lists, copied out of the tables it
+normally comes from: the specialization of the doctor's clinics, the clinic
+memberships and the next free slot. ``DoctorFacet`` has one row per doctor and
+filterable value (specialization, clinic, weekday with working hours) under a
+unique index on ``(facet, value, doctor)``, so each filter is an index lookup
+and the doctor counts of every facet come from one grouped query.
+
+Only active doctors have rows. ``clinic.signals`` queues ``refresh_profiles``
+when memberships, hours or appointments change; ``manage.py run_worker``
+refreshes profiles whose next free slot has gone by, and
+``manage.py rebuild_doctor_profiles`` rebuilds everything.
+"""
+
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import catalog, tasks
+from .models import Availability, Clinic, DoctorFacet, DoctorProfile, User
+from .slots import WEEKDAYS, next_free_slots
+
+
+FACETS = ('specialization', 'clinic', 'day')
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Keeps the IN lists of a rebuild within SQLite's variable limit.
+BATCH_SIZE = 500
+
+
+def _profiles(doctor_ids):
+    """``(profile, facet rows)`` per active doctor among ``doctor_ids``."""
+    doctor_ids = set(User.objects.filter(id__in=doctor_ids, role='doctor', is_active=True)
+                     .values_list('id', flat=True))
+    clinics, specializations, names = {}, {}, {}
+    for doctor_id, clinic_id, specialization_id, name in Clinic.doctors.through.objects.filter(
+            user_id__in=doctor_ids).values_list('user_id', 'clinic_id', 'clinic__specialization_id',
+                                                'clinic__specialization__name'):
+        clinics.setdefault(doctor_id, []).append(clinic_id)
+        if specialization_id is not None:
+            specializations.setdefault(doctor_id, Counter())[specialization_id] += 1
+            names[specialization_id] = name
+    days = {}
+    for doctor_id, day in Availability.objects.filter(doctor_id__in=doctor_ids).values_list(
+            'doctor_id', 'day').distinct():
+        days.setdefault(doctor_id, set()).add(day)
+    next_available = next_free_slots(sorted(doctor_ids))
+
+    built = {}
+    for doctor_id in doctor_ids:
+        counts = specializations.get(doctor_id, Counter())
+        # Most clinics first, then the lowest id, so the choice does not flip between rebuilds.
+        primary = min(counts, key=lambda pk: (-counts[pk], pk)) if counts else None
+        profile = DoctorProfile(doctor_id=doctor_id, specialization_id=primary,
+                                specialization_name=names.get(primary, ''),
+                                clinic_ids=sorted(clinics.get(doctor_id, [])),
+                                next_available=next_available[doctor_id])
+        facets = ([('specialization', pk) for pk in counts] + [('clinic', pk) for pk in profile.clinic_ids]
+                  + [('day', day) for day in days.get(doctor_id, ())])
+        built[doctor_id] = profile, [DoctorFacet(doctor_id=doctor_id, facet=facet, value=str(value))
+                                     for facet, value in facets]
+    return built
+
+
+def refresh(doctor_ids):
+    """Rebuild the profiles and facets of ``doctor_ids``, dropping those of users who are no longer doctors."""
+    doctor_ids = set(doctor_ids)
+    built = _profiles(doctor_ids)
+    existing = {profile.doctor_id: profile for profile in DoctorProfile.objects.filter(doctor_id__in=doctor_ids)}
+    fields = ('specialization', 'specialization_name', 'clinic_ids', 'next_available')
+    changed = [profile for doctor_id, (profile, _) in built.items() if doctor_id in existing
+               and any(getattr(profile, field) != getattr(existing[doctor_id], field) for field in fields)]
+    for profile in changed:
+        profile.pk = existing[profile.doctor_id].pk
+        profile.updated_at = timezone.now()
+
+    facets = {doctor_id: rows for doctor_id, (_, rows) in built.items()}
+    old_facets = {}
+    for doctor_id, facet, value in DoctorFacet.objects.filter(doctor_id__in=doctor_ids).values_list(
+            'doctor_id', 'facet', 'value'):
+        old_facets.setdefault(doctor_id, set()).add((facet, value))
+    # Most refreshes only move the next free slot; facets are rewritten for the doctors whose values changed.
+    refaceted = {doctor_id for doctor_id in doctor_ids if old_facets.get(doctor_id, set())
+                 != {(row.facet, row.value) for row in facets.get(doctor_id, ())}}
+
+    with transaction.atomic():
+        DoctorProfile.objects.filter(doctor_id__in=doctor_ids - built.keys()).delete()
+        DoctorProfile.objects.bulk_create([profile for doctor_id, (profile, _) in built.items()
+                                           if doctor_id not in existing])
+        DoctorProfile.objects.bulk_update(changed, fields + ('updated_at',))
+        DoctorFacet.objects.filter(doctor_id__in=refaceted).delete()
+        DoctorFacet.objects.bulk_create([row for doctor_id in refaceted for row in facets.get(doctor_id, ())])
+    if refaceted:
+        transaction.on_commit(lambda: catalog.bump('directory'))
+    # catalog.doctors() shows the specialization name; the next free slot is not cached there.
+    if existing.keys() != built.keys() or any(
+            profile.specialization_name != existing[profile.doctor_id].specialization_name for profile in changed):
+        transaction.on_commit(lambda: catalog.bump('doctors'))
+    return len(built)
+
+
+def rebuild():
+    """Rebuild every profile; returns the number of doctors listed."""
+    doctor_ids = set(User.objects.filter(role='doctor').values_list('id', flat=True))
+    doctor_ids |= set(DoctorProfile.objects.values_list('doctor_id', flat=True))
+    doctor_ids = sorted(doctor_ids)
+    return sum(refresh(doctor_ids[i:i + BATCH_SIZE]) for i in range(0, len(doctor_ids), BATCH_SIZE))
+
+
+def refresh_passed(now=None):
+    """Refresh the profiles whose next free slot has started; returns how many."""
+    doctor_ids = list(DoctorProfile.objects.filter(next_available__lte=now or timezone.now())
+                      .values_list('doctor_id', flat=True)[:BATCH_SIZE])
+    if doctor_ids:
+        refresh(doctor_ids)
+    return len(doctor_ids)
+
+
+@tasks.task
+def refresh_profiles(doctor_ids):
+    refresh(doctor_ids)
+
+
+def queue_refresh(*doctor_ids):
+    doctor_ids = sorted({doctor_id for doctor_id in doctor_ids if doctor_id is not None})
+    if doctor_ids:
+        refresh_profiles.enqueue(doctor_ids=doctor_ids)
+
+
+# -- filtering ----------------------------------------------------------------
+
+def parse_filters(params):
+    """``{facet: [values]}`` from query parameters such as ``?clinic=1&clinic=2&day=Monday``."""
+    filters = {}
+    for facet in FACETS:
+        values = [value for value in params.getlist(facet) if value]
+        if not values:
+            continue
+        if facet == 'day':
+            if any(value not in WEEKDAYS for value in values):
+                raise ValueError(f'"day" must be one of {", ".join(WEEKDAYS)}.')
+        elif not all(value.isdigit() for value in values):
+            raise ValueError(f'"{facet}" must be an id.')
+        filters[facet] = sorted(set(values))
+    return filters
+
+
+def matching(filters):
+    """Ids of the doctors with one of the given values in every facet of ``filters``, as a subquery."""
+    doctors = None
+    for facet, values in sorted(filters.items()):
+        rows = DoctorFacet.objects.filter(facet=facet, value__in=values)
+        if doctors is not None:
+            rows = rows.filter(doctor_id__in=doctors)
+        doctors = rows.values('doctor_id')
+    return doctors
+
+
+def profiles(filters):
+    queryset = DoctorProfile.objects.select_related('doctor').order_by(
+        F('next_available').asc(nulls_last=True), 'doctor_id')
+    if filters:
+        queryset = queryset.filter(doctor_id__in=matching(filters))
+    return queryset
+
+
+def facet_counts(filters):
+    """
+    ``{facet: {value: doctors}}``. Each facet is counted under the filters on
+    the other facets only, so the counts show what choosing another value of
+    it would return. Built with one statement, a ``UNION ALL`` of a grouped
+    select per facet that each read the unique index in order, and cached
+    until the facet rows change.
+    """
+    key = '&'.join(f'{facet}={",".join(values)}' for facet, values in sorted(filters.items()))
+    return catalog.get_or_build('directory_facets', ('directory',), lambda: _facet_counts(filters), key=key)
+
+
+def _facet_counts(filters):
+    grouped = []
+    for facet in FACETS:
+        rows = DoctorFacet.objects.filter(facet=facet)
+        others = {name: values for name, values in filters.items() if name != facet}
+        if others:
+            rows = rows.filter(doctor_id__in=matching(others))
+        grouped.append(rows.values_list('facet', 'value').annotate(doctors=Count('doctor_id')).order_by())
+    counts = {facet: {} for facet in FACETS}
+    for facet, value, doctors in grouped[0].union(*grouped[1:], all=True):
+        counts[facet][value] = doctors
+    return counts
+
+
+def _facet_values(facet, counts, names):
+    if facet == 'day':
+        return [{'value': day, 'name': day, 'count': counts[day]} for day in sorted(counts, key=WEEKDAYS.get)]
+    values = sorted(counts, key=lambda value: (names.get(value, ''), int(value)))
+    return [{'value': int(value), 'name': names.get(value), 'count': counts[value]} for value in values]
+
+
+def search(filters, limit=PAGE_SIZE, offset=0):
+    """A page of the filtered directory with its total and the facet counts, ready for JSON."""
+    queryset = profiles(filters)
+    page = list(queryset[offset:offset + limit])
+    count = offset + len(page) if len(page) < limit and (page or not offset) else queryset.count()
+    counts = facet_counts(filters)
+    names = {
+        'specialization': {str(specialization.id): specialization.name
+                           for specialization in catalog.specializations()},
+        'clinic': {str(pk): name for pk, name in catalog.clinic_names().items()},
+    }
+    return {
+        'count': count,
+        'filters': filters,
+        'doctors': [{
+            'id': profile.doctor_id,
+            'name': profile.doctor.name,
+            'specialization': profile.specialization_name or None,
+            'clinics': profile.clinic_ids,
+            'next_available': profile.next_available.isoformat() if profile.next_available else None,
+        } for profile in page],
+        'facets': {facet: _facet_values(facet, counts[facet], names.get(facet)) for facet in FACETS},
+    }
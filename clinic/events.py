@@ -0,0 +1,205 @@
+"""
+Live slot events for the booking page, as server-sent events.
+
+Once a change has committed, ``clinic.signals`` publishes ``taken`` when an
+appointment is scheduled into a slot or the slot is held, and ``released`` when
+a scheduled appointment is cancelled, moved or deleted or a hold is let go.
+``hub`` formats each event once and hands it to every subscriber watching the
+doctor; a subscriber is an ``asyncio.Queue`` read by one ``slot_events``
+response on the ASGI event loop, so an open connection costs a queue and a
+suspended coroutine rather than a thread or a page poll.
+
+The hub lives in the process: changes made by another process (a second
+server, ``manage.py run_worker``) are not pushed, and clients pick them up when
+they next check a slot. Under WSGI there is no event loop to park connections
+on, so ``slot_events`` only tells the browser to retry later.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Appointment
+
+
+HEARTBEAT_SECONDS = getattr(settings, 'CLINIC_EVENTS_HEARTBEAT_SECONDS', 15)
+# Connections are closed after this long; EventSource reconnects on its own.
+MAX_CONNECTION_SECONDS = getattr(settings, 'CLINIC_EVENTS_MAX_CONNECTION_SECONDS', 300)
+QUEUE_SIZE = getattr(settings, 'CLINIC_EVENTS_QUEUE_SIZE', 100)
+MAX_DOCTORS = 20
+RETRY_MS = 5000
+# Without an ASGI server, browsers are asked to come back this much later.
+WSGI_RETRY_MS = 10 * 60 * 1000
+
+HEARTBEAT = b': keepalive\n\n'
+RESET = b'event: reset\ndata: {}\n\n'
+
+
+class Subscription:
+
+    def __init__(self, doctor_ids, loop, size=QUEUE_SIZE):
+        self.doctor_ids = frozenset(doctor_ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        # Set when events had to be dropped; the client is told to reload instead.
+        self.lagging = False
+
+    def deliver(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.lagging = True
+
+    async def stream(self, hub):
+        """The response body: the retry interval, then events and heartbeats until the connection ages out."""
+        try:
+            yield f'retry: {RETRY_MS}\n\n'.encode()
+            deadline = self.loop.time() + MAX_CONNECTION_SECONDS
+            while (remaining := deadline - self.loop.time()) > 0:
+                try:
+                    frame = await asyncio.wait_for(self.queue.get(), min(HEARTBEAT_SECONDS, remaining))
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+                yield frame
+                if self.lagging and self.queue.empty():
+                    yield RESET
+                    return
+        finally:
+            hub.unsubscribe(self)
+
+
+def _deliver_all(subscriptions, frame):
+    for subscription in subscriptions:
+        subscription.deliver(frame)
+
+
+class SlotEventHub:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # doctor id -> set of subscriptions
+        self._ids = itertools.count(1)
+
+    def subscribe(self, doctor_ids, loop=None):
+        """Watch ``doctor_ids`` from the running event loop (or ``loop``)."""
+        subscription = Subscription(doctor_ids, loop or asyncio.get_running_loop())
+        with self._lock:
+            for doctor_id in subscription.doctor_ids:
+                self._subscriptions.setdefault(doctor_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for doctor_id in subscription.doctor_ids:
+                watchers = self._subscriptions.get(doctor_id)
+                if watchers is not None:
+                    watchers.discard(subscription)
+                    if not watchers:
+                        del self._subscriptions[doctor_id]
+
+    def watching(self, doctor_id):
+        with self._lock:
+            return doctor_id in self._subscriptions
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+    def publish(self, kind, doctor_id, data):
+        """Send ``data`` as a ``kind`` event to the subscribers watching ``doctor_id``; returns how many."""
+        with self._lock:
+            watchers = list(self._subscriptions.get(doctor_id, ()))
+        if not watchers:
+            return 0
+        frame = f'id: {next(self._ids)}\nevent: {kind}\ndata: {json.dumps(data)}\n\n'.encode()
+        by_loop = {}
+        for subscription in watchers:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        # Signals fire on request threads; queues may only be touched from their own loop.
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver_all, subscriptions, frame)
+            except RuntimeError:  # the loop has closed
+                for subscription in subscriptions:
+                    self.unsubscribe(subscription)
+        return len(watchers)
+
+
+hub = SlotEventHub()
+
+
+def _slot(doctor_id, when, **extra):
+    when = timezone.localtime(when)
+    return dict({'doctor': doctor_id, 'start': when.isoformat(), 'date': when.strftime('%Y-%m-%d'),
+                 'time': when.strftime('%H:%M')}, **extra)
+
+
+def appointment_changed(before, after):
+    """Publish the effect of an appointment going from ``before`` to ``after``, each ``(doctor, when, status)``."""
+    if before == after:
+        return
+    old_doctor, old_when, old_status = before
+    doctor_id, when, status = after
+    if old_status == 'Scheduled' and old_when is not None:
+        hub.publish('released', old_doctor, _slot(old_doctor, old_when, reason='appointment'))
+    if status == 'Scheduled':
+        hub.publish('taken', doctor_id, _slot(doctor_id, when, reason='appointment'))
+
+
+def appointment_removed(doctor_id, when, status):
+    if status == 'Scheduled':
+        hub.publish('released', doctor_id, _slot(doctor_id, when, reason='appointment'))
+
+
+def hold_placed(doctor_id, when, expires_at):
+    hub.publish('taken', doctor_id, _slot(doctor_id, when, reason='hold', until=expires_at.isoformat()))
+
+
+def hold_released(doctor_id, when):
+    if not hub.watching(doctor_id):
+        return
+    # Booking a held slot deletes the hold after scheduling the appointment; the slot stays taken.
+    if not Appointment.objects.filter(doctor_id=doctor_id, appointment_datetime=when, status='Scheduled').exists():
+        hub.publish('released', doctor_id, _slot(doctor_id, when, reason='hold'))
+
+
+def close_on_disconnect(application, prefixes):
+    """
+    ASGI middleware cancelling requests under ``prefixes`` when the client goes
+    away. Django 4.2 stops listening once it has read the request body, so a
+    closed event stream would otherwise stay subscribed until it ages out.
+    """
+    async def app(scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(tuple(prefixes)):
+            return await application(scope, receive, send)
+
+        body_read = asyncio.Event()
+
+        async def tracked_receive():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body'):
+                body_read.set()
+            return message
+
+        async def wait_for_disconnect():
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        request = asyncio.ensure_future(application(scope, tracked_receive, send))
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await asyncio.wait({request, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (request, disconnect):
+                task.cancel()
+            await asyncio.gather(request, disconnect, return_exceptions=True)
+        if request.done() and not request.cancelled() and request.exception() is not None:
+            raise request.exception()
+
+    return app
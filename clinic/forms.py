@@ -1,8 +1,10 @@
 
 
-from django.forms import ModelForm
+from django.core.exceptions import ValidationError
+from django.forms import DateInput, ModelForm, TimeInput
 from django.contrib.auth.forms import UserCreationForm as BaseUserCreationForm
-from .models import User, Clinic, Appointment, Availability
+from .models import User, Clinic, Appointment, Availability, AvailabilityException
+from . import booking
 
 # This is the new, corrected code
 class UserCreationForm(BaseUserCreationForm):
@@ -20,7 +22,7 @@ class ClinicForm(ModelForm):
     class Meta:
         model = Clinic
         
-        fields = ['specialization', 'name', 'description']
+        fields = ['specialization', 'name', 'description', 'latitude', 'longitude']
 
 class AppointmentForm(ModelForm):
     class Meta:
@@ -32,7 +34,44 @@ class AppointmentForm(ModelForm):
 
         self.fields['doctor'].queryset = User.objects.filter(role='doctor')
 
+    def clean(self):
+        cleaned_data = super().clean()
+        clinic, doctor, when = (cleaned_data.get(name) for name in ('clinic', 'doctor', 'appointment_datetime'))
+        # Other edits leave a past appointment alone; a new time, doctor or clinic must be a real slot.
+        if None not in (clinic, doctor, when) and {'clinic', 'doctor', 'appointment_datetime'} & set(self.changed_data):
+            try:
+                booking.check_slot(clinic, doctor, when)
+            except booking.InvalidSlot:
+                raise ValidationError('The doctor has no appointment starting at that time at this clinic.')
+        return cleaned_data
+
 class AvailabilityForm(ModelForm):
     class Meta:
         model = Availability
-        fields = ['day', 'start_time', 'end_time']
\ No newline at end of file
+        fields = ['day', 'start_time', 'end_time', 'clinic']
+        widgets = {'start_time': TimeInput(attrs={'type': 'time'}), 'end_time': TimeInput(attrs={'type': 'time'})}
+
+    def __init__(self, *args, doctor, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set before validation so that clean() can check for overlapping hours.
+        self.instance.doctor = doctor
+        self.fields['clinic'].queryset = doctor.clinics.all()
+        self.fields['clinic'].empty_label = 'Any of my clinics'
+
+
+class AvailabilityExceptionForm(ModelForm):
+    class Meta:
+        model = AvailabilityException
+        fields = ['date', 'available', 'start_time', 'end_time', 'clinic', 'reason']
+        labels = {'available': 'Extra hours (leave unticked for time off)'}
+        widgets = {
+            'date': DateInput(attrs={'type': 'date'}),
+            'start_time': TimeInput(attrs={'type': 'time'}),
+            'end_time': TimeInput(attrs={'type': 'time'}),
+        }
+
+    def __init__(self, *args, doctor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instance.doctor = doctor
+        self.fields['clinic'].queryset = doctor.clinics.all()
+        self.fields['clinic'].empty_label = 'All my clinics'
@@ -0,0 +1,120 @@
+"""
+Nearest-clinic search without a spatial extension.
+
+A clinic with a location stores the cell of a fixed latitude/longitude grid
+in ``Clinic.geo_cell``. Cells are numbered row by row, so the cells under a
+bounding box form one contiguous ``geo_cell`` range per grid row, which the
+``(specialization, geo_cell)`` and ``(geo_cell)`` indexes read directly.
+``nearest`` fetches the clinics in a box around the point, keeps those whose
+exact haversine distance is within the box's radius, and widens the box until
+it holds ``k`` of them or reaches the requested radius. Distances are only
+ever computed for clinics near the answer.
+"""
+
+import heapq
+import math
+
+from django.db.models import Q
+
+from .models import Clinic
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Cells are this many degrees on a side (about 11 km north to south). Stored
+# cells depend on it: after changing it, run `manage.py rebuild_geo_cells`.
+CELL_DEGREES = 0.1
+ROWS = round(180 / CELL_DEGREES)
+COLUMNS = round(360 / CELL_DEGREES)
+
+DEFAULT_RADIUS_KM = 25
+MAX_RADIUS_KM = 500
+MAX_RESULTS = 50
+# Each round searches a box this many times wider than the last.
+GROWTH = 4
+
+FIELDS = ('id', 'name', 'latitude', 'longitude', 'specialization_id')
+
+
+def _row(latitude):
+    return min(int((latitude + 90) / CELL_DEGREES), ROWS - 1)
+
+
+def _column(longitude):
+    return min(int((longitude + 180) / CELL_DEGREES), COLUMNS - 1)
+
+
+def cell(latitude, longitude):
+    """The grid cell holding a point, or ``None`` without a location."""
+    if latitude is None or longitude is None:
+        return None
+    return _row(latitude) * COLUMNS + _column(longitude)
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance in km."""
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    ``(south, north, [(west, east), ...])`` around every point within
+    ``radius_km``; the longitudes are split in two where the box crosses the
+    antimeridian and cover the whole circle when it reaches a pole.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    south, north = latitude - math.degrees(angle), latitude + math.degrees(angle)
+    if south <= -90 or north >= 90:
+        return max(south, -90.0), min(north, 90.0), [(-180.0, 180.0)]
+    # The circle's widest point is poleward of its centre: asin(sin(d) / cos(latitude)).
+    spread = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(latitude))))
+    west, east = longitude - spread, longitude + spread
+    if west < -180:
+        return south, north, [(west + 360, 180.0), (-180.0, east)]
+    if east > 180:
+        return south, north, [(west, 180.0), (-180.0, east - 360)]
+    return south, north, [(west, east)]
+
+
+def cell_ranges(south, north, spans):
+    """Merged inclusive ``geo_cell`` ranges covering the box."""
+    ranges = sorted((row * COLUMNS + _column(west), row * COLUMNS + _column(east))
+                    for row in range(_row(south), _row(north) + 1) for west, east in spans)
+    merged = [list(ranges[0])]
+    for lo, hi in ranges[1:]:
+        if lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return [tuple(pair) for pair in merged]
+
+
+def within_box(latitude, longitude, radius_km, specialization=None):
+    """Clinics in the cells under the bounding box of the circle, as ``values()`` rows."""
+    south, north, spans = bounding_box(latitude, longitude, radius_km)
+    # The specialization is repeated in every range so that SQLite searches
+    # (specialization, geo_cell) once per range instead of reading every clinic
+    # of the specialization.
+    wanted = {} if specialization is None else {'specialization_id': specialization}
+    cells = Q()
+    for lo, hi in cell_ranges(south, north, spans):
+        cells |= Q(geo_cell__range=(lo, hi), **wanted)
+    return Clinic.objects.filter(cells).order_by().values(*FIELDS)
+
+
+def nearest(latitude, longitude, k=10, radius_km=DEFAULT_RADIUS_KM, specialization=None):
+    """Up to ``k`` ``(distance_km, clinic)`` pairs within ``radius_km``, nearest first."""
+    searched = min(radius_km, CELL_DEGREES * KM_PER_DEGREE)
+    while True:
+        found = []
+        for clinic in within_box(latitude, longitude, searched, specialization):
+            distance = haversine(latitude, longitude, clinic['latitude'], clinic['longitude'])
+            if distance <= searched:
+                found.append((distance, clinic))
+        # Anything outside this circle is further away than all k found in it.
+        if len(found) >= k or searched >= radius_km:
+            return heapq.nsmallest(k, found, key=lambda pair: pair[0])
+        searched = min(searched * GROWTH, radius_km)
@@ -0,0 +1,338 @@
+"""
+Per-doctor iCalendar feeds.
+
+Calendar apps subscribe to a signed URL (see ``feed_token``) and poll it. The
+full feed is serialized once and cached until one of the doctor's
+appointments, availability rows or availability exceptions changes (see
+``clinic.signals``); its ``Last-Modified`` and ``ETag`` let unchanged polls end
+in a 304 without touching the database.
+
+A client that passes back the ``X-Sync-Token`` of an earlier response as
+``?since=`` receives only the events changed after it, plus cancelled events
+for the ones that were deleted.
+
+Availability exceptions appear as events of their own: extra hours as
+available time, blackouts as busy time. Weekly hours that an exception replaces
+or blocks for the whole day carry an ``EXDATE`` for that date; when any
+exception changes, incremental feeds resend the weekly hours with their new
+``EXDATE`` lists.
+"""
+
+import base64
+import hashlib
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Appointment, Availability, AvailabilityException, CalendarTombstone, User
+from .slots import SLOT_MINUTES
+
+
+FEED_TIMEOUT = 60 * 60
+FEED_PAST_DAYS = 90
+TOMBSTONE_DAYS = 90
+# Changes committed shortly after a poll can carry an earlier updated_at, so
+# incremental feeds repeat everything from the last few seconds before the token.
+SYNC_OVERLAP = timedelta(seconds=5)
+
+# Weekly availability repeats from a fixed week so that the serialized feed is stable.
+ANCHOR_MONDAY = date(2024, 1, 1)
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+PRODID = '-//CliQ//Doctor schedule//EN'
+_SALT = 'clinic.calendar'
+_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+class InvalidSyncToken(ValueError):
+    pass
+
+
+def feed_token(doctor_id):
+    return signing.dumps(doctor_id, salt=_SALT)
+
+
+def doctor_for_token(token):
+    try:
+        return int(signing.loads(token, salt=_SALT))
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def encode_sync_token(when):
+    return base64.urlsafe_b64encode(when.isoformat().encode()).decode()
+
+
+def decode_sync_token(token):
+    try:
+        when = parse_datetime(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise InvalidSyncToken(token)
+    if when is None or timezone.is_naive(when):
+        raise InvalidSyncToken(token)
+    return when
+
+
+def appointment_uid(appointment_id):
+    return f'appointment-{appointment_id}@cliq'
+
+
+def availability_uid(availability_id):
+    return f'availability-{availability_id}@cliq'
+
+
+def exception_uid(exception_id):
+    return f'exception-{exception_id}@cliq'
+
+
+def _feed_key(doctor_id):
+    return f'clinic:calendar:{doctor_id}'
+
+
+def invalidate(doctor_id):
+    cache.delete(_feed_key(doctor_id))
+
+
+def record_deletion(doctor_id, uid):
+    now = timezone.now()
+    CalendarTombstone.objects.filter(doctor_id=doctor_id, deleted_at__lt=now - timedelta(days=TOMBSTONE_DAYS)).delete()
+    CalendarTombstone.objects.create(doctor_id=doctor_id, uid=uid)
+
+
+def _escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Split a content line into 75-octet pieces as RFC 5545 requires."""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line
+    pieces, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1  # never split a UTF-8 sequence
+        pieces.append(encoded[start:end].decode())
+        start, limit = end, 74
+    return '\r\n '.join(pieces)
+
+
+def _utc(when):
+    return when.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _appointment_event(row):
+    pk, when, status, reason, updated_at, patient_name, patient_username, clinic_name = row
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{appointment_uid(pk)}',
+        f'DTSTAMP:{_utc(updated_at)}',
+        f'LAST-MODIFIED:{_utc(updated_at)}',
+        f'DTSTART:{_utc(when)}',
+        f'DTEND:{_utc(when + timedelta(minutes=SLOT_MINUTES))}',
+        f'SUMMARY:{_escape("Appointment with " + (patient_name or patient_username))}',
+        f'DESCRIPTION:{_escape(reason)}',
+        f'STATUS:{"CANCELLED" if status == "Cancelled" else "CONFIRMED"}',
+    ]
+    if clinic_name:
+        lines.append(f'LOCATION:{_escape(clinic_name)}')
+    lines.append('END:VEVENT')
+    return lines
+
+
+def _local(day, at):
+    return f'TZID={settings.TIME_ZONE}:{datetime.combine(day, at):%Y%m%dT%H%M%S}'
+
+
+def _skipped_dates(row, exceptions):
+    """Dates on which the weekly hours ``row`` are replaced by extra hours or blocked for the whole day."""
+    day, clinic_id = row[1], row[6]
+    return sorted({
+        on for _, on, start_time, _, available, _, _, off_clinic, _ in exceptions
+        if WEEKDAYS[on.weekday()] == day and (available or (start_time is None and off_clinic in (None, clinic_id)))
+    })
+
+
+def _availability_event(row, exceptions, exceptions_changed):
+    pk, day, start_time, end_time, updated_at, clinic_name, _ = row
+    # The EXDATE list changes with the exceptions, so they date the event too.
+    updated_at = max(updated_at, exceptions_changed)
+    first = ANCHOR_MONDAY + timedelta(days=WEEKDAYS.index(day))
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{availability_uid(pk)}',
+        f'DTSTAMP:{_utc(updated_at)}',
+        f'LAST-MODIFIED:{_utc(updated_at)}',
+        f'DTSTART;{_local(first, start_time)}',
+        f'DTEND;{_local(first, end_time)}',
+        f'RRULE:FREQ=WEEKLY;BYDAY={day[:2].upper()}',
+    ]
+    skipped = _skipped_dates(row, exceptions)
+    if skipped:
+        lines.append(f'EXDATE;TZID={settings.TIME_ZONE}:'
+                     + ','.join(f'{datetime.combine(on, start_time):%Y%m%dT%H%M%S}' for on in skipped))
+    lines += ['SUMMARY:Available for appointments', 'TRANSP:TRANSPARENT']
+    if clinic_name:
+        lines.append(f'LOCATION:{_escape(clinic_name)}')
+    lines.append('END:VEVENT')
+    return lines
+
+
+def _exception_event(row):
+    pk, on, start_time, end_time, available, reason, updated_at, _, clinic_name = row
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{exception_uid(pk)}',
+        f'DTSTAMP:{_utc(updated_at)}',
+        f'LAST-MODIFIED:{_utc(updated_at)}',
+    ]
+    if start_time is None:
+        lines += [f'DTSTART;VALUE=DATE:{on:%Y%m%d}', f'DTEND;VALUE=DATE:{on + timedelta(days=1):%Y%m%d}']
+    else:
+        lines += [f'DTSTART;{_local(on, start_time)}', f'DTEND;{_local(on, end_time)}']
+    if available:
+        lines += ['SUMMARY:Available for appointments', 'TRANSP:TRANSPARENT']
+    else:
+        lines += [f'SUMMARY:{_escape(f"Unavailable: {reason}" if reason else "Unavailable")}', 'TRANSP:OPAQUE']
+    if clinic_name:
+        lines.append(f'LOCATION:{_escape(clinic_name)}')
+    lines.append('END:VEVENT')
+    return lines
+
+
+def _cancelled_event(uid, deleted_at):
+    return [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{_utc(deleted_at)}',
+        'STATUS:CANCELLED',
+        'END:VEVENT',
+    ]
+
+
+def _serialize(calendar_name, events, sync_token):
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        'CALSCALE:GREGORIAN',
+        f'X-SYNC-TOKEN:{sync_token}',
+    ]
+    if calendar_name:
+        lines.append(f'X-WR-CALNAME:{_escape(calendar_name)}')
+    for event in events:
+        lines.extend(event)
+    lines.append('END:VCALENDAR')
+    return ''.join(_fold(line) + '\r\n' for line in lines)
+
+
+def _calendar_name(doctor_id):
+    row = User.objects.filter(pk=doctor_id, role='doctor').values_list('name', 'username').first()
+    if row is None:
+        return None
+    return f'Dr. {row[0] or row[1]} - CliQ'
+
+
+_APPOINTMENT_FIELDS = ('id', 'appointment_datetime', 'status', 'reason', 'updated_at',
+                       'patient__name', 'patient__username', 'clinic__name')
+_AVAILABILITY_FIELDS = ('id', 'day', 'start_time', 'end_time', 'updated_at', 'clinic__name', 'clinic_id')
+_EXCEPTION_FIELDS = ('id', 'date', 'start_time', 'end_time', 'available', 'reason', 'updated_at',
+                     'clinic_id', 'clinic__name')
+_EXCEPTION_DELETED = Q(uid__startswith='exception-')
+
+
+class Feed:
+    """A serialized calendar with the validators used for conditional GET."""
+
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.last_modified = last_modified
+        self.sync_token = encode_sync_token(last_modified)
+        self.etag = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+
+
+def _exceptions(doctor_id):
+    return list(AvailabilityException.objects.filter(
+        doctor_id=doctor_id, date__gte=timezone.localdate() - timedelta(days=FEED_PAST_DAYS),
+    ).order_by('date', 'id').values_list(*_EXCEPTION_FIELDS))
+
+
+def full_feed(doctor_id):
+    """The complete feed for ``doctor_id``, or ``None`` if there is no such doctor."""
+    feed = cache.get(_feed_key(doctor_id))
+    if feed is not None:
+        return feed
+
+    name = _calendar_name(doctor_id)
+    if name is None:
+        return None
+    appointments = list(
+        Appointment.objects.filter(
+            doctor_id=doctor_id,
+            appointment_datetime__gte=timezone.now() - timedelta(days=FEED_PAST_DAYS),
+        ).order_by('appointment_datetime', 'id').values_list(*_APPOINTMENT_FIELDS)
+    )
+    availability = list(Availability.objects.filter(doctor_id=doctor_id).order_by('id')
+                        .values_list(*_AVAILABILITY_FIELDS))
+    exceptions = _exceptions(doctor_id)
+    deletions = CalendarTombstone.objects.filter(doctor_id=doctor_id).aggregate(
+        last=Max('deleted_at'), exceptions=Max('deleted_at', filter=_EXCEPTION_DELETED))
+
+    exceptions_changed = max([row[6] for row in exceptions] + [deletions['exceptions'] or _EPOCH])
+    last_modified = max(
+        [row[4] for row in appointments] + [row[4] for row in availability]
+        + [exceptions_changed, deletions['last'] or _EPOCH]
+    )
+    events = [_appointment_event(row) for row in appointments]
+    events += [_availability_event(row, exceptions, exceptions_changed) for row in availability]
+    events += [_exception_event(row) for row in exceptions]
+    feed = Feed(_serialize(name, events, encode_sync_token(last_modified)), last_modified)
+    cache.set(_feed_key(doctor_id), feed, FEED_TIMEOUT)
+    return feed
+
+
+def changes_since(doctor_id, since):
+    """
+    A feed with only the events changed after ``since``. Tokens older than the
+    tombstone retention period cannot account for every deletion, so those get
+    the full feed instead.
+    """
+    if since < timezone.now() - timedelta(days=TOMBSTONE_DAYS):
+        return full_feed(doctor_id)
+
+    cached = cache.get(_feed_key(doctor_id))
+    if cached is not None and cached.last_modified <= since:
+        return Feed(_serialize(None, [], encode_sync_token(since)), since)
+
+    name = _calendar_name(doctor_id)
+    if name is None:
+        return None
+    window = since - SYNC_OVERLAP
+    appointments = list(Appointment.objects.filter(doctor_id=doctor_id, updated_at__gt=window)
+                        .order_by('updated_at', 'id').values_list(*_APPOINTMENT_FIELDS))
+    availability = list(Availability.objects.filter(doctor_id=doctor_id).order_by('id')
+                        .values_list(*_AVAILABILITY_FIELDS))
+    exceptions = _exceptions(doctor_id)
+    deletions = list(CalendarTombstone.objects.filter(doctor_id=doctor_id, deleted_at__gt=window)
+                     .order_by('deleted_at').values_list('uid', 'deleted_at'))
+
+    changed_exceptions = [row for row in exceptions if row[6] > window]
+    exceptions_changed = max([row[6] for row in changed_exceptions] + [_EPOCH] + [
+        deleted_at for uid, deleted_at in deletions if uid.startswith('exception-')])
+    if exceptions_changed == _EPOCH:
+        availability = [row for row in availability if row[4] > window]
+    # Otherwise every weekly row is resent, as its EXDATE list may have changed.
+    last_modified = max([since] + [row[4] for row in appointments] + [row[4] for row in availability]
+                        + [exceptions_changed] + [deleted_at for _, deleted_at in deletions])
+    events = [_appointment_event(row) for row in appointments]
+    events += [_availability_event(row, exceptions, exceptions_changed) for row in availability]
+    events += [_exception_event(row) for row in changed_exceptions]
+    events += [_cancelled_event(uid, deleted_at) for uid, deleted_at in deletions]
+    return Feed(_serialize(name, events, encode_sync_token(last_modified)), last_modified)
@@ -0,0 +1,80 @@
+"""
+Resized and WebP variants of user avatars.
+
+When an avatar is uploaded (or ``manage.py generate_avatar_variants`` runs),
+square copies are written at each of ``AVATAR_WIDTHS`` in WebP and in a
+fallback format (JPEG, or PNG for images with transparency). File names are
+derived from a hash of the source image, so identical uploads share files and
+browsers can cache them indefinitely. ``User.avatar_variants`` records what
+was written for the ``{% avatar %}`` template tag.
+"""
+
+import hashlib
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+logger = logging.getLogger(__name__)
+
+AVATAR_WIDTHS = getattr(settings, 'CLINIC_AVATAR_WIDTHS', (64, 128, 256))
+VARIANT_DIR = 'avatars'
+
+WEBP = ('webp', 'WEBP', {'quality': 80, 'method': 6})
+JPEG = ('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True})
+PNG = ('png', 'PNG', {'optimize': True})
+
+
+def is_vector(name):
+    return name.lower().endswith('.svg')
+
+
+def needs_variants(user):
+    name = user.avatar.name if user.avatar else ''
+    return bool(name) and not is_vector(name) and user.avatar_variants.get('source') != name
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def build_variants(field_file):
+    """Write the variants of ``field_file`` and return the record to store in ``avatar_variants``."""
+    with field_file.open('rb') as f:
+        data = f.read()
+    record = {'source': field_file.name, 'webp': [], 'fallback': []}
+    try:
+        image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    except (UnidentifiedImageError, OSError):
+        logger.warning('Cannot read avatar %s; serving it unchanged', field_file.name)
+        return record
+
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    alpha = _has_alpha(image)
+    image = image.convert('RGBA' if alpha else 'RGB')
+    smallest = min(image.size)
+    widths = [width for width in AVATAR_WIDTHS if width <= smallest] or [smallest]
+
+    storage = field_file.storage
+    for width in widths:
+        square = ImageOps.fit(image, (width, width), Image.LANCZOS)
+        for key, (ext, fmt, options) in (('webp', WEBP), ('fallback', PNG if alpha else JPEG)):
+            name = f'{VARIANT_DIR}/{digest}-{width}.{ext}'
+            if not storage.exists(name):
+                buffer = BytesIO()
+                square.save(buffer, fmt, **options)
+                name = storage.save(name, ContentFile(buffer.getvalue()))
+            record[key].append([width, name])
+    return record
+
+
+def update_variants(user, force=False):
+    """Generate variants for ``user``'s avatar if it changed since they were last built."""
+    if not (force or needs_variants(user)) or not user.avatar or is_vector(user.avatar.name):
+        return False
+    user.avatar_variants = build_variants(user.avatar)
+    type(user).objects.filter(pk=user.pk).update(avatar_variants=user.avatar_variants)
+    return True
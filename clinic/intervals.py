@@ -0,0 +1,74 @@
+"""
+Static interval trees over a doctor's working hours.
+
+An ``IntervalTree`` is built once from half-open ``(start, end, data)``
+intervals and then answers "which intervals contain this moment" and "which
+intervals overlap this range" in O(log n + k) instead of scanning every
+interval. ``clinic.slots`` keeps one per doctor, covering its booking horizon,
+and rebuilds it when the doctor's availability changes.
+"""
+
+
+class IntervalTree:
+    """
+    A balanced, augmented binary search tree stored implicitly in arrays.
+
+    The intervals are sorted by start; the subtree over ``[lo, hi)`` has its
+    root at ``(lo + hi) // 2`` and ``_max_end[root]`` holds the latest end
+    anywhere in that subtree, which lets a query skip subtrees that finish
+    before the range it is looking for.
+    """
+
+    def __init__(self, intervals=()):
+        self._intervals = sorted(intervals, key=lambda interval: (interval[0], interval[1]))
+        self._max_end = [None] * len(self._intervals)
+        if self._intervals:
+            self._augment(0, len(self._intervals))
+
+    def _augment(self, lo, hi):
+        mid = (lo + hi) // 2
+        latest = self._intervals[mid][1]
+        if lo < mid:
+            latest = max(latest, self._augment(lo, mid))
+        if mid + 1 < hi:
+            latest = max(latest, self._augment(mid + 1, hi))
+        self._max_end[mid] = latest
+        return latest
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        return iter(self._intervals)
+
+    def _collect(self, lo, hi, start, end, closed, found):
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        if self._max_end[mid] <= start:
+            return
+        self._collect(lo, mid, start, end, closed, found)
+        interval = self._intervals[mid]
+        if interval[0] < end or (closed and interval[0] == end):
+            if interval[1] > start:
+                found.append(interval)
+            self._collect(mid + 1, hi, start, end, closed, found)
+
+    def overlapping(self, start, end):
+        """Intervals sharing any time with ``[start, end)``, in start order."""
+        found = []
+        self._collect(0, len(self._intervals), start, end, False, found)
+        return found
+
+    def containing(self, point):
+        """Intervals with ``start <= point < end``, in start order."""
+        found = []
+        self._collect(0, len(self._intervals), point, point, True, found)
+        return found
+
+    def covering(self, start, end):
+        """The first interval that contains all of ``[start, end)``, or ``None``."""
+        for interval in self.containing(start):
+            if interval[1] >= end:
+                return interval
+        return None
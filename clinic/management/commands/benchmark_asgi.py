@@ -0,0 +1,149 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.test import Client
+from django.urls import reverse
+
+from clinic.models import User
+
+
+def _split(path):
+    path, _, query = path.partition('?')
+    return path, query
+
+
+def _wsgi_request(handler, path, cookie):
+    path, query = _split(path)
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'HTTP_COOKIE': cookie,
+        'wsgi.input': BytesIO(), 'wsgi.url_scheme': 'http', 'wsgi.errors': BytesIO(),
+    }
+    status = []
+    response = handler(environ, lambda s, headers, exc_info=None: status.append(int(s.split()[0])))
+    try:
+        for _ in response:
+            pass
+    finally:
+        response.close()
+    return status[0]
+
+
+async def _asgi_request(application, path, cookie):
+    path, query = _split(path)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(b'host', b'localhost'), (b'cookie', cookie.encode())],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    body_sent = False
+    status = []
+
+    async def receive():
+        nonlocal body_sent
+        if body_sent:
+            await asyncio.Future()  # the client never disconnects
+        body_sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+def _summary(name, latencies, wall, errors):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+    return (f'{name:<5} {len(latencies):>7} {wall:>8.2f} {len(latencies) / wall:>9.0f} '
+            f'{statistics.median(latencies) * 1000:>8.1f} {p95 * 1000:>8.1f} {errors:>7}')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the WSGI and ASGI handlers on the read-heavy views under concurrent clients. '
+        'Requests are dispatched in-process: WSGI through a fixed pool of worker threads, '
+        'ASGI with every client as a task on one event loop.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per handler.')
+        parser.add_argument('--threads', type=int, default=4, help='WSGI worker threads.')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='URL to request (repeatable); defaults to the async read views.')
+        parser.add_argument('--email', help='User to log in as; defaults to the first active doctor.')
+
+    def handle(self, *args, clients, requests, threads, paths, email, **options):
+        users = User.objects.filter(is_active=True)
+        user = users.filter(email=email).first() if email else users.filter(role='doctor').first()
+        if user is None:
+            raise CommandError('No user to log in as; create a doctor or pass --email.')
+        client = Client()
+        client.force_login(user)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+        if not paths:
+            dashboard = 'doctor_dashboard' if user.role == 'doctor' else 'patient_dashboard'
+            doctor = user if user.role == 'doctor' else User.objects.filter(role='doctor').first()
+            paths = [reverse('doctor_list'), reverse(dashboard), reverse('free_slots') + '?limit=20']
+            if doctor is not None:
+                paths.append(reverse('doctor_availability', args=[doctor.id]))
+        schedule = [paths[i % len(paths)] for i in range(requests)]
+
+        self.stdout.write(f'{len(paths)} paths, {clients} clients, {threads} WSGI threads, as {user.email}')
+        self.stdout.write(f'{"":<5} {"requests":>7} {"wall s":>8} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"errors":>7}')
+        self.stdout.write(self.run_wsgi(schedule, cookie, clients, threads))
+        self.stdout.write(self.run_asgi(schedule, cookie, clients))
+
+    def run_wsgi(self, schedule, cookie, clients, threads):
+        handler = get_wsgi_application()
+        _wsgi_request(handler, schedule[0], cookie)  # warm up caches and the slot index
+        workers = threading.Semaphore(threads)
+        latencies, errors = [], 0
+
+        def client(paths):
+            nonlocal errors
+            for path in paths:
+                start = time.perf_counter()
+                with workers:
+                    status = _wsgi_request(handler, path, cookie)
+                latencies.append(time.perf_counter() - start)
+                errors += status >= 400
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            list(pool.map(client, [schedule[i::clients] for i in range(clients)]))
+        return _summary('wsgi', latencies, time.perf_counter() - start, errors)
+
+    def run_asgi(self, schedule, cookie, clients):
+        application = get_asgi_application()
+        latencies, errors = [], 0
+
+        async def client(paths):
+            nonlocal errors
+            for path in paths:
+                start = time.perf_counter()
+                status = await _asgi_request(application, path, cookie)
+                latencies.append(time.perf_counter() - start)
+                errors += status >= 400
+
+        async def main():
+            await _asgi_request(application, schedule[0], cookie)
+            start = time.perf_counter()
+            await asyncio.gather(*(client(schedule[i::clients]) for i in range(clients)))
+            return time.perf_counter() - start
+
+        wall = asyncio.run(main())
+        return _summary('asgi', latencies, wall, errors)
@@ -0,0 +1,80 @@
+import heapq
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from clinic import geo
+from clinic.models import Clinic, Specialization, User
+
+
+# Roughly the size of a large country, so the grid cells are unevenly filled.
+REGION = ((36.0, 60.0), (-10.0, 30.0))
+
+
+def _naive(latitude, longitude, k, radius_km, specialization):
+    """The distance to every clinic of the specialization, for comparison."""
+    found = []
+    for clinic in Clinic.objects.filter(specialization_id=specialization, latitude__isnull=False).values(*geo.FIELDS):
+        distance = geo.haversine(latitude, longitude, clinic['latitude'], clinic['longitude'])
+        if distance <= radius_km:
+            found.append((distance, clinic))
+    return heapq.nsmallest(k, found, key=lambda pair: pair[0])
+
+
+def _ms(times, q):
+    return statistics.quantiles(times, n=100)[q - 1] * 1000 if len(times) > 1 else times[0] * 1000
+
+
+class Command(BaseCommand):
+    help = ('Time "k nearest clinics of a specialization within a radius" through the grid index against '
+            'computing the distance to every clinic, on generated clinics that are rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clinics', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('-k', type=int, default=10)
+        parser.add_argument('--radius', type=float, default=geo.DEFAULT_RADIUS_KM)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, clinics, queries, k, radius, seed, **options):
+        host = User.objects.filter(role='doctor').first()
+        if host is None:
+            raise CommandError('There are no doctors to host the clinics; run seed_data first.')
+        rng = random.Random(seed)
+        with transaction.atomic():
+            specializations = list(Specialization.objects.values_list('id', flat=True))
+            if not specializations:
+                specializations = [Specialization.objects.create(name=f'Benchmark {i}').id for i in range(16)]
+            self.stdout.write(f'Creating {clinics} clinics across {len(specializations)} specializations...')
+            rows = []
+            for i in range(clinics):
+                latitude, longitude = rng.uniform(*REGION[0]), rng.uniform(*REGION[1])
+                rows.append(Clinic(name=f'Benchmark clinic {i}', host=host, specialization_id=rng.choice(specializations),
+                                   latitude=latitude, longitude=longitude, geo_cell=geo.cell(latitude, longitude)))
+            Clinic.objects.bulk_create(rows, batch_size=5000)
+
+            points = [(rng.uniform(*REGION[0]), rng.uniform(*REGION[1]), rng.choice(specializations))
+                      for _ in range(queries)]
+            results = {}
+            for name, search in (('grid', geo.nearest), ('naive', _naive)):
+                times, found = [], []
+                for latitude, longitude, specialization in points:
+                    start = time.perf_counter()
+                    found.append(search(latitude, longitude, k, radius, specialization))
+                    times.append(time.perf_counter() - start)
+                results[name] = times, found
+            transaction.set_rollback(True)
+
+        grid, naive = results['grid'], results['naive']
+        mismatches = sum([c['id'] for _, c in a] != [c['id'] for _, c in b] for a, b in zip(grid[1], naive[1]))
+        self.stdout.write(f'{queries} queries, k={k}, radius {radius:g} km, '
+                          f'{statistics.mean(len(found) for found in grid[1]):.1f} results on average')
+        self.stdout.write(f'{"":<6} {"p50":>9} {"p95":>9}')
+        for name, (times, _) in results.items():
+            self.stdout.write(f'{name:<6} {_ms(times, 50):>7.2f}ms {_ms(times, 95):>7.2f}ms')
+        self.stdout.write(f'speedup {statistics.median(naive[0]) / statistics.median(grid[0]):.1f}x at the median')
+        if mismatches:
+            raise CommandError(f'{mismatches} searches returned different clinics.')
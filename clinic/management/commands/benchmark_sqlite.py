@@ -0,0 +1,119 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from clinic import db
+
+
+# SQLite's defaults, with the same busy timeout so that only journaling differs.
+BASELINE_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000}
+
+SCHEMA = '''
+CREATE TABLE appointment (
+    id INTEGER PRIMARY KEY,
+    doctor_id INTEGER NOT NULL,
+    patient_id INTEGER NOT NULL,
+    starts_at REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX appointment_doctor_starts ON appointment (doctor_id, starts_at);
+'''
+
+DOCTORS = 50
+
+
+def _p95(samples):
+    samples = sorted(samples)
+    return samples[int(len(samples) * 0.95) - 1] * 1000 if samples else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        'Concurrent read/write benchmark of SQLite with its default rollback journal against the '
+        'tuned settings in clinic.db.SQLITE_PRAGMAS, on a scratch database shaped like the appointments table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--rows', type=int, default=50000)
+
+    def handle(self, *args, seconds, readers, writers, rows, **options):
+        self.stdout.write(f'{readers} readers, {writers} writers, {seconds:g}s per run, {rows} rows')
+        self.stdout.write(f'{"":<9} {"reads/s":>9} {"writes/s":>9} {"read p95":>9} {"write p95":>10} {"busy":>6}')
+        for name, pragmas in (('baseline', BASELINE_PRAGMAS), ('tuned', db.SQLITE_PRAGMAS)):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'bench.sqlite3')
+                self.seed(path, pragmas, rows)
+                self.stdout.write(self.run(name, path, pragmas, seconds, readers, writers))
+
+    def connect(self, path, pragmas):
+        connection = sqlite3.connect(path, timeout=pragmas.get('busy_timeout', 5000) / 1000,
+                                     isolation_level=None, check_same_thread=False)
+        db.apply_pragmas(connection, pragmas)
+        return connection
+
+    def seed(self, path, pragmas, rows):
+        connection = self.connect(path, pragmas)
+        connection.executescript(SCHEMA)
+        now = time.time()
+        connection.execute('BEGIN')
+        connection.executemany(
+            'INSERT INTO appointment (doctor_id, patient_id, starts_at, status) VALUES (?, ?, ?, ?)',
+            ((i % DOCTORS, i, now + i * 60, 'Scheduled') for i in range(rows)))
+        connection.execute('COMMIT')
+        connection.close()
+
+    def run(self, name, path, pragmas, seconds, readers, writers):
+        deadline = time.perf_counter() + seconds
+        read_times, write_times, busy = [], [], [0]
+
+        def reader():
+            connection = self.connect(path, pragmas)
+            rng = random.Random()
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    connection.execute(
+                        'SELECT id, patient_id, starts_at FROM appointment WHERE doctor_id = ? AND starts_at >= ? '
+                        'ORDER BY starts_at LIMIT 20', (rng.randrange(DOCTORS), time.time())).fetchall()
+                except sqlite3.OperationalError:
+                    busy[0] += 1
+                    continue
+                read_times.append(time.perf_counter() - start)
+            connection.close()
+
+        def writer():
+            connection = self.connect(path, pragmas)
+            rng = random.Random()
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    connection.execute('BEGIN IMMEDIATE')
+                    connection.execute(
+                        'INSERT INTO appointment (doctor_id, patient_id, starts_at, status) VALUES (?, ?, ?, ?)',
+                        (rng.randrange(DOCTORS), rng.randrange(10000), time.time() + rng.random() * 1e6, 'Scheduled'))
+                    connection.execute('COMMIT')
+                except sqlite3.OperationalError:
+                    busy[0] += 1
+                    if connection.in_transaction:
+                        connection.execute('ROLLBACK')
+                    continue
+                write_times.append(time.perf_counter() - start)
+            connection.close()
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        threads += [threading.Thread(target=writer) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return (f'{name:<9} {len(read_times) / seconds:>9.0f} {len(write_times) / seconds:>9.0f} '
+                f'{_p95(read_times):>7.2f}ms {_p95(write_times):>8.2f}ms {busy[0]:>6}')
@@ -0,0 +1,228 @@
+import gc
+import json
+import time
+import tracemalloc
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from clinic import ical, urls
+from clinic.models import Appointment, Clinic, Specialization, User
+from clinic.querybudget import record_queries
+from clinic.slots import slot_index
+
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'clinic' / 'benchmarks' / 'views.json'
+
+# Regressions smaller than these are treated as noise whatever the ratio.
+MIN_LATENCY_DELTA = 0.002
+MIN_MEMORY_DELTA = 256 * 1024
+
+
+def _percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def _fixtures():
+    """Users and objects the routes are requested with, taken from the current database."""
+    # A doctor who hosts a clinic, so that the clinic editing pages render instead of redirecting.
+    appointment = (Appointment.objects.filter(status='Scheduled', doctor__in=Clinic.objects.values('host'))
+                   .order_by('-appointment_datetime').first()
+                   or Appointment.objects.filter(status='Scheduled').order_by('-appointment_datetime').first())
+    if appointment is None:
+        raise CommandError('No scheduled appointments to benchmark with; run `manage.py seed_data` first.')
+    doctor, patient = appointment.doctor, appointment.patient
+    clinic = Clinic.objects.filter(host=doctor).first() or appointment.clinic
+    staff = User.objects.filter(is_staff=True, is_active=True).first()
+    # Only free slots of the doctor's hours can be held.
+    free = slot_index.free_slots(doctor=doctor.id, limit=1)
+    hold_at = timezone.localtime(free[0][0]) if free else timezone.localtime() + timedelta(days=1)
+    return {
+        'doctor': doctor, 'patient': patient, 'staff': staff or doctor, 'clinic': clinic,
+        'appointment': appointment, 'specialization': Specialization.objects.first(), 'hold_at': hold_at,
+    }
+
+
+def _client():
+    # The test runner allows only "testserver", DEBUG with no ALLOWED_HOSTS only localhost.
+    allowed = settings.ALLOWED_HOSTS
+    if 'testserver' in allowed:
+        host = 'testserver'
+    elif allowed and allowed[0] != '*' and not allowed[0].startswith('.'):
+        host = allowed[0]
+    else:
+        host = 'localhost'
+    return Client(HTTP_HOST=host)
+
+
+def route_requests(f):
+    """``{url name: (user role, url args, method, data)}`` for every route in clinic/urls.py."""
+    return {
+        'login': (None, (), 'get', None),
+        'logout': ('patient', (), 'get', None),
+        'register': (None, (), 'get', None),
+        'home': (None, (), 'get', None),
+        'search': (None, (), 'get', {'q': f['clinic'].name.split()[0]}),
+        'clinic': (None, (f['clinic'].id,), 'get', None),
+        'nearby_clinics': (None, (), 'get', {'lat': f['clinic'].latitude or 0, 'lng': f['clinic'].longitude or 0,
+                                             'specialization': f['clinic'].specialization_id or ''}),
+        'clinic_analytics': ('doctor', (f['clinic'].id,), 'get', None),
+        'user-profile': (None, (f['doctor'].id,), 'get', None),
+        'create-clinic': ('doctor', (), 'get', None),
+        'update-clinic': ('doctor', (f['clinic'].id,), 'get', None),
+        'delete-clinic': ('doctor', (f['clinic'].id,), 'get', None),
+        'doctor_dashboard': ('doctor', (), 'get', None),
+        'patient_dashboard': ('patient', (), 'get', None),
+        'book_appointment': ('patient', (), 'get', None),
+        'patient_appointments': ('patient', (), 'get', None),
+        'patient_settings': ('patient', (), 'get', None),
+        'doctor_appointments': ('doctor', (), 'get', None),
+        'doctor_settings': ('doctor', (), 'get', None),
+        'appointments_more': ('doctor', (), 'get', None),
+        'update-appointment': ('patient', (f['appointment'].id,), 'get', None),
+        'delete-appointment': ('patient', (f['appointment'].id,), 'get', None),
+        'update-user': ('patient', (), 'get', None),
+        'doctor_list': ('patient', (), 'get', None),
+        'doctor_availability': ('patient', (f['doctor'].id,), 'get', None),
+        'doctor_directory': ('patient', (), 'get', {'clinic': f['clinic'].id, 'day': 'Monday'}),
+        'set_availability': ('doctor', (), 'get', None),
+        'free_slots': ('patient', (), 'get', {'specialization': f['specialization'].id} if f['specialization'] else {}),
+        'slot_events': ('patient', (), 'get', {'doctor': f['doctor'].id}),
+        'hold_slot': ('patient', (), 'post', {
+            'doctor': f['doctor'].id, 'appointment_date': f['hold_at'].strftime('%Y-%m-%d'),
+            'appointment_time': f['hold_at'].strftime('%H:%M'),
+        }),
+        'export': ('doctor', ('appointment',), 'get', None),
+        'doctor_calendar': (None, (ical.feed_token(f['doctor'].id),), 'get', None),
+        'cache_stats': ('staff', (), 'get', None),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Request every named route in clinic/urls.py through the test client and report latency percentiles, '
+        'query counts and peak Python memory per route. Compares the results with a stored baseline and '
+        'exits with an error when a route got slower, runs more queries or allocates more memory. Run it '
+        'against a database filled by `manage.py seed_data` (see CLINIC_DB).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Timed requests per route.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per route first.')
+        parser.add_argument('--route', action='append', dest='routes', help='Only these url names (repeatable).')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE))
+        parser.add_argument('--save-baseline', action='store_true', help='Store these results as the baseline.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed relative growth of median latency and peak memory; p95 may grow twice as much.')
+
+    def handle(self, *args, iterations, warmup, routes, baseline, save_baseline, tolerance, **options):
+        fixtures = _fixtures()
+        requests = route_requests(fixtures)
+        missing = {pattern.name for pattern in urls.urlpatterns} - set(requests)
+        if missing:
+            raise CommandError(f'No benchmark request defined for: {", ".join(sorted(missing))}')
+        names = routes or sorted(requests)
+
+        self.stdout.write(f'{"route":<22} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8} {"peak KiB":>9} {"status":>6}')
+        results = {}
+        for name in names:
+            role, args, method, data = requests[name]
+            results[name] = self.measure(fixtures.get(role), reverse(name, args=args), method, data,
+                                         iterations, warmup)
+            r = results[name]
+            self.stdout.write(f'{name:<22} {r["p50"] * 1000:>8.2f} {r["p95"] * 1000:>8.2f} {r["p99"] * 1000:>8.2f} '
+                              f'{r["queries"]:>8} {r["peak_memory"] / 1024:>9.0f} {r["status"]:>6}')
+
+        path = Path(baseline)
+        if save_baseline:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Baseline written to {path}.'))
+            return
+        if not path.exists():
+            self.stdout.write(f'No baseline at {path}; run with --save-baseline to create one.')
+            return
+
+        regressions = compare(json.loads(path.read_text()), results, tolerance)
+        for line in regressions:
+            self.stderr.write(line)
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions against {path}.')
+        self.stdout.write(self.style.SUCCESS(f'No regressions against {path}.'))
+
+    def measure(self, user, url, method, data, iterations, warmup):
+        client = _client()
+
+        def request():
+            if user is not None and not client.session.get('_auth_user_id'):
+                client.force_login(user)  # again after logout; not part of the timed request
+            with record_queries() as recorder:
+                start = time.perf_counter()
+                response = getattr(client, method)(url, data)
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+                elapsed = time.perf_counter() - start
+            statuses.add(response.status_code)
+            return elapsed, recorder.count
+
+        statuses = set()
+
+        for _ in range(warmup):
+            request()
+
+        # Collections triggered by earlier routes' garbage would land on random requests.
+        latencies, queries = [], 0
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(iterations):
+                elapsed, count = request()
+                latencies.append(elapsed)
+                queries = max(queries, count)
+        finally:
+            gc.enable()
+
+        # Tracing slows requests down a lot, so memory gets its own untimed request.
+        tracemalloc.start()
+        try:
+            request()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'p50': round(_percentile(latencies, 0.50), 6), 'p95': round(_percentile(latencies, 0.95), 6),
+            'p99': round(_percentile(latencies, 0.99), 6), 'queries': queries, 'peak_memory': peak_memory,
+            'status': max(statuses),
+        }
+
+
+def compare(baseline, results, tolerance):
+    """Human-readable descriptions of every metric in ``results`` that is worse than in ``baseline``."""
+    regressions = []
+    for name, current in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if current['status'] >= 400 and current['status'] != before.get('status'):
+            regressions.append(f'{name}: status {current["status"]}, baseline {before.get("status")}')
+        if current['queries'] > before['queries']:
+            regressions.append(f'{name}: {current["queries"]} queries, baseline {before["queries"]}')
+        # Tail latency is noisier than the median, so it gets twice the slack.
+        for metric, slack in (('p50', tolerance), ('p95', tolerance * 2)):
+            if (current[metric] > before[metric] * (1 + slack)
+                    and current[metric] - before[metric] > MIN_LATENCY_DELTA):
+                regressions.append(f'{name}: {metric} {current[metric] * 1000:.2f} ms, '
+                                   f'baseline {before[metric] * 1000:.2f} ms')
+        if (current['peak_memory'] > before['peak_memory'] * (1 + tolerance)
+                and current['peak_memory'] - before['peak_memory'] > MIN_MEMORY_DELTA):
+            regressions.append(f'{name}: peak memory {current["peak_memory"] / 1024:.0f} KiB, '
+                               f'baseline {before["peak_memory"] / 1024:.0f} KiB')
+    return regressions
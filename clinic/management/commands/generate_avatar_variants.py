@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from clinic import catalog, images
+from clinic.models import User
+
+
+class Command(BaseCommand):
+    help = 'Write resized and WebP variants for existing avatars that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Rebuild variants that already exist.')
+
+    def handle(self, *args, force, **options):
+        updated = 0
+        for user in User.objects.exclude(avatar='').exclude(avatar__isnull=True).only('id', 'avatar', 'avatar_variants').iterator():
+            if images.update_variants(user, force=force):
+                updated += 1
+                self.stdout.write(f'{user.avatar.name}: {len(user.avatar_variants["webp"])} sizes')
+        if updated:
+            # update() skips the signals that invalidate cached doctor lists.
+            catalog.bump('doctors')
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} avatars.'))
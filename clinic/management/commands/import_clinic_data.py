@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from clinic import bulk, catalog, directory, stats
+from clinic.slots import slot_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream doctors, patients, availability and appointments from a CSV or JSONL file '
+        'into the database in batches. Use "-" to read from stdin.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=bulk.FORMATS,
+                            help='Input format; guessed from the file extension when omitted.')
+        parser.add_argument('--type', choices=bulk.KINDS, dest='kind',
+                            help='Record type for CSV files without a "type" column.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--strict', action='store_true',
+                            help='Fail instead of skipping rows that already exist.')
+
+    def handle(self, *args, path, format, kind, batch_size, strict, **options):
+        fmt = format or ('csv' if path.endswith('.csv') else 'jsonl')
+        importer = bulk.Importer(batch_size=batch_size, ignore_conflicts=not strict)
+
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except FileNotFoundError:
+            raise CommandError(f'No such file: {path}')
+        try:
+            for line_number, record_kind, record in bulk.read_records(stream, fmt, kind):
+                importer.add(line_number, record_kind, record)
+            importer.finish()
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        # bulk_create skips the signal handlers that keep the dashboard counters, the directory,
+        # the cached catalog and the slot index current.
+        for doctor_id in importer.doctor_ids:
+            stats.refresh(doctor_id)
+        directory.refresh(importer.doctor_ids)
+        for entity in ('doctors', 'availability', 'clinics'):
+            catalog.bump(entity)
+        slot_index.reset()
+
+        for line_number, message in importer.errors:
+            self.stderr.write(f'line {line_number}: {message}')
+        summary = ', '.join(f'{n} {record_kind}' for record_kind, n in importer.accepted.items() if n)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {summary or "nothing"}; {len(importer.errors)} rows rejected.'))
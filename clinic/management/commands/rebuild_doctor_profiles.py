@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from clinic import directory
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the doctor directory profiles and facets, e.g. after bulk imports that bypass signals.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doctor', type=int, action='append', help='Only rebuild these doctor ids.')
+
+    def handle(self, *args, **options):
+        if options['doctor']:
+            listed = directory.refresh(options['doctor'])
+        else:
+            listed = directory.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt directory profiles of {listed} doctors.'))
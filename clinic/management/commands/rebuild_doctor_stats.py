@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from clinic import stats
+from clinic.models import Appointment, User
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard counters of every doctor to fix drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doctor', type=int, action='append', help='Only rebuild these doctor ids.')
+
+    def handle(self, *args, **options):
+        doctor_ids = options['doctor']
+        if not doctor_ids:
+            doctor_ids = set(User.objects.filter(role='doctor').values_list('id', flat=True))
+            doctor_ids |= set(Appointment.objects.values_list('doctor_id', flat=True).distinct())
+
+        for doctor_id in sorted(doctor_ids):
+            stats.refresh(doctor_id)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt stats for {len(doctor_ids)} doctors.'))
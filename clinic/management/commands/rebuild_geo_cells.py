@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from clinic import geo
+from clinic.models import Clinic
+
+
+class Command(BaseCommand):
+    help = 'Recompute the grid cell of every clinic, e.g. after changing clinic.geo.CELL_DEGREES.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, batch_size, **options):
+        changed = []
+        for clinic in Clinic.objects.only('id', 'latitude', 'longitude', 'geo_cell').iterator(chunk_size=batch_size):
+            cell = geo.cell(clinic.latitude, clinic.longitude)
+            if cell != clinic.geo_cell:
+                clinic.geo_cell = cell
+                changed.append(clinic)
+        Clinic.objects.bulk_update(changed, ['geo_cell'], batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Updated the cells of {len(changed)} clinics.'))
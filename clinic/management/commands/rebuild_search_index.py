@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from clinic import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the clinic and specialization full-text search tables from scratch.'
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            self.stdout.write('Full-text search needs SQLite; nothing to rebuild.')
+            return
+        search.create_tables(search.connection)
+        search.rebuild()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt.'))
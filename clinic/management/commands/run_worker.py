@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from clinic import directory, notifications, tasks
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background tasks (emails, reminders, directory updates) on a thread pool, and periodically '
+        'queue due appointment reminders, refresh directory profiles whose next free slot has passed, requeue '
+        'tasks whose worker died and purge old finished tasks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--batch', type=int, default=20, help='Tasks claimed at a time.')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--sweep-interval', type=float, default=60.0,
+                            help='Seconds between reminder sweeps.')
+        parser.add_argument('--no-scheduler', action='store_true',
+                            help='Only run tasks; leave reminder sweeps to another worker.')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty.')
+
+    def handle(self, *args, threads, batch, poll, sweep_interval, no_scheduler, once, **options):
+        worker = tasks.worker_id()
+        self.stdout.write(f'Worker {worker} with {threads} threads.')
+        next_sweep = 0.0
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                while True:
+                    close_old_connections()
+                    if not no_scheduler and time.monotonic() >= next_sweep:
+                        self.sweep()
+                        next_sweep = time.monotonic() + sweep_interval
+                    ran = tasks.run_batch(worker, batch, executor)
+                    if ran and options['verbosity'] > 1:
+                        self.stdout.write(f'Ran {ran} tasks.')
+                    if not ran:
+                        if once:
+                            break
+                        time.sleep(poll)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
+
+    def sweep(self):
+        requeued = tasks.requeue_expired()
+        queued = notifications.schedule_reminders()
+        refreshed = directory.refresh_passed()
+        purged = tasks.purge()
+        if requeued or queued or refreshed or purged:
+            self.stdout.write(f'Requeued {requeued} expired tasks, queued {queued} reminders, '
+                              f'refreshed {refreshed} doctor profiles, purged {purged} finished tasks.')
@@ -0,0 +1,242 @@
+import random
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from clinic import catalog, directory, geo, search, stats
+from clinic.models import Appointment, Availability, Clinic, Specialization, User
+from clinic.slots import slot_index
+
+
+DOMAIN = 'seed.example'
+
+SPECIALIZATIONS = (
+    'Cardiology', 'Dermatology', 'Endocrinology', 'Gastroenterology', 'General Practice', 'Neurology',
+    'Obstetrics', 'Oncology', 'Ophthalmology', 'Orthopaedics', 'Paediatrics', 'Psychiatry', 'Pulmonology',
+    'Radiology', 'Rheumatology', 'Urology',
+)
+AREAS = (
+    'Riverside', 'Hillcrest', 'Old Town', 'Harbour', 'Northgate', 'Westfield', 'Lakeside', 'Parkview',
+    'Kingsway', 'Meadowbrook', 'Southbank', 'Elm Street',
+)
+FIRST_NAMES = (
+    'Aarav', 'Amelia', 'Chen', 'Diego', 'Fatima', 'Grace', 'Hiro', 'Isla', 'Jonas', 'Kavya', 'Liam', 'Maya',
+    'Noah', 'Olga', 'Priya', 'Rosa', 'Samir', 'Tara', 'Uma', 'Victor', 'Wei', 'Yusuf', 'Zara', 'Elena',
+)
+LAST_NAMES = (
+    'Adams', 'Banerjee', 'Costa', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Haddad', 'Ito', 'Jensen', 'Khan',
+    'Lopez', 'Mensah', 'Nakamura', 'Okafor', 'Patel', 'Rossi', 'Schmidt', 'Tanaka', 'Walsh', 'Yilmaz', 'Zhang',
+)
+REASONS = (
+    'Annual checkup', 'Follow-up visit', 'Persistent cough', 'Back pain', 'Skin rash', 'Prescription renewal',
+    'Blood test results', 'Headaches', 'Vaccination', 'Chest pain', 'Joint swelling', 'Sleep problems',
+)
+WEEKDAYS = [day for day, _ in Availability.DAY_CHOICES]
+# Clinics are spread over about 50 km around this point.
+CENTRE = (51.5, -0.12)
+SLOT_MINUTES = 30
+
+
+def _name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+
+def _slots_per_day(windows):
+    return sum(max(0, (end.hour * 60 + end.minute - start.hour * 60 - start.minute) // SLOT_MINUTES)
+               for start, end in windows)
+
+
+def _capacity(availability, first_day, days):
+    return sum(
+        _slots_per_day(availability[weekday])
+        for weekday in (WEEKDAYS[(first_day + timedelta(days=offset)).weekday()] for offset in range(days))
+        if weekday in availability
+    )
+
+
+def _slots(availability, first_day, days):
+    """Every slot start inside ``availability`` (weekday -> [(start, end)]) over ``days`` days from ``first_day``."""
+    slots = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        for hours in availability.get(WEEKDAYS[day.weekday()], ()):
+            start = timezone.make_aware(datetime.combine(day, hours[0]))
+            end = timezone.make_aware(datetime.combine(day, hours[1]))
+            while start + timedelta(minutes=SLOT_MINUTES) <= end:
+                slots.append(start)
+                start += timedelta(minutes=SLOT_MINUTES)
+    return slots
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the database with a synthetic but realistic dataset for benchmarking: clinics, doctors with '
+        'weekly availability, patients and appointments, all written with bulk inserts. Seeded users have '
+        f'@{DOMAIN} emails and can be removed again with --flush.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clinics', type=int, default=50)
+        parser.add_argument('--doctors', type=int, default=200)
+        parser.add_argument('--patients', type=int, default=20000)
+        parser.add_argument('--appointments', type=int, default=1000000)
+        parser.add_argument('--past-days', type=int, default=730, help='How far back appointments go.')
+        parser.add_argument('--future-days', type=int, default=90, help='How far ahead appointments go.')
+        parser.add_argument('--password', default='password', help='Password of every seeded user.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for repeatable datasets.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--flush', action='store_true', help='Delete previously seeded data first.')
+
+    def handle(self, *args, **options):
+        seeded = User.objects.filter(email__endswith=f'@{DOMAIN}')
+        if options['flush']:
+            with transaction.atomic():
+                self.delete_appointments(Appointment.objects.filter(Q(doctor__in=seeded) | Q(patient__in=seeded)))
+                Clinic.objects.filter(host__in=seeded).delete()
+                deleted = seeded.delete()[1].get('clinic.User', 0)
+            self.stdout.write(f'Removed {deleted} seeded users and their data.')
+        elif seeded.exists():
+            raise CommandError('The database already holds seeded data; pass --flush to replace it.')
+        if min(options['clinics'], options['doctors'], options['patients']) < 1:
+            raise CommandError('--clinics, --doctors and --patients must be at least 1.')
+
+        rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        password = make_password(options['password'])
+
+        with transaction.atomic():
+            doctors = self.create_users('doctor', options['doctors'], password, rng)
+            patients = self.create_users('patient', options['patients'], password, rng)
+            User.objects.create(username='seed_staff', email=f'staff@{DOMAIN}', name='Seed Staff',
+                                password=password, is_staff=True)
+            clinics_by_doctor = self.create_clinics(options['clinics'], doctors, rng)
+            availability = self.create_availability(doctors, rng)
+        self.stdout.write(f'{len(doctors)} doctors, {len(patients)} patients and '
+                          f'{options["clinics"]} clinics created.')
+
+        count = self.create_appointments(options['appointments'], doctors, patients, clinics_by_doctor,
+                                         availability, options['past_days'], options['future_days'], rng)
+
+        for doctor in doctors:
+            stats.refresh(doctor.id)
+        directory.rebuild()
+        search.rebuild()
+        for entity in catalog.ENTITIES:
+            catalog.bump(entity)
+        # Bulk inserts skip the signals that keep this process's slot index current.
+        slot_index.reset()
+        self.stdout.write(self.style.SUCCESS(f'Seeded {count} appointments.'))
+
+    def delete_appointments(self, appointments):
+        """
+        Delete the appointments in one statement. A plain delete would load every appointment and run its
+        signal handlers, so rows pointing at them (reminders) are deleted through the ORM first.
+        """
+        for relation in Appointment._meta.related_objects:
+            relation.related_model._base_manager.filter(**{f'{relation.field.name}__in': appointments}).delete()
+        select, params = appointments.values('pk').query.sql_with_params()
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {quote(Appointment._meta.db_table)} WHERE {quote(Appointment._meta.pk.column)} '
+                           f'IN ({select})', params)
+
+    def create_users(self, role, count, password, rng):
+        users = [
+            User(username=f'seed_{role}_{i}', email=f'{role}{i}@{DOMAIN}', name=_name(rng), role=role,
+                 password=password, bio='Seeded for benchmarks.' if role == 'doctor' else None)
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users, batch_size=self.batch_size)
+        # SQLite returns primary keys from bulk_create, other backends may not.
+        return list(User.objects.filter(email__endswith=f'@{DOMAIN}', role=role).order_by('id'))
+
+    def create_clinics(self, count, doctors, rng):
+        specializations = []
+        for name in SPECIALIZATIONS:
+            specialization, _ = Specialization.objects.get_or_create(name=name)
+            specializations.append(specialization)
+        clinics = []
+        for i in range(count):
+            latitude = round(CENTRE[0] + rng.uniform(-0.25, 0.25), 6)
+            longitude = round(CENTRE[1] + rng.uniform(-0.4, 0.4), 6)
+            clinics.append(Clinic(
+                name=f'{AREAS[i % len(AREAS)]} {specializations[i % len(specializations)].name} Clinic',
+                specialization=specializations[i % len(specializations)], host=doctors[i % len(doctors)],
+                description=f'Seeded clinic {i} offering {specializations[i % len(specializations)].name.lower()}.',
+                # bulk_create skips Clinic.save(), which sets the cell.
+                latitude=latitude, longitude=longitude, geo_cell=geo.cell(latitude, longitude)))
+        clinics = Clinic.objects.bulk_create(clinics)
+
+        # Every doctor works at one or two clinics; every clinic gets at least its host.
+        clinics_by_doctor = {doctor.id: [] for doctor in doctors}
+        for i, clinic in enumerate(clinics):
+            clinics_by_doctor[doctors[i % len(doctors)].id].append(clinic)
+        for doctor in doctors:
+            extra = rng.choice(clinics)
+            if rng.random() < 0.3 and extra not in clinics_by_doctor[doctor.id]:
+                clinics_by_doctor[doctor.id].append(extra)
+            if not clinics_by_doctor[doctor.id]:
+                clinics_by_doctor[doctor.id].append(extra)
+        Clinic.doctors.through.objects.bulk_create([
+            Clinic.doctors.through(clinic_id=clinic.id, user_id=doctor_id)
+            for doctor_id, clinics in clinics_by_doctor.items() for clinic in clinics
+        ], batch_size=self.batch_size)
+        return clinics_by_doctor
+
+    def create_availability(self, doctors, rng):
+        availability = {}
+        rows = []
+        for doctor in doctors:
+            days = WEEKDAYS[:5] if rng.random() < 0.7 else rng.sample(WEEKDAYS, rng.randint(3, 6))
+            start, end = time(rng.choice((8, 9, 10))), time(rng.choice((15, 16, 17, 18)))
+            # Most doctors take a lunch break, which splits their day in two.
+            windows = [(start, time(12)), (time(13), end)] if rng.random() < 0.6 else [(start, end)]
+            availability[doctor.id] = {day: windows for day in days}
+            rows.extend(Availability(doctor=doctor, day=day, start_time=window_start, end_time=window_end)
+                        for day in days for window_start, window_end in windows)
+        Availability.objects.bulk_create(rows, batch_size=self.batch_size)
+        return availability
+
+    def create_appointments(self, total, doctors, patients, clinics_by_doctor, availability,
+                            past_days, future_days, rng):
+        now = timezone.now()
+        first_day = timezone.localdate() - timedelta(days=past_days)
+        days = past_days + future_days
+        # Busier schedules get proportionally more appointments.
+        capacity = [_capacity(availability[doctor.id], first_day, days) for doctor in doctors]
+        if total > sum(capacity):
+            raise CommandError(f'The doctors only have {sum(capacity)} slots for {total} appointments; '
+                               'raise --doctors or --past-days.')
+        wanted = [total * c // sum(capacity) for c in capacity]
+        for index in range(total - sum(wanted)):
+            wanted[index] += 1
+        batch, created = [], 0
+        for index, doctor in enumerate(doctors):
+            slots = _slots(availability[doctor.id], first_day, days)
+            clinics = clinics_by_doctor[doctor.id]
+            for when in rng.sample(slots, min(wanted[index], len(slots))):
+                if when < now:
+                    status = 'Completed' if rng.random() < 0.85 else 'Cancelled'
+                else:
+                    status = 'Scheduled' if rng.random() < 0.85 else 'Cancelled'
+                clinic = rng.choice(clinics)
+                batch.append(Appointment(
+                    doctor_id=doctor.id, patient_id=rng.choice(patients).id, clinic_id=clinic.id,
+                    Specialization_id=clinic.specialization_id, appointment_datetime=when,
+                    reason=rng.choice(REASONS), status=status,
+                ))
+                if len(batch) >= self.batch_size:
+                    created += self.flush_appointments(batch)
+                    batch = []
+            if index % 20 == 19:
+                self.stdout.write(f'  {created} appointments written')
+        return created + self.flush_appointments(batch)
+
+    def flush_appointments(self, batch):
+        with transaction.atomic():
+            Appointment.objects.bulk_create(batch)
+        return len(batch)
@@ -0,0 +1,39 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from clinic import db
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the primary SQLite database into the read replica with the online backup API. '
+        'Run it periodically (e.g. from cron); readers of the replica wait on busy_timeout while a copy is written.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and sync every INTERVAL seconds.')
+
+    def handle(self, *args, interval, **options):
+        if not db.replica_configured():
+            raise CommandError('No replica database configured; set CLINIC_REPLICA_DB.')
+        while True:
+            start = time.perf_counter()
+            self.sync()
+            self.stdout.write(f'Replica synced in {(time.perf_counter() - start) * 1000:.0f} ms')
+            if not interval:
+                break
+            time.sleep(interval)
+
+    def sync(self):
+        source = sqlite3.connect(connections[db.PRIMARY].settings_dict['NAME'])
+        target = sqlite3.connect(connections[db.REPLICA].settings_dict['NAME'])
+        try:
+            db.apply_pragmas(target, {'busy_timeout': db.SQLITE_PRAGMAS.get('busy_timeout', 5000)})
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
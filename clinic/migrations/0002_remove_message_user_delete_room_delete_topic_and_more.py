@@ -1,26 +0,0 @@
-# Generated by Django 5.2.4 on 2025-08-04 13:23
-
-from django.db import migrations
-
-
-class Migration(migrations.Migration):
-
-    dependencies = [
-        ('clinic', '0001_initial'),
-    ]
-
-    operations = [
-        migrations.RemoveField(
-            model_name='message',
-            name='user',
-        ),
-        migrations.DeleteModel(
-            name='Room',
-        ),
-        migrations.DeleteModel(
-            name='Topic',
-        ),
-        migrations.DeleteModel(
-            name='Message',
-        ),
-    ]
@@ -1,63 +0,0 @@
-# Generated by Django 5.2.4 on 2025-08-04 16:26
-
-import django.db.models.deletion
-from django.conf import settings
-from django.db import migrations, models
-
-
-class Migration(migrations.Migration):
-
-    dependencies = [
-        ('clinic', '0002_remove_message_user_delete_room_delete_topic_and_more'),
-    ]
-
-    operations = [
-        migrations.AlterModelOptions(
-            name='appointment',
-            options={'ordering': ['-appointment_date', '-appointment_time']},
-        ),
-        migrations.RenameField(
-            model_name='appointment',
-            old_name='created',
-            new_name='created_at',
-        ),
-        migrations.RenameField(
-            model_name='appointment',
-            old_name='updated',
-            new_name='updated_at',
-        ),
-        migrations.RemoveField(
-            model_name='appointment',
-            name='clinic',
-        ),
-        migrations.RemoveField(
-            model_name='appointment',
-            name='description',
-        ),
-        migrations.AddField(
-            model_name='appointment',
-            name='is_confirmed',
-            field=models.BooleanField(default=False),
-        ),
-        migrations.AddField(
-            model_name='appointment',
-            name='reason',
-            field=models.TextField(default='', max_length=500),
-            preserve_default=False,
-        ),
-        migrations.AddField(
-            model_name='appointment',
-            name='specialization',
-            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='clinic.specialization'),
-        ),
-        migrations.AlterField(
-            model_name='appointment',
-            name='doctor',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointments_as_doctor', to=settings.AUTH_USER_MODEL),
-        ),
-        migrations.AlterField(
-            model_name='appointment',
-            name='patient',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointments_as_patient', to=settings.AUTH_USER_MODEL),
-        ),
-    ]
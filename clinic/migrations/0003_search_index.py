@@ -0,0 +1,29 @@
+# Generated by Django 4.2.13 on 2026-10-18 10:00
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from clinic import search
+
+    if search.enabled(schema_editor.connection):
+        search.create_tables(schema_editor.connection)
+        search.rebuild(schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    from clinic import search
+
+    if search.enabled(schema_editor.connection):
+        search.drop_tables(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0002_slothold'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
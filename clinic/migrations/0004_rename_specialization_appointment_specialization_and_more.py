@@ -1,41 +0,0 @@
-# Generated by Django 5.2.4 on 2025-08-05 18:25
-
-import django.db.models.deletion
-from django.conf import settings
-from django.db import migrations, models
-
-
-class Migration(migrations.Migration):
-
-    dependencies = [
-        ('clinic', '0003_alter_appointment_options_and_more'),
-    ]
-
-    operations = [
-        migrations.RenameField(
-            model_name='appointment',
-            old_name='specialization',
-            new_name='Specialization',
-        ),
-        migrations.AddField(
-            model_name='appointment',
-            name='clinic',
-            field=models.ForeignKey(default='', on_delete=django.db.models.deletion.CASCADE, to='clinic.clinic'),
-            preserve_default=False,
-        ),
-        migrations.AddField(
-            model_name='appointment',
-            name='description',
-            field=models.TextField(blank=True, null=True),
-        ),
-        migrations.AlterField(
-            model_name='appointment',
-            name='doctor',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='doctor_appointments', to=settings.AUTH_USER_MODEL),
-        ),
-        migrations.AlterField(
-            model_name='appointment',
-            name='patient',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointments', to=settings.AUTH_USER_MODEL),
-        ),
-    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0009_availability_exceptions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['clinic', 'appointment_datetime'], name='appointment_clinic_time_idx'),
+        ),
+    ]
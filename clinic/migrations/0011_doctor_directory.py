@@ -0,0 +1,42 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0010_clinic_analytics_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('specialization_name', models.CharField(blank=True, max_length=200)),
+                ('clinic_ids', models.JSONField(blank=True, default=list)),
+                ('next_available', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profile', to=settings.AUTH_USER_MODEL)),
+                ('specialization', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='clinic.specialization')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['next_available'], name='profile_next_available_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DoctorFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('specialization', 'Specialization'), ('clinic', 'Clinic'), ('day', 'Availability day')], max_length=20)),
+                ('value', models.CharField(max_length=20)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('facet', 'value', 'doctor')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:29
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0011_doctor_directory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinic',
+            name='geo_cell',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='clinic',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AddField(
+            model_name='clinic',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.AddIndex(
+            model_name='clinic',
+            index=models.Index(fields=['specialization', 'geo_cell'], name='clinic_specialization_cell_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clinic',
+            index=models.Index(fields=['geo_cell'], name='clinic_cell_idx'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
@@ -11,10 +13,15 @@ class User(AbstractUser):
     email = models.EmailField(unique=True, null=True)
     bio = models.TextField(null=True, blank=True)
     avatar = models.ImageField(null=True, default="avatar.svg")
+    # Resized copies of ``avatar`` written by clinic.images; see the {% avatar %} template tag.
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
+    class Meta(AbstractUser.Meta):
+        indexes = [models.Index(fields=['role', 'is_active'], name='user_role_active_idx')]
+
 
 class Specialization(models.Model):
     name = models.CharField(max_length=200)
@@ -29,11 +36,31 @@ class Clinic(models.Model):
     specialization = models.ForeignKey(Specialization, on_delete=models.SET_NULL, null=True)
     description = models.TextField(null=True, blank=True)
     doctors = models.ManyToManyField(User, related_name='clinics', blank=True)
+    latitude = models.FloatField(null=True, blank=True,
+                                 validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(null=True, blank=True,
+                                  validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # Cell of the location in the grid of clinic.geo, kept in step by save().
+    geo_cell = models.IntegerField(null=True, blank=True, editable=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-updated', '-created']
+        indexes = [
+            models.Index(fields=['updated', 'created'], name='clinic_updated_idx'),
+            models.Index(fields=['specialization', 'geo_cell'], name='clinic_specialization_cell_idx'),
+            models.Index(fields=['geo_cell'], name='clinic_cell_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        from .geo import cell
+
+        self.geo_cell = cell(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geo_cell'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -50,17 +77,72 @@ class Availability(models.Model):
         ('Sunday', 'Sunday'),
     )
     doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='availability')
+    # Blank means the hours are not tied to one of the doctor's clinics.
+    clinic = models.ForeignKey(Clinic, on_delete=models.CASCADE, null=True, blank=True, related_name='availability')
     day = models.CharField(max_length=10, choices=DAY_CHOICES)
     start_time = models.TimeField()
     end_time = models.TimeField()
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        unique_together = ('doctor', 'day',)
+        # A day may hold several windows (split shifts, lunch breaks); unique_together
+        # also indexes (doctor, day, start_time) for the overlap check in clean().
+        unique_together = ('doctor', 'day', 'start_time')
+        indexes = [models.Index(fields=['doctor', 'updated_at'], name='availability_changed_idx')]
+
+    def clean(self):
+        if self.start_time is None or self.end_time is None:
+            return
+        if self.start_time >= self.end_time:
+            raise ValidationError('The start time must be before the end time.')
+        if self.doctor_id is not None and Availability.objects.filter(
+                doctor_id=self.doctor_id, day=self.day, start_time__lt=self.end_time,
+                end_time__gt=self.start_time).exclude(pk=self.pk).exists():
+            raise ValidationError(f'These hours overlap hours already set for {self.day}.')
 
     def __str__(self):
         return f"Dr. {self.doctor.name}'s availability on {self.day}"
 
 
+class AvailabilityException(models.Model):
+    """
+    A change to a doctor's weekly hours on one date. Available exceptions are
+    extra or replacement hours: on a date that has any, they are worked instead
+    of that weekday's regular hours. Unavailable ones are blackouts that remove
+    ``start_time``-``end_time`` (the whole day when blank) from whatever is left.
+    Either kind can be limited to one clinic.
+    """
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='availability_exceptions')
+    clinic = models.ForeignKey(Clinic, on_delete=models.CASCADE, null=True, blank=True,
+                               related_name='availability_exceptions')
+    date = models.DateField()
+    start_time = models.TimeField(null=True, blank=True)
+    end_time = models.TimeField(null=True, blank=True)
+    available = models.BooleanField(default=False)
+    reason = models.CharField(max_length=200, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['date', 'start_time']
+        indexes = [models.Index(fields=['date', 'doctor'], name='availexception_date_idx')]
+
+    def clean(self):
+        if (self.start_time is None) != (self.end_time is None):
+            raise ValidationError('Give both a start and an end time, or neither for the whole day.')
+        if self.start_time is not None and self.start_time >= self.end_time:
+            raise ValidationError('The start time must be before the end time.')
+        if self.available and self.start_time is None:
+            raise ValidationError('Extra hours need a start and an end time.')
+        if self.available and self.doctor_id is not None and AvailabilityException.objects.filter(
+                doctor_id=self.doctor_id, date=self.date, available=True, start_time__lt=self.end_time,
+                end_time__gt=self.start_time).exclude(pk=self.pk).exists():
+            raise ValidationError(f'These hours overlap extra hours already set for {self.date:%d %b %Y}.')
+
+    def __str__(self):
+        kind = 'hours' if self.available else 'time off'
+        return f"Dr. {self.doctor.name}'s {kind} on {self.date:%d %b %Y}"
+
+
 class Appointment(models.Model):
     STATUS_CHOICES = (
         ('Scheduled', 'Scheduled'),
@@ -79,10 +161,171 @@ class Appointment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored state so that signal handlers can tell what changed.
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
     def __str__(self):
         formatted_time = self.appointment_datetime.strftime("%d %b %Y, %I:%M %p")
         return f"Appointment for {self.patient.name} with Dr. {self.doctor.name} on {formatted_time}"
 
     class Meta:
         ordering = ['-appointment_datetime']
-        unique_together = ('doctor', 'appointment_datetime')
\ No newline at end of file
+        constraints = [
+            # A cancelled appointment gives its slot back.
+            models.UniqueConstraint(fields=['doctor', 'appointment_datetime'], condition=~models.Q(status='Cancelled'),
+                                    name='appointment_doctor_slot_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['doctor', 'appointment_datetime'], name='appointment_doctor_time_idx'),
+            models.Index(fields=['patient', 'appointment_datetime'], name='appointment_patient_time_idx'),
+            models.Index(fields=['doctor', 'status', 'appointment_datetime'], name='appointment_doctor_status_idx'),
+            models.Index(fields=['doctor', 'updated_at'], name='appointment_changed_idx'),
+            # Date ranges of one clinic's appointments, streamed by clinic.analytics.
+            models.Index(fields=['clinic', 'appointment_datetime'], name='appointment_clinic_time_idx'),
+            # Booked slots across all doctors, read when the free-slot index is built.
+            models.Index(fields=['appointment_datetime', 'doctor'], condition=models.Q(status='Scheduled'),
+                         name='appointment_scheduled_idx'),
+        ]
+
+class SlotHold(models.Model):
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='slot_holds')
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='held_slots')
+    starts_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('doctor', 'starts_at')
+        indexes = [models.Index(fields=['expires_at'], name='slothold_expires_idx')]
+
+    def __str__(self):
+        return f"Hold on {self.starts_at:%d %b %Y, %I:%M %p} until {self.expires_at:%I:%M %p}"
+
+
+class DoctorStats(models.Model):
+    """
+    Dashboard counters for one doctor, maintained incrementally by
+    ``clinic.stats``. ``today_count`` and ``upcoming_count`` are relative to
+    ``stats_date`` and are recomputed the first time they are read on a new day.
+    """
+    doctor = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stats')
+    stats_date = models.DateField()
+    today_count = models.PositiveIntegerField(default=0)
+    upcoming_count = models.PositiveIntegerField(default=0)
+    total_patients = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Stats for Dr. {self.doctor_id} on {self.stats_date}"
+
+
+class DoctorPatient(models.Model):
+    """Number of appointments between a doctor and a patient, used to keep ``total_patients`` distinct."""
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    appointment_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('doctor', 'patient')
+
+
+class DoctorProfile(models.Model):
+    """
+    What the doctor directory shows, copied out of the doctor's clinics and
+    schedule by ``clinic.directory`` so that listing doctors needs no joins.
+    ``specialization`` is the one most of the doctor's clinics share.
+    """
+    doctor = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
+    specialization = models.ForeignKey(Specialization, on_delete=models.SET_NULL, null=True, blank=True,
+                                       related_name='+')
+    specialization_name = models.CharField(max_length=200, blank=True)
+    clinic_ids = models.JSONField(default=list, blank=True)
+    next_available = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['next_available'], name='profile_next_available_idx')]
+
+    def __str__(self):
+        return f"Directory profile of Dr. {self.doctor_id}"
+
+
+class DoctorFacet(models.Model):
+    """One value a doctor can be filtered on in the directory, e.g. ``('clinic', '12')``."""
+    FACET_CHOICES = (
+        ('specialization', 'Specialization'),
+        ('clinic', 'Clinic'),
+        ('day', 'Availability day'),
+    )
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    facet = models.CharField(max_length=20, choices=FACET_CHOICES)
+    value = models.CharField(max_length=20)
+
+    class Meta:
+        # Also the covering index for filtering on a value and counting doctors per value.
+        unique_together = ('facet', 'value', 'doctor')
+
+
+class CalendarTombstone(models.Model):
+    """Records a deleted calendar event so that incremental feeds can tell clients to remove it."""
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    uid = models.CharField(max_length=100)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['doctor', 'deleted_at'])]
+
+    def __str__(self):
+        return f"{self.uid} deleted at {self.deleted_at}"
+
+
+class Task(models.Model):
+    """A unit of deferred work, run by ``manage.py run_worker``; see ``clinic.tasks``."""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    run_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx')]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class Reminder(models.Model):
+    """One reminder of an appointment; the unique constraint keeps each from being sent twice."""
+    KIND_CHOICES = (
+        ('24h', '24 hours before'),
+        ('1h', '1 hour before'),
+    )
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='reminders')
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES)
+    # The task that sends this reminder; a sweep that lost the race to create the row does not own it.
+    task = models.ForeignKey(Task, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('appointment', 'kind')
+
+    def __str__(self):
+        return f"{self.kind} reminder for appointment {self.appointment_id}"
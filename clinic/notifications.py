@@ -0,0 +1,133 @@
+"""
+Appointment emails, sent by the task worker rather than the request.
+
+Booking, changing and cancelling an appointment queue a task from
+``clinic.signals``. Reminders are queued by ``schedule_reminders``, which the
+worker runs periodically: it walks the scheduled appointments starting inside
+each reminder's window through the partial ``appointment_scheduled_idx``
+index, records a ``Reminder`` row per appointment and queues one task per
+batch to send them.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import tasks
+from .models import Appointment, Reminder
+
+
+# (kind, lead time), longest first; each window ends where the next one starts.
+REMINDERS = (('24h', timedelta(hours=24)), ('1h', timedelta(hours=1)))
+REMINDER_BATCH = getattr(settings, 'CLINIC_REMINDER_BATCH', 200)
+
+
+def _when(value):
+    return timezone.localtime(value).strftime('%d %b %Y, %I:%M %p')
+
+
+def _message(subject, body, *recipients):
+    recipients = [email for email in recipients if email]
+    return (subject, body, None, recipients) if recipients else None
+
+
+def _send(messages):
+    messages = [message for message in messages if message]
+    if messages:
+        send_mass_mail(messages, fail_silently=False)
+    return len(messages)
+
+
+def _appointment(appointment_id):
+    return (Appointment.objects.select_related('patient', 'doctor', 'clinic')
+            .filter(pk=appointment_id).first())
+
+
+@tasks.task
+def appointment_booked(appointment_id):
+    appointment = _appointment(appointment_id)
+    if appointment is None:
+        return
+    when, doctor, patient = _when(appointment.appointment_datetime), appointment.doctor, appointment.patient
+    _send([
+        _message('Your appointment is booked',
+                 f'Hello {patient.name},\n\nYour appointment with Dr. {doctor.name} at {appointment.clinic.name} '
+                 f'is booked for {when}.\n', patient.email),
+        _message('New appointment',
+                 f'{patient.name} booked an appointment at {appointment.clinic.name} for {when}.\n'
+                 f'Reason: {appointment.reason}\n', doctor.email),
+    ])
+
+
+@tasks.task
+def appointment_changed(appointment_id):
+    appointment = _appointment(appointment_id)
+    if appointment is None:
+        return
+    when, patient = _when(appointment.appointment_datetime), appointment.patient
+    if appointment.status == 'Cancelled':
+        subject, news = 'Your appointment was cancelled', 'has been cancelled'
+    else:
+        subject, news = 'Your appointment was updated', f'is now {appointment.status.lower()} for {when}'
+    _send([_message(subject, f'Hello {patient.name},\n\nYour appointment with Dr. {appointment.doctor.name} '
+                             f'{news}.\n', patient.email)])
+
+
+@tasks.task
+def appointment_cancelled(patient_name, patient_email, doctor_name, doctor_email, when):
+    _send([
+        _message('Your appointment was cancelled',
+                 f'Hello {patient_name},\n\nYour appointment with Dr. {doctor_name} on {when} has been cancelled.\n',
+                 patient_email),
+        _message('Appointment cancelled', f'The appointment with {patient_name} on {when} was cancelled.\n',
+                 doctor_email),
+    ])
+
+
+def cancellation(appointment):
+    """Keyword arguments for ``appointment_cancelled``, taken before the appointment is deleted."""
+    return {
+        'patient_name': appointment.patient.name, 'patient_email': appointment.patient.email,
+        'doctor_name': appointment.doctor.name, 'doctor_email': appointment.doctor.email,
+        'when': _when(appointment.appointment_datetime),
+    }
+
+
+@tasks.task(bind=True)
+def send_reminders(task, kind):
+    reminders = list(Reminder.objects.filter(task=task, sent_at=None)
+                     .select_related('appointment__patient', 'appointment__doctor', 'appointment__clinic'))
+    # Marked first: if sending fails the task's transaction rolls this back.
+    Reminder.objects.filter(pk__in=[r.pk for r in reminders]).update(sent_at=timezone.now())
+    _send([
+        _message('Appointment reminder',
+                 f'Hello {r.appointment.patient.name},\n\nThis is a reminder of your appointment with '
+                 f'Dr. {r.appointment.doctor.name} at {r.appointment.clinic.name} on '
+                 f'{_when(r.appointment.appointment_datetime)}.\n', r.appointment.patient.email)
+        for r in reminders if r.appointment.status == 'Scheduled'
+    ])
+
+
+def schedule_reminders(now=None, batch_size=REMINDER_BATCH):
+    """Queue the reminders that are due and not yet queued; returns how many."""
+    now = now or timezone.now()
+    queued = 0
+    for i, (kind, lead) in enumerate(REMINDERS):
+        start = now + (REMINDERS[i + 1][1] if i + 1 < len(REMINDERS) else timedelta(0))
+        due = (Appointment.objects
+               .filter(status='Scheduled', appointment_datetime__gt=start, appointment_datetime__lte=now + lead)
+               .filter(~Exists(Reminder.objects.filter(appointment=OuterRef('pk'), kind=kind)))
+               .order_by('appointment_datetime').values_list('id', flat=True))
+        # Every pass records its batch, so the next pass of the same query starts after it.
+        while batch := list(due[:batch_size]):
+            with transaction.atomic():
+                task = send_reminders.enqueue(kind=kind)
+                # A concurrent sweep may have recorded some of these already; it sends those.
+                Reminder.objects.bulk_create([Reminder(appointment_id=pk, kind=kind, task=task) for pk in batch],
+                                             ignore_conflicts=True)
+            queued += len(batch)
+    return queued
@@ -0,0 +1,97 @@
+"""
+Keyset (cursor) pagination for appointment listings.
+
+Pages are selected with ``WHERE (appointment_datetime, id) < cursor`` rather
+than ``OFFSET``, so fetching page 500 costs the same as fetching page 1.
+"""
+
+import base64
+from datetime import datetime, time
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Appointment
+
+
+PAGE_SIZE = 20
+
+STATUSES = {status for status, _ in Appointment.STATUS_CHOICES}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(appointment):
+    raw = f'{appointment.appointment_datetime.isoformat()}|{appointment.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        when, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        when = parse_datetime(when)
+        pk = int(pk)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if when is None:
+        raise InvalidCursor(cursor)
+    return when, pk
+
+
+def filter_appointments(queryset, params):
+    """Apply the ``status``, ``date_from`` and ``date_to`` listing filters from ``params``."""
+    status = params.get('status')
+    if status in STATUSES:
+        queryset = queryset.filter(status=status)
+
+    date_from = parse_date(params.get('date_from') or '')
+    if date_from:
+        queryset = queryset.filter(
+            appointment_datetime__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+
+    date_to = parse_date(params.get('date_to') or '')
+    if date_to:
+        queryset = queryset.filter(
+            appointment_datetime__lte=timezone.make_aware(datetime.combine(date_to, time.max)))
+    return queryset
+
+
+def _after_cursor(queryset, cursor, descending):
+    if descending:
+        queryset = queryset.order_by('-appointment_datetime', '-id')
+    else:
+        queryset = queryset.order_by('appointment_datetime', 'id')
+
+    if cursor:
+        when, pk = decode_cursor(cursor)
+        if descending:
+            queryset = queryset.filter(
+                Q(appointment_datetime__lt=when) | Q(appointment_datetime=when, id__lt=pk))
+        else:
+            queryset = queryset.filter(
+                Q(appointment_datetime__gt=when) | Q(appointment_datetime=when, id__gt=pk))
+    return queryset
+
+
+def _split(rows, size):
+    if len(rows) > size:
+        return rows[:size], encode_cursor(rows[size - 1])
+    return rows, None
+
+
+def keyset_page(queryset, cursor=None, size=PAGE_SIZE, descending=True):
+    """
+    Return ``(appointments, next_cursor)`` for the page after ``cursor``.
+    ``next_cursor`` is ``None`` on the last page.
+    """
+    rows = list(_after_cursor(queryset, cursor, descending)[:size + 1])
+    return _split(rows, size)
+
+
+async def akeyset_page(queryset, cursor=None, size=PAGE_SIZE, descending=True):
+    """``keyset_page`` for async views."""
+    rows = [row async for row in _after_cursor(queryset, cursor, descending)[:size + 1]]
+    return _split(rows, size)
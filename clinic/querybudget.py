@@ -0,0 +1,205 @@
+"""
+Per-request SQL instrumentation.
+
+``QueryBudgetMiddleware`` records every query a request runs, keeps running
+totals per URL name (see ``query_stats``) and logs a warning when a view
+exceeds the budget declared for its route and method in
+``clinic.urls.QUERY_BUDGETS`` or repeats the same query often enough to look
+like an N+1 pattern. With ``CLINIC_QUERY_BUDGET_STRICT`` on, as under
+``manage.py test``, an overrun raises ``QueryBudgetExceeded`` instead, so any
+test request that outgrows its budget fails. ``QueryBudgetMixin`` applies the
+same checks to single test-client requests and on SQLite also runs
+``EXPLAIN QUERY PLAN`` for each query to catch filters that no index serves.
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.urls import reverse
+
+
+logger = logging.getLogger('clinic.queries')
+
+REPEAT_THRESHOLD = getattr(settings, 'CLINIC_N_PLUS_ONE_THRESHOLD', 3)
+STRICT = getattr(settings, 'CLINIC_QUERY_BUDGET_STRICT', False)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN \([^()]*\)")
+_TRANSACTION_CONTROL = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'BEGIN')
+# "SCAN clinic_user" ("SCAN TABLE clinic_user" before SQLite 3.36). Walking a whole
+# index in order is still a full scan; only "SEARCH ..." narrows by the filter.
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX \w+)?$')
+
+
+def fingerprint(sql):
+    """Collapse literals and IN lists so that queries differing only in values compare equal."""
+    return _IN_LISTS.sub('IN (...)', _LITERALS.sub('?', sql))
+
+
+class QueryRecorder:
+
+    def __init__(self):
+        self.queries = []
+        # (sql, params) of single statements, for explain()
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.startswith(_TRANSACTION_CONTROL):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+            if not many:
+                self.statements.append((sql, params))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(duration for _, duration in self.queries)
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """Fingerprints executed at least ``threshold`` times, with their counts."""
+        counts = Counter(fingerprint(sql) for sql, _ in self.queries)
+        return {sql: n for sql, n in counts.items() if n >= threshold}
+
+
+@contextmanager
+def record_queries(using='default'):
+    recorder = QueryRecorder()
+    with connections[using].execute_wrapper(recorder):
+        yield recorder
+
+
+def full_scans(sql, params=None, using='default'):
+    """
+    Tables SQLite would read row by row to answer ``sql``. Statements without
+    a WHERE clause are meant to read everything and are not reported.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or ' WHERE ' not in sql:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = cursor.fetchall()
+    return [match[1] for match in (_FULL_SCAN.match(row[-1]) for row in plan) if match]
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more queries than its budget, in strict mode."""
+
+
+def budget_for(url_name, method='GET'):
+    """The budget of ``method`` requests to ``url_name``; a plain number covers GET and HEAD only."""
+    from .urls import QUERY_BUDGETS
+
+    budget = QUERY_BUDGETS.get(url_name)
+    method = 'GET' if method.upper() == 'HEAD' else method.upper()
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget if method == 'GET' else None
+
+
+# url_name -> {'requests', 'queries', 'db_time', 'max_queries'}
+request_stats = defaultdict(lambda: {'requests': 0, 'queries': 0, 'db_time': 0.0, 'max_queries': 0})
+_stats_lock = threading.Lock()
+
+
+def query_stats():
+    """A copy of the running totals per URL name."""
+    with _stats_lock:
+        return {url_name: dict(stats) for url_name, stats in request_stats.items()}
+
+
+def _start_recording(recorder, using='default'):
+    wrapper = connections[using].execute_wrapper(recorder)
+    wrapper.__enter__()
+    return wrapper
+
+
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        return self.process(request, response, recorder)
+
+    async def __acall__(self, request):
+        # The async ORM runs queries on the request's sync thread, whose
+        # connection is not the one visible from the event loop.
+        recorder = QueryRecorder()
+        wrapper = await sync_to_async(_start_recording)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrapper.__exit__)(None, None, None)
+        return self.process(request, response, recorder)
+
+    def process(self, request, response, recorder):
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match else None
+
+        with _stats_lock:
+            stats = request_stats[url_name]
+            stats['requests'] += 1
+            stats['queries'] += recorder.count
+            stats['db_time'] += recorder.total_time
+            stats['max_queries'] = max(stats['max_queries'], recorder.count)
+
+        budget = budget_for(url_name, request.method)
+        if budget is not None and recorder.count > budget:
+            message = (f'{request.method} {url_name} ran {recorder.count} queries (budget {budget}) '
+                       f'in {recorder.total_time * 1000:.1f} ms')
+            if STRICT:
+                raise QueryBudgetExceeded(message + ':\n' + '\n'.join(sql for sql, _ in recorder.queries))
+            logger.warning(message)
+        for sql, n in recorder.repeated().items():
+            logger.warning('Possible N+1 in %s: %d x %s', url_name, n, sql)
+
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time'] = f'{recorder.total_time * 1000:.1f}ms'
+        return response
+
+
+class QueryBudgetMixin:
+    """TestCase mixin that fails a request which exceeds its route's query budget."""
+
+    def assertQueryBudget(self, url_name, *args, method='get', data=None, **kwargs):
+        budget = budget_for(url_name, method)
+        self.assertIsNotNone(budget, f'No {method.upper()} query budget declared for {url_name!r}')
+
+        with record_queries() as recorder:
+            response = getattr(self.client, method)(reverse(url_name, args=args), data, **kwargs)
+
+        listing = '\n'.join(sql for sql, _ in recorder.queries)
+        self.assertLessEqual(
+            recorder.count, budget,
+            f'{url_name} ran {recorder.count} queries, budget is {budget}:\n{listing}')
+        self.assertEqual(recorder.repeated(), {}, f'{url_name} repeats queries:\n{listing}')
+        for sql, params in recorder.statements:
+            if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            scanned = full_scans(sql, params)
+            self.assertEqual(scanned, [], f'{url_name} scans {", ".join(scanned)} in full:\n{sql}')
+        return response
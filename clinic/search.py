@@ -0,0 +1,161 @@
+"""
+Full-text search over clinics and specializations.
+
+On SQLite the searchable text lives in two FTS5 shadow tables whose rowids are
+the primary keys of the source rows, so keeping them in sync is a single
+indexed write from the signal handlers in ``clinic.signals``. Other database
+backends fall back to plain ``icontains`` filtering.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Clinic, Specialization
+
+
+CLINIC_TABLE = 'clinic_clinic_search'
+SPECIALIZATION_TABLE = 'clinic_specialization_search'
+
+# bm25 column weights for (name, specialization, description).
+CLINIC_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def enabled(conn=None):
+    return (conn or connection).vendor == 'sqlite'
+
+
+def create_tables(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {CLINIC_TABLE} USING fts5("
+            "name, specialization, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SPECIALIZATION_TABLE} USING fts5("
+            "name, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+
+def drop_tables(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {CLINIC_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {SPECIALIZATION_TABLE}")
+
+
+def rebuild(conn=None):
+    conn = conn or connection
+    if not enabled(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {CLINIC_TABLE}")
+        cursor.execute(f"DELETE FROM {SPECIALIZATION_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {CLINIC_TABLE} (rowid, name, specialization, description) "
+            "SELECT c.id, c.name, COALESCE(s.name, ''), COALESCE(c.description, '') "
+            "FROM clinic_clinic c LEFT JOIN clinic_specialization s ON s.id = c.specialization_id"
+        )
+        cursor.execute(
+            f"INSERT INTO {SPECIALIZATION_TABLE} (rowid, name) SELECT id, name FROM clinic_specialization"
+        )
+
+
+def index_clinics(clinic_ids):
+    if not enabled() or not clinic_ids:
+        return
+    rows = Clinic.objects.filter(id__in=clinic_ids).values_list('id', 'name', 'specialization__name', 'description')
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {CLINIC_TABLE} WHERE rowid = %s", [(pk,) for pk in clinic_ids])
+        cursor.executemany(
+            f"INSERT INTO {CLINIC_TABLE} (rowid, name, specialization, description) VALUES (%s, %s, %s, %s)",
+            [(pk, name, specialization or '', description or '') for pk, name, specialization, description in rows],
+        )
+
+
+def unindex_clinic(clinic_id):
+    if enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {CLINIC_TABLE} WHERE rowid = %s", [clinic_id])
+
+
+def index_specialization(specialization):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SPECIALIZATION_TABLE} WHERE rowid = %s", [specialization.id])
+        cursor.execute(f"INSERT INTO {SPECIALIZATION_TABLE} (rowid, name) VALUES (%s, %s)",
+                       [specialization.id, specialization.name])
+
+
+def unindex_specialization(specialization_id):
+    if enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SPECIALIZATION_TABLE} WHERE rowid = %s", [specialization_id])
+
+
+def match_expression(q):
+    """Turn free text into an FTS5 query where every word is a prefix match."""
+    words = re.findall(r'\w+', q.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class SearchResults:
+    """
+    Lazily evaluated, ranked search results that ``django.core.paginator``
+    can slice and count without loading every match.
+    """
+
+    def __init__(self, q, table, model, weights=(), select_related=()):
+        self.match = match_expression(q)
+        self.table = table
+        self.model = model
+        self.weights = weights
+        self.select_related = select_related
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if not self.match:
+                self._count = 0
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"SELECT count(*) FROM {self.table} WHERE {self.table} MATCH %s", [self.match])
+                    self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        if not self.match:
+            return []
+        start = key.start or 0
+        limit = -1 if key.stop is None else max(key.stop - start, 0)
+        rank = f"bm25({self.table}{''.join(f', {w}' for w in self.weights)})"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s ORDER BY {rank} LIMIT %s OFFSET %s",
+                [self.match, limit, start],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        objects = self.model.objects.select_related(*self.select_related).in_bulk(ids)
+        return [objects[pk] for pk in ids if pk in objects]
+
+
+def search_clinics(q):
+    if enabled():
+        return SearchResults(q, CLINIC_TABLE, Clinic, CLINIC_WEIGHTS, ('specialization', 'host'))
+    return Clinic.objects.select_related('specialization', 'host').filter(
+        Q(specialization__name__icontains=q) |
+        Q(name__icontains=q) |
+        Q(description__icontains=q)
+    )
+
+
+def search_specializations(q):
+    if enabled():
+        return SearchResults(q, SPECIALIZATION_TABLE, Specialization)
+    return Specialization.objects.filter(name__icontains=q)
@@ -0,0 +1,344 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import analytics, auth, catalog, dashboards, db, directory, events, ical, images, notifications, search, stats
+from .models import (
+    Appointment, Availability, AvailabilityException, Clinic, DoctorProfile, SlotHold, Specialization, User,
+)
+from .slots import slot_index
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    db.configure_connection(connection)
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved(sender, instance, **kwargs):
+    args = (instance.id, instance.doctor_id, instance.appointment_datetime, instance.status)
+    transaction.on_commit(lambda: slot_index.appointment_changed(*args))
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance, **kwargs):
+    appointment_id = instance.id
+    transaction.on_commit(lambda: slot_index.appointment_removed(appointment_id))
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved_events(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old = {} if created else getattr(instance, '_loaded_values', {})
+    before = (old.get('doctor_id'), old.get('appointment_datetime'), old.get('status'))
+    after = (instance.doctor_id, instance.appointment_datetime, instance.status)
+    transaction.on_commit(lambda: events.appointment_changed(before, after))
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted_events(sender, instance, **kwargs):
+    args = (instance.doctor_id, instance.appointment_datetime, instance.status)
+    transaction.on_commit(lambda: events.appointment_removed(*args))
+
+
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+@receiver(post_save, sender=AvailabilityException)
+@receiver(post_delete, sender=AvailabilityException)
+def availability_changed(sender, instance, **kwargs):
+    doctor_id = instance.doctor_id
+    transaction.on_commit(lambda: slot_index.availability_changed(doctor_id))
+
+
+@receiver(post_save, sender=SlotHold)
+def hold_saved(sender, instance, **kwargs):
+    args = (instance.doctor_id, instance.starts_at, instance.expires_at)
+    transaction.on_commit(lambda: slot_index.hold_changed(*args))
+
+
+@receiver(post_delete, sender=SlotHold)
+def hold_deleted(sender, instance, **kwargs):
+    args = (instance.doctor_id, instance.starts_at)
+    transaction.on_commit(lambda: slot_index.hold_removed(*args))
+
+
+@receiver(post_save, sender=SlotHold)
+def hold_saved_events(sender, instance, **kwargs):
+    args = (instance.doctor_id, instance.starts_at, instance.expires_at)
+    transaction.on_commit(lambda: events.hold_placed(*args))
+
+
+@receiver(post_delete, sender=SlotHold)
+def hold_deleted_events(sender, instance, **kwargs):
+    args = (instance.doctor_id, instance.starts_at)
+    transaction.on_commit(lambda: events.hold_released(*args))
+
+
+@receiver(post_save, sender=Clinic)
+@receiver(post_delete, sender=Clinic)
+@receiver(m2m_changed, sender=Clinic.doctors.through)
+def clinic_changed(sender, **kwargs):
+    transaction.on_commit(slot_index.memberships_changed)
+
+
+@receiver(post_save, sender=Clinic)
+def clinic_saved_search(sender, instance, **kwargs):
+    search.index_clinics([instance.id])
+
+
+@receiver(post_delete, sender=Clinic)
+def clinic_deleted_search(sender, instance, **kwargs):
+    search.unindex_clinic(instance.id)
+
+
+@receiver(post_save, sender=Specialization)
+def specialization_saved_search(sender, instance, created, **kwargs):
+    search.index_specialization(instance)
+    if not created:
+        search.index_clinics(list(instance.clinic_set.values_list('id', flat=True)))
+
+
+@receiver(pre_delete, sender=Specialization)
+def specialization_deleting_search(sender, instance, **kwargs):
+    instance._search_clinic_ids = list(instance.clinic_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Specialization)
+def specialization_deleted_search(sender, instance, **kwargs):
+    search.unindex_specialization(instance.id)
+    search.index_clinics(getattr(instance, '_search_clinic_ids', []))
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved_stats(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        stats.appointment_saved(instance, created)
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted_stats(sender, instance, **kwargs):
+    stats.appointment_deleted(instance)
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_changed_dashboard(sender, instance, **kwargs):
+    patient_ids = {instance.patient_id, getattr(instance, '_loaded_values', {}).get('patient_id')}
+    for patient_id in patient_ids - {None}:
+        transaction.on_commit(lambda patient_id=patient_id: dashboards.invalidate_patient(patient_id))
+
+
+# Changes to these are worth telling the patient about.
+NOTIFIED_FIELDS = ('doctor_id', 'appointment_datetime', 'status')
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved_notify(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        notifications.appointment_booked.enqueue(appointment_id=instance.id)
+        return
+    old = getattr(instance, '_loaded_values', {})
+    if any(field in old and old[field] != getattr(instance, field) for field in NOTIFIED_FIELDS):
+        notifications.appointment_changed.enqueue(appointment_id=instance.id)
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted_notify(sender, instance, origin=None, **kwargs):
+    if _deleted_with(origin, instance.patient_id) or _deleted_with(origin, instance.doctor_id):
+        return
+    if instance.status == 'Scheduled' and instance.appointment_datetime > timezone.now():
+        notifications.appointment_cancelled.enqueue(**notifications.cancellation(instance))
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_save, sender=Availability)
+@receiver(post_save, sender=AvailabilityException)
+def schedule_saved_calendar(sender, instance, **kwargs):
+    doctor_id = instance.doctor_id
+    transaction.on_commit(lambda: ical.invalidate(doctor_id))
+    old_doctor_id = getattr(instance, '_loaded_values', {}).get('doctor_id')
+    if old_doctor_id not in (None, doctor_id):
+        # The appointment moved to another doctor's calendar.
+        ical.record_deletion(old_doctor_id, ical.appointment_uid(instance.id))
+        transaction.on_commit(lambda: ical.invalidate(old_doctor_id))
+
+
+def _deleted_with(origin, user_id):
+    """Whether the delete that started at ``origin`` also removes the user ``user_id``."""
+    if isinstance(origin, User):
+        return origin.pk == user_id
+    if isinstance(origin, QuerySet) and origin.model is User:
+        # Dependent rows are deleted before the users, so the queryset still matches them.
+        if not hasattr(origin, '_deleted_ids'):
+            origin._deleted_ids = set(origin.values_list('pk', flat=True))
+        return user_id in origin._deleted_ids
+    return False
+
+
+@receiver(post_delete, sender=Appointment)
+@receiver(post_delete, sender=Availability)
+@receiver(post_delete, sender=AvailabilityException)
+def schedule_deleted_calendar(sender, instance, origin=None, **kwargs):
+    doctor_id = instance.doctor_id
+    transaction.on_commit(lambda: ical.invalidate(doctor_id))
+    if _deleted_with(origin, doctor_id):
+        return  # the whole calendar is going away with the doctor
+    uid = {Appointment: ical.appointment_uid, Availability: ical.availability_uid,
+           AvailabilityException: ical.exception_uid}[sender](instance.id)
+    ical.record_deletion(doctor_id, uid)
+
+
+def _bump_on_commit(*entities):
+    for entity in entities:
+        transaction.on_commit(lambda entity=entity: catalog.bump(entity))
+
+
+@receiver(post_save, sender=User)
+def user_saved_catalog(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    # An existing patient may have just stopped being a doctor, so only new patients are skipped.
+    if instance.role == 'doctor' or not created:
+        _bump_on_commit('doctors')
+
+
+@receiver(post_delete, sender=User)
+def user_deleted_catalog(sender, instance, **kwargs):
+    if instance.role == 'doctor':
+        _bump_on_commit('doctors')
+
+
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+@receiver(post_save, sender=AvailabilityException)
+@receiver(post_delete, sender=AvailabilityException)
+def availability_changed_catalog(sender, **kwargs):
+    _bump_on_commit('availability')
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_changed_analytics(sender, instance, **kwargs):
+    clinic_ids = {instance.clinic_id, getattr(instance, '_loaded_values', {}).get('clinic_id')} - {None}
+    _bump_on_commit(*(analytics.appointments_entity(clinic_id) for clinic_id in clinic_ids))
+
+
+@receiver(post_save, sender=Specialization)
+@receiver(post_delete, sender=Specialization)
+def specialization_changed_catalog(sender, **kwargs):
+    _bump_on_commit('specializations')
+
+
+@receiver(post_save, sender=Clinic)
+@receiver(post_delete, sender=Clinic)
+@receiver(m2m_changed, sender=Clinic.doctors.through)
+def clinic_changed_catalog(sender, **kwargs):
+    _bump_on_commit('clinics')
+
+
+@receiver(post_save, sender=User)
+def user_saved_avatar(sender, instance, raw=False, **kwargs):
+    if not raw and images.needs_variants(instance):
+        images.update_variants(instance)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed_auth(sender, instance, **kwargs):
+    user_id = instance.pk
+    auth.user_cache.forget_user(user_id)
+    # Again once committed, in case another request cached the old row in between.
+    transaction.on_commit(lambda: auth.user_cache.forget_user(user_id))
+
+
+def _takes_next_slot(when, status):
+    return status == 'Scheduled' and when is not None and when > timezone.now()
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved_directory(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_loaded_values', {})
+    if old and all(old.get(field) == getattr(instance, field) for field in stats.TRACKED_FIELDS):
+        return
+    doctor_ids = set()
+    if _takes_next_slot(instance.appointment_datetime, instance.status):
+        doctor_ids.add(instance.doctor_id)
+    if _takes_next_slot(old.get('appointment_datetime'), old.get('status')):
+        doctor_ids.add(old.get('doctor_id'))
+    directory.queue_refresh(*doctor_ids)
+
+
+@receiver(post_delete, sender=Appointment)
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+@receiver(post_save, sender=AvailabilityException)
+@receiver(post_delete, sender=AvailabilityException)
+def schedule_changed_directory(sender, instance, raw=False, origin=None, **kwargs):
+    if raw or _deleted_with(origin, instance.doctor_id):
+        return
+    if sender is Appointment and not _takes_next_slot(instance.appointment_datetime, instance.status):
+        return
+    directory.queue_refresh(instance.doctor_id)
+
+
+@receiver(m2m_changed, sender=Clinic.doctors.through)
+def clinic_doctors_changed_directory(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        instance._directory_doctor_ids = [instance.pk] if reverse else list(
+            instance.doctors.values_list('id', flat=True))
+    elif action == 'post_clear':
+        directory.queue_refresh(*instance._directory_doctor_ids)
+    elif action in ('post_add', 'post_remove'):
+        directory.queue_refresh(*([instance.pk] if reverse else pk_set))
+
+
+@receiver(post_save, sender=Clinic)
+def clinic_saved_directory(sender, instance, created, raw=False, **kwargs):
+    # A new clinic has no doctors yet; an existing one may have changed specialization.
+    if not created and not raw:
+        directory.queue_refresh(*instance.doctors.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Clinic)
+def clinic_deleting_directory(sender, instance, **kwargs):
+    instance._directory_doctor_ids = list(instance.doctors.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Clinic)
+def clinic_deleted_directory(sender, instance, origin=None, **kwargs):
+    doctor_ids = getattr(instance, '_directory_doctor_ids', [])
+    directory.queue_refresh(*(doctor_id for doctor_id in doctor_ids if not _deleted_with(origin, doctor_id)))
+
+
+@receiver(post_save, sender=Specialization)
+def specialization_saved_directory(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw and DoctorProfile.objects.filter(specialization=instance).exclude(
+            specialization_name=instance.name).update(specialization_name=instance.name):
+        _bump_on_commit('doctors')
+
+
+@receiver(pre_delete, sender=Specialization)
+def specialization_deleting_directory(sender, instance, **kwargs):
+    instance._directory_doctor_ids = list(instance.clinic_set.values_list('doctors', flat=True).distinct())
+
+
+@receiver(post_delete, sender=Specialization)
+def specialization_deleted_directory(sender, instance, **kwargs):
+    directory.queue_refresh(*getattr(instance, '_directory_doctor_ids', []))
+
+
+@receiver(post_save, sender=User)
+def user_saved_directory(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    # Listed doctors may have been deactivated, and former doctors must be dropped.
+    if instance.role == 'doctor' or (not created and DoctorProfile.objects.filter(doctor_id=instance.pk).exists()):
+        directory.queue_refresh(instance.pk)
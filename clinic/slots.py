@@ -0,0 +1,439 @@
+"""
+In-memory index of bookable appointment slots.
+
+Each doctor's weekly Availability rows, with that doctor's dated
+AvailabilityExceptions applied, are expanded into concrete working hours over a
+rolling horizon and kept in an ``IntervalTree``; the hours are cut into slots
+and scheduled Appointments are subtracted from them. The index is built once
+per process and then kept up to date by the signal handlers in
+``clinic.signals``, so answering "is the doctor working at T" never touches
+the database.
+
+Signals only reach the index of the process that made the change. Before
+``free_slots`` offers slots it checks them against the scheduled appointments
+and live holds in the database and folds in any it had missed, so bookings
+made by another process are never offered; slots freed by another process
+come back at the next daily rebuild.
+"""
+
+import bisect
+import heapq
+import threading
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .intervals import IntervalTree
+from .models import Appointment, Availability, AvailabilityException, Clinic, SlotHold
+
+
+SLOT_MINUTES = getattr(settings, 'CLINIC_SLOT_MINUTES', 30)
+HORIZON_DAYS = getattr(settings, 'CLINIC_SLOT_HORIZON_DAYS', 28)
+# Lookups that keep finding bookings the index missed give up after this many passes.
+RECHECK_ROUNDS = 3
+
+WEEKDAYS = {day: number for number, (day, _) in enumerate(Availability.DAY_CHOICES)}
+
+
+def _disjoint(intervals):
+    """
+    ``intervals`` in start order without overlaps: overlapping hours at the same
+    clinic are merged, and between different clinics the earlier one keeps the
+    overlap. Validation rejects overlapping hours, but rows saved without it
+    would otherwise offer the same slot twice.
+    """
+    result = []
+    for start, end, clinic_id in sorted(intervals, key=lambda interval: (interval[0], interval[1])):
+        if result and start < result[-1][1]:
+            last_start, last_end, last_clinic = result[-1]
+            if clinic_id == last_clinic:
+                result[-1] = (last_start, max(last_end, end), last_clinic)
+                continue
+            start = last_end
+            if start >= end:
+                continue
+        result.append((start, end, clinic_id))
+    return result
+
+
+def working_hours(weekly, exceptions, day):
+    """
+    ``(start, end, clinic_id)`` for the hours worked on ``day``, in order and
+    not overlapping, given a doctor's ``weekly`` windows
+    (weekday -> [(start_time, end_time, clinic_id)]) and dated ``exceptions``
+    (date -> [(start_time, end_time, available, clinic_id)]).
+    """
+    exceptions = exceptions.get(day, ())
+    hours = [(start, end, clinic_id) for start, end, available, clinic_id in exceptions if available]
+    if not hours:
+        hours = weekly.get(day.weekday(), ())
+    blackouts = [(start or time.min, end or time.max, clinic_id)
+                 for start, end, available, clinic_id in exceptions if not available]
+    intervals = []
+    for start, end, clinic_id in hours:
+        pieces = [(start, end)]
+        for off_start, off_end, off_clinic in blackouts:
+            if off_clinic in (None, clinic_id):
+                pieces = [piece for lo, hi in pieces
+                          for piece in ((lo, min(hi, off_start)), (max(lo, off_end), hi)) if piece[0] < piece[1]]
+        intervals.extend((timezone.make_aware(datetime.combine(day, lo)),
+                          timezone.make_aware(datetime.combine(day, hi)), clinic_id) for lo, hi in pieces)
+    return _disjoint(intervals)
+
+
+class SlotIndex:
+
+    def __init__(self, slot_minutes=SLOT_MINUTES, horizon_days=HORIZON_DAYS):
+        self.slot = timedelta(minutes=slot_minutes)
+        self.horizon_days = horizon_days
+        self._lock = threading.RLock()
+        self._built_on = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._built_on = None
+            self._weekly = {}         # doctor_id -> {weekday: [(start_time, end_time, clinic_id)]}
+            self._exceptions = {}     # doctor_id -> {date: [(start_time, end_time, available, clinic_id)]}
+            self._hours = {}          # doctor_id -> IntervalTree of (start, end, clinic_id)
+            self._free = {}           # doctor_id -> sorted [datetime]
+            self._booked = {}         # doctor_id -> sorted [datetime]
+            self._appointments = {}   # appointment_id -> (doctor_id, datetime)
+            self._holds = {}          # (doctor_id, datetime) -> expires_at
+            self._by_clinic = {}      # clinic_id -> {doctor_id}
+            self._by_specialization = {}  # specialization_id -> {doctor_id}
+
+    # -- building -----------------------------------------------------------
+
+    def _ensure_built(self):
+        if self._built_on != timezone.localdate():
+            self.rebuild()
+
+    def rebuild(self):
+        with self._lock:
+            self.reset()
+            today = timezone.localdate()
+            start, end = self._horizon(today)
+            self._load(start, end)
+
+            holds = SlotHold.objects.filter(expires_at__gt=timezone.now()).values_list(
+                'doctor_id', 'starts_at', 'expires_at')
+            for doctor_id, when, expires_at in holds:
+                self._holds[(doctor_id, when)] = expires_at
+
+            self._load_memberships()
+            for doctor_id in self._weekly.keys() | self._exceptions.keys():
+                self._build_hours(doctor_id, start.date(), end.date())
+            self._built_on = today
+
+    def _load(self, start, end, doctor_ids=None):
+        """Weekly hours, exceptions and scheduled appointments between ``start`` and ``end``."""
+        weekly = Availability.objects.all()
+        exceptions = AvailabilityException.objects.filter(date__gte=start.date(), date__lt=end.date())
+        scheduled = Appointment.objects.filter(
+            status='Scheduled',
+            appointment_datetime__gte=start,
+            appointment_datetime__lt=end,
+        )
+        if doctor_ids is not None:
+            weekly, exceptions, scheduled = (
+                queryset.filter(doctor_id__in=doctor_ids) for queryset in (weekly, exceptions, scheduled))
+
+        for doctor_id, day, start_time, end_time, clinic_id in weekly.values_list(
+                'doctor_id', 'day', 'start_time', 'end_time', 'clinic_id'):
+            self._weekly.setdefault(doctor_id, {}).setdefault(
+                WEEKDAYS[day], []).append((start_time, end_time, clinic_id))
+        for doctor_id, *row in exceptions.values_list(
+                'doctor_id', 'date', 'start_time', 'end_time', 'available', 'clinic_id'):
+            self._add_exception(doctor_id, *row)
+        for appointment_id, doctor_id, when in scheduled.values_list('id', 'doctor_id', 'appointment_datetime'):
+            self._appointments[appointment_id] = (doctor_id, when)
+            bisect.insort(self._booked.setdefault(doctor_id, []), when)
+
+    def _add_exception(self, doctor_id, date, start_time, end_time, available, clinic_id):
+        self._exceptions.setdefault(doctor_id, {}).setdefault(date, []).append(
+            (start_time, end_time, available, clinic_id))
+
+    def _load_memberships(self):
+        self._by_clinic = {}
+        self._by_specialization = {}
+        specialization_of = dict(Clinic.objects.values_list('id', 'specialization_id'))
+        for clinic_id, doctor_id in Clinic.doctors.through.objects.values_list('clinic_id', 'user_id'):
+            self._by_clinic.setdefault(clinic_id, set()).add(doctor_id)
+            specialization_id = specialization_of.get(clinic_id)
+            if specialization_id is not None:
+                self._by_specialization.setdefault(specialization_id, set()).add(doctor_id)
+
+    def _horizon(self, today):
+        start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
+        return start, start + timedelta(days=self.horizon_days)
+
+    def _working_hours(self, doctor_id, day):
+        return working_hours(self._weekly.get(doctor_id, {}), self._exceptions.get(doctor_id, {}), day)
+
+    def _build_hours(self, doctor_id, first_day, last_day):
+        intervals = []
+        day = first_day
+        while day < last_day:
+            intervals.extend(self._working_hours(doctor_id, day))
+            day += timedelta(days=1)
+        self._hours[doctor_id] = IntervalTree(intervals)
+        self._free[doctor_id] = self._expand(doctor_id, first_day, last_day)
+
+    def _expand(self, doctor_id, first_day, last_day):
+        """Free slots for ``doctor_id`` on the days in ``[first_day, last_day)``."""
+        hours = self._hours.get(doctor_id)
+        if hours is None:
+            return []
+        booked = self._booked.get(doctor_id, [])
+        first = timezone.make_aware(datetime.combine(first_day, datetime.min.time()))
+        last = timezone.make_aware(datetime.combine(last_day, datetime.min.time()))
+        slots = []
+        for start, end, _ in hours.overlapping(first, last):
+            cursor = max(start, first)
+            while cursor + self.slot <= min(end, last):
+                if not self._overlaps_booking(booked, cursor):
+                    slots.append(cursor)
+                cursor += self.slot
+        return slots
+
+    def _overlaps_booking(self, booked, slot_start):
+        # A booking at time b occupies [b, b + slot); find any b in (slot_start - slot, slot_start + slot).
+        i = bisect.bisect_right(booked, slot_start - self.slot)
+        return i < len(booked) and booked[i] < slot_start + self.slot
+
+    def _refresh_day(self, doctor_id, day):
+        if self._built_on is None:
+            return
+        start, end = self._horizon(self._built_on)
+        if not start.date() <= day < end.date():
+            return
+        free = self._free.setdefault(doctor_id, [])
+        day_start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        lo = bisect.bisect_left(free, day_start)
+        hi = bisect.bisect_left(free, day_start + timedelta(days=1))
+        free[lo:hi] = self._expand(doctor_id, day, day + timedelta(days=1))
+
+    # -- incremental maintenance -------------------------------------------
+
+    def appointment_changed(self, appointment_id, doctor_id, when, status):
+        with self._lock:
+            if self._built_on is None:
+                return
+            previous = self._appointments.pop(appointment_id, None)
+            if previous is not None:
+                old_doctor, old_when = previous
+                self._booked[old_doctor].remove(old_when)
+                self._refresh_day(old_doctor, timezone.localdate(old_when))
+            if status == 'Scheduled':
+                self._appointments[appointment_id] = (doctor_id, when)
+                bisect.insort(self._booked.setdefault(doctor_id, []), when)
+                self._refresh_day(doctor_id, timezone.localdate(when))
+
+    def appointment_removed(self, appointment_id):
+        with self._lock:
+            previous = self._appointments.pop(appointment_id, None)
+            if previous is None:
+                return
+            doctor_id, when = previous
+            self._booked[doctor_id].remove(when)
+            self._refresh_day(doctor_id, timezone.localdate(when))
+
+    def availability_changed(self, doctor_id):
+        with self._lock:
+            if self._built_on is None:
+                return
+            start, end = self._horizon(self._built_on)
+            weekly = {}
+            for day, start_time, end_time, clinic_id in Availability.objects.filter(doctor_id=doctor_id).values_list(
+                    'day', 'start_time', 'end_time', 'clinic_id'):
+                weekly.setdefault(WEEKDAYS[day], []).append((start_time, end_time, clinic_id))
+            self._weekly[doctor_id] = weekly
+            self._exceptions.pop(doctor_id, None)
+            exceptions = AvailabilityException.objects.filter(
+                doctor_id=doctor_id, date__gte=start.date(), date__lt=end.date())
+            for row in exceptions.values_list('date', 'start_time', 'end_time', 'available', 'clinic_id'):
+                self._add_exception(doctor_id, *row)
+            self._build_hours(doctor_id, start.date(), end.date())
+
+    def hold_changed(self, doctor_id, when, expires_at):
+        with self._lock:
+            if self._built_on is not None:
+                self._holds[(doctor_id, when)] = expires_at
+
+    def hold_removed(self, doctor_id, when):
+        with self._lock:
+            self._holds.pop((doctor_id, when), None)
+
+    def memberships_changed(self):
+        with self._lock:
+            if self._built_on is not None:
+                self._load_memberships()
+
+    # -- queries -------------------------------------------------------------
+
+    def doctors_for(self, doctor=None, specialization=None, clinic=None):
+        self._ensure_built()
+        candidates = None
+        if doctor is not None:
+            candidates = {int(doctor)}
+        if clinic is not None:
+            members = self._by_clinic.get(int(clinic), set())
+            candidates = members if candidates is None else candidates & members
+        if specialization is not None:
+            members = self._by_specialization.get(int(specialization), set())
+            candidates = members if candidates is None else candidates & members
+        if candidates is None:
+            candidates = self._free.keys()
+        return set(candidates)
+
+    def free_slots(self, doctor=None, specialization=None, clinic=None, after=None, limit=10):
+        """
+        Return up to ``limit`` ``(datetime, doctor_id)`` pairs in time order,
+        starting strictly after ``after`` (default: now).
+        """
+        now = timezone.now()
+        after = max(after or now, now)
+        for _ in range(RECHECK_ROUNDS):
+            with self._lock:
+                streams = []
+                for doctor_id in self.doctors_for(doctor, specialization, clinic):
+                    free = self._free.get(doctor_id)
+                    if not free:
+                        continue
+                    i = bisect.bisect_right(free, after)
+                    slots = self._unheld(doctor_id, free, i, now)
+                    if clinic is not None:
+                        slots = self._at_clinic(doctor_id, int(clinic), slots)
+                    streams.append(islice(slots, limit))
+                found = list(islice(heapq.merge(*streams), limit))
+            if not self._learn_missed(found, now):
+                return found
+        # Still catching up with another process; offer only what is known to be free.
+        return [(when, doctor_id) for when, doctor_id in found if self.is_free(doctor_id, when)]
+
+    def _learn_missed(self, slots, now):
+        """
+        Apply the scheduled appointments and live holds in the database that
+        overlap ``slots`` but are missing from the index; returns whether there
+        were any.
+        """
+        if not slots:
+            return False
+        doctor_ids = {doctor_id for _, doctor_id in slots}
+        first, last = slots[0][0] - self.slot, max(when for when, _ in slots) + self.slot
+        appointments = Appointment.objects.filter(
+            status='Scheduled', doctor_id__in=doctor_ids,
+            appointment_datetime__gt=first, appointment_datetime__lt=last,
+        ).order_by().values_list('id', 'doctor_id', 'appointment_datetime')
+        offered = {(doctor_id, when) for when, doctor_id in slots}
+        holds = SlotHold.objects.filter(
+            doctor_id__in=doctor_ids, starts_at__in={when for when, _ in slots}, expires_at__gt=now,
+        ).order_by().values_list('doctor_id', 'starts_at', 'expires_at')
+        missed = False
+        with self._lock:
+            for appointment_id, doctor_id, when in appointments:
+                if self._appointments.get(appointment_id) != (doctor_id, when):
+                    self.appointment_changed(appointment_id, doctor_id, when, 'Scheduled')
+                    missed = True
+            for doctor_id, when, expires_at in holds:
+                # Offered slots have no live hold in the index, so any found here was missed.
+                if (doctor_id, when) in offered:
+                    self._holds[(doctor_id, when)] = expires_at
+                    missed = True
+        return missed
+
+    async def afree_slots(self, **filters):
+        """
+        ``free_slots`` for async views. The lookup runs in a worker thread: the
+        lock can be held by a rebuild that is querying the database, which must
+        not stall the event loop, and a rebuild cannot run on the loop itself.
+        """
+        return await sync_to_async(self.free_slots)(**filters)
+
+    def _unheld(self, doctor_id, free, start, now):
+        for i in range(start, len(free)):
+            expires_at = self._holds.get((doctor_id, free[i]))
+            if expires_at is None or expires_at <= now:
+                yield free[i], doctor_id
+
+    def _at_clinic(self, doctor_id, clinic_id, slots):
+        # Hours not tied to a clinic count for every clinic the doctor belongs to.
+        hours = self._hours[doctor_id]
+        for when, _ in slots:
+            interval = hours.covering(when, when + self.slot)
+            if interval is not None and interval[2] in (None, clinic_id):
+                yield when, doctor_id
+
+    def is_available(self, doctor_id, start, end=None, clinic=None):
+        """
+        Whether ``doctor_id`` works through all of ``[start, end)`` (one slot by
+        default), at ``clinic`` if given. Bookings and holds are not considered.
+        """
+        end = end or start + self.slot
+        with self._lock:
+            self._ensure_built()
+            hours = self._hours.get(int(doctor_id))
+            if hours is None:
+                return False
+            for _, interval_end, clinic_id in hours.containing(start):
+                if interval_end >= end and (clinic is None or clinic_id in (None, int(clinic))):
+                    return True
+            return False
+
+    def is_slot(self, doctor_id, when, clinic=None):
+        """
+        Whether a slot of ``doctor_id``'s working hours starts at ``when``,
+        booked or not, at ``clinic`` if given.
+        """
+        with self._lock:
+            self._ensure_built()
+            hours = self._hours.get(int(doctor_id))
+            if hours is None:
+                return False
+            return any(when + self.slot <= end and (when - start) % self.slot == timedelta(0)
+                       and (clinic is None or clinic_id in (None, int(clinic)))
+                       for start, end, clinic_id in hours.containing(when))
+
+    def working_hours(self, doctor_id, start, end):
+        """``(start, end, clinic_id)`` for the hours of ``doctor_id`` overlapping ``[start, end)``."""
+        with self._lock:
+            self._ensure_built()
+            hours = self._hours.get(int(doctor_id))
+            return hours.overlapping(start, end) if hours is not None else []
+
+    def is_free(self, doctor_id, when):
+        with self._lock:
+            self._ensure_built()
+            free = self._free.get(int(doctor_id), [])
+            i = bisect.bisect_left(free, when)
+            if i == len(free) or free[i] != when:
+                return False
+            expires_at = self._holds.get((int(doctor_id), when))
+            return expires_at is None or expires_at <= timezone.now()
+
+
+slot_index = SlotIndex()
+
+
+def next_free_slots(doctor_ids):
+    """
+    The first free slot from now on of each of ``doctor_ids`` within the
+    horizon, or ``None``. Read from the database rather than ``slot_index``, so
+    the answer is current in any process; holds are ignored as they expire
+    within minutes.
+    """
+    index = SlotIndex()
+    now = timezone.now()
+    start, end = index._horizon(timezone.localdate())
+    index._load(start, end, doctor_ids)
+    first = {}
+    for doctor_id in doctor_ids:
+        index._build_hours(doctor_id, start.date(), end.date())
+        free = index._free[doctor_id]
+        i = bisect.bisect_right(free, now)
+        first[doctor_id] = free[i] if i < len(free) else None
+    return first
@@ -0,0 +1,130 @@
+"""
+Incrementally maintained doctor dashboard counters.
+
+Every appointment create, update and delete adjusts the affected doctor's
+``DoctorStats`` row with ``F()`` updates in the same transaction, so the
+dashboard reads its numbers with a single lookup by ``doctor_id``. Writes that
+bypass signals (``bulk_create``, ``QuerySet.update``) can be reconciled with
+``manage.py rebuild_doctor_stats``.
+"""
+
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Appointment, DoctorPatient, DoctorStats
+
+
+TRACKED_FIELDS = ('doctor_id', 'patient_id', 'appointment_datetime', 'status')
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    return start, start + timedelta(days=1)
+
+
+def _contribution(stats_date, when, status):
+    """``(today, upcoming)`` increments one appointment adds to stats dated ``stats_date``."""
+    if status != 'Scheduled' or when is None:
+        return 0, 0
+    day = timezone.localdate(when)
+    return int(day == stats_date), int(day >= stats_date)
+
+
+def refresh(doctor_id, today=None):
+    """Recompute every counter for ``doctor_id`` from the appointments table."""
+    today = today or timezone.localdate()
+    start, end = _day_bounds(today)
+    appointments = Appointment.objects.filter(doctor_id=doctor_id)
+
+    counts = appointments.aggregate(
+        today=Count('id', filter=Q(status='Scheduled', appointment_datetime__gte=start,
+                                   appointment_datetime__lt=end)),
+        upcoming=Count('id', filter=Q(status='Scheduled', appointment_datetime__gte=start)),
+    )
+    per_patient = appointments.values_list('patient_id').annotate(n=Count('id')).order_by()
+
+    DoctorPatient.objects.filter(doctor_id=doctor_id).delete()
+    DoctorPatient.objects.bulk_create([
+        DoctorPatient(doctor_id=doctor_id, patient_id=patient_id, appointment_count=n)
+        for patient_id, n in per_patient
+    ])
+    stats, _ = DoctorStats.objects.update_or_create(doctor_id=doctor_id, defaults={
+        'stats_date': today,
+        'today_count': counts['today'],
+        'upcoming_count': counts['upcoming'],
+        'total_patients': len(per_patient),
+    })
+    return stats
+
+
+def for_doctor(doctor_id):
+    """Current counters for ``doctor_id``; one query unless the row is missing or from an earlier day."""
+    stats = DoctorStats.objects.filter(doctor_id=doctor_id).first()
+    if stats is None or stats.stats_date != timezone.localdate():
+        stats = refresh(doctor_id)
+    return stats
+
+
+async def afor_doctor(doctor_id):
+    stats = await DoctorStats.objects.filter(doctor_id=doctor_id).afirst()
+    if stats is None or stats.stats_date != timezone.localdate():
+        stats = await sync_to_async(refresh)(doctor_id)
+    return stats
+
+
+def _apply(doctor_id, today_delta, upcoming_delta, patients_delta):
+    if today_delta or upcoming_delta or patients_delta:
+        DoctorStats.objects.filter(doctor_id=doctor_id).update(
+            today_count=F('today_count') + today_delta,
+            upcoming_count=F('upcoming_count') + upcoming_delta,
+            total_patients=F('total_patients') + patients_delta,
+        )
+
+
+def _remove(doctor_id, patient_id, when, status):
+    stats = DoctorStats.objects.filter(doctor_id=doctor_id).first()
+    if stats is None:
+        return
+    today_delta, upcoming_delta = _contribution(stats.stats_date, when, status)
+
+    pair = DoctorPatient.objects.filter(doctor_id=doctor_id, patient_id=patient_id)
+    pair.update(appointment_count=F('appointment_count') - 1)
+    lost_patient = pair.filter(appointment_count=0).delete()[0]
+    _apply(doctor_id, -today_delta, -upcoming_delta, -lost_patient)
+
+
+def _add(doctor_id, patient_id, when, status):
+    stats = DoctorStats.objects.filter(doctor_id=doctor_id).first()
+    if stats is None:
+        refresh(doctor_id)
+        return
+    today_delta, upcoming_delta = _contribution(stats.stats_date, when, status)
+
+    pair, created = DoctorPatient.objects.get_or_create(
+        doctor_id=doctor_id, patient_id=patient_id, defaults={'appointment_count': 1})
+    if not created:
+        DoctorPatient.objects.filter(pk=pair.pk).update(appointment_count=F('appointment_count') + 1)
+    _apply(doctor_id, today_delta, upcoming_delta, int(created))
+
+
+def appointment_saved(instance, created):
+    new = {field: getattr(instance, field) for field in TRACKED_FIELDS}
+    old = None if created else getattr(instance, '_loaded_values', {})
+    if old is not None and any(field not in old for field in TRACKED_FIELDS):
+        # Saved through an instance that was never (fully) loaded; we cannot tell what changed.
+        refresh(instance.doctor_id)
+    elif old is None:
+        _add(*(new[field] for field in TRACKED_FIELDS))
+    elif any(old[field] != new[field] for field in TRACKED_FIELDS):
+        _remove(*(old[field] for field in TRACKED_FIELDS))
+        _add(*(new[field] for field in TRACKED_FIELDS))
+
+
+def appointment_deleted(instance):
+    state = getattr(instance, '_loaded_values', {})
+    if any(field not in state for field in TRACKED_FIELDS):
+        state = {field: getattr(instance, field) for field in TRACKED_FIELDS}
+    _remove(*(state[field] for field in TRACKED_FIELDS))
@@ -0,0 +1,173 @@
+"""
+Database-backed queue for work that should not hold up a request.
+
+Functions decorated with ``@task`` are queued with ``fn.enqueue(**kwargs)``,
+which inserts a ``Task`` row in the caller's transaction: a booking that rolls
+back takes its notifications with it, and nothing runs before the data it
+refers to is committed. ``manage.py run_worker`` claims due rows in batches
+with a single ``UPDATE`` (so several workers never claim the same row), runs
+them on a thread pool, and retries failures with exponential backoff. A claim
+is a lease; rows whose worker died are picked up again once it expires.
+"""
+
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Task
+
+
+logger = logging.getLogger('clinic.tasks')
+
+LEASE = timedelta(seconds=getattr(settings, 'CLINIC_TASK_LEASE', 300))
+RETRY_DELAY = timedelta(seconds=getattr(settings, 'CLINIC_TASK_RETRY_DELAY', 30))
+KEEP_FINISHED = timedelta(days=getattr(settings, 'CLINIC_TASK_KEEP_DAYS', 7))
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05
+
+# name -> TaskFunction
+registry = {}
+
+
+class TaskFunction:
+
+    def __init__(self, func, name, max_attempts, bind):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.bind = bind
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def enqueue(self, run_at=None, **kwargs):
+        """Queue a call with JSON-serializable ``kwargs``, due now or at ``run_at``."""
+        return Task.objects.create(name=self.name, kwargs=kwargs, run_at=run_at or timezone.now(),
+                                   max_attempts=self.max_attempts)
+
+
+def task(func=None, *, name=None, max_attempts=3, bind=False):
+    """Register ``func`` as a task. With ``bind=True`` it receives its ``Task`` row first."""
+    def register(func):
+        task_function = TaskFunction(func, name or f'{func.__module__}.{func.__qualname__}', max_attempts, bind)
+        registry[task_function.name] = task_function
+        return task_function
+    return register(func) if func is not None else register
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def requeue_expired(now=None):
+    """Put running tasks whose lease ran out back in the queue."""
+    return Task.objects.filter(status='running', locked_until__lt=now or timezone.now()).update(
+        status='queued', locked_by='', locked_until=None)
+
+
+def claim(worker, limit):
+    """Lease up to ``limit`` due tasks to ``worker`` and return them, oldest first."""
+    now = timezone.now()
+    due = Task.objects.filter(status='queued', run_at__lte=now).order_by('run_at', 'id').values('id')[:limit]
+    # One statement, so concurrent workers cannot both claim a row.
+    claimed = Task.objects.filter(id__in=due, status='queued').update(
+        status='running', locked_by=worker, locked_until=now + LEASE)
+    if not claimed:
+        return []
+    return list(Task.objects.filter(status='running', locked_by=worker).order_by('run_at', 'id'))
+
+
+def _renew_lease(row):
+    Task.objects.filter(pk=row.pk).update(locked_until=timezone.now() + LEASE)
+
+
+def _run(task_function, row):
+    args = (row,) if task_function.bind else ()
+    for attempt in range(BUSY_RETRIES):
+        started = False
+        try:
+            with transaction.atomic():
+                # Writing first takes SQLite's write lock before the task reads
+                # anything, so the body cannot fail to turn a read transaction
+                # into a write after another thread committed.
+                _renew_lease(row)
+                started = True
+                return task_function(*args, **row.kwargs)
+        except OperationalError:
+            # Only waiting for the lock is retried here: once the body has run it
+            # may have sent email, so later errors fail the attempt as usual.
+            if started or attempt == BUSY_RETRIES - 1:
+                raise
+            time.sleep(BUSY_BACKOFF * 2 ** attempt)
+
+
+def execute(row):
+    """Run one claimed task and record the outcome."""
+    task_function = registry.get(row.name)
+    try:
+        if task_function is None:
+            raise LookupError(f'Unknown task {row.name!r}')
+        _run(task_function, row)
+    except Exception:
+        _failed(row, traceback.format_exc())
+        return False
+    Task.objects.filter(pk=row.pk).update(status='done', attempts=row.attempts + 1, locked_by='',
+                                          locked_until=None, last_error='', finished_at=timezone.now())
+    return True
+
+
+def _execute_in_thread(row):
+    # Pool threads keep their connections between tasks, like requests under CONN_MAX_AGE.
+    close_old_connections()
+    try:
+        return execute(row)
+    finally:
+        close_old_connections()
+
+
+def _failed(row, error):
+    attempts = row.attempts + 1
+    update = {'attempts': attempts, 'locked_by': '', 'locked_until': None, 'last_error': error}
+    if attempts >= row.max_attempts:
+        logger.error('Task %s (%s) failed after %d attempts:\n%s', row.pk, row.name, attempts, error)
+        update.update(status='failed', finished_at=timezone.now())
+    else:
+        logger.warning('Task %s (%s) failed, retrying:\n%s', row.pk, row.name, error)
+        update.update(status='queued', run_at=timezone.now() + RETRY_DELAY * 2 ** (attempts - 1))
+    Task.objects.filter(pk=row.pk).update(**update)
+
+
+def run_batch(worker, limit, executor=None):
+    """Claim and run one batch; returns the number of tasks run."""
+    rows = claim(worker, limit)
+    if executor is None:
+        for row in rows:
+            execute(row)
+    else:
+        list(executor.map(_execute_in_thread, rows))
+    return len(rows)
+
+
+def run_pending(limit=100, threads=0):
+    """Run every due task, on a thread pool when ``threads`` is set. Used by tests and ``run_worker --once``."""
+    worker, total = worker_id(), 0
+    with ThreadPoolExecutor(max_workers=threads) if threads else nullcontext() as executor:
+        while count := run_batch(worker, limit, executor):
+            total += count
+    return total
+
+
+def purge(now=None):
+    """Delete finished tasks older than ``KEEP_FINISHED``."""
+    cutoff = (now or timezone.now()) - KEEP_FINISHED
+    return Task.objects.filter(status__in=('done', 'failed'), finished_at__lt=cutoff).delete()[0]
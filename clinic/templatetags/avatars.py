@@ -0,0 +1,36 @@
+from django import template
+from django.utils.html import format_html
+
+
+register = template.Library()
+
+
+def _srcset(storage, variants):
+    return ', '.join(f'{storage.url(name)} {width}w' for width, name in variants)
+
+
+@register.simple_tag
+def avatar(user, size=100, alt='', lazy=True):
+    """
+    ``<img>`` for ``user``'s avatar displayed at ``size`` CSS pixels. When
+    resized variants exist the browser picks one through ``srcset``,
+    preferring WebP; otherwise the original file is used.
+    """
+    loading = 'lazy' if lazy else 'eager'
+    field = user.avatar
+    variants = user.avatar_variants or {}
+    if not field or not variants.get('webp') or variants.get('source') != field.name:
+        return format_html('<img src="{}" alt="{}" width="{}" height="{}" loading="{}">',
+                           field.url if field else '', alt, size, size, loading)
+
+    storage = field.storage
+    fallback = variants['fallback']
+    # Without srcset support, the smallest variant that still fills the box.
+    src = next((name for width, name in fallback if width >= size), fallback[-1][1])
+    sizes = f'{size}px'
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" width="{}" height="{}" loading="{}"></picture>',
+        _srcset(storage, variants['webp']), sizes,
+        storage.url(src), _srcset(storage, fallback), sizes, alt, size, size, loading,
+    )
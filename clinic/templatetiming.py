@@ -0,0 +1,135 @@
+"""
+Per-request template render timing.
+
+With ``CLINIC_TEMPLATE_TIMING`` on, ``TemplateTimingMiddleware`` wraps
+``Template.render``, which Django calls for the template a response renders and
+for every ``{% include %}`` inside it (an extended parent counts towards its
+child). Each request logs one line to ``clinic.templates`` listing how often
+every template was rendered, its total time and its self time, i.e. without
+the includes it rendered, so the includes worth turning into ``{% cache %}``
+fragments stand out. Running totals per template are kept in ``template_stats``.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.template.base import Template
+
+
+logger = logging.getLogger('clinic.templates')
+
+_recorder = ContextVar('clinic_template_recorder', default=None)
+_original_render = Template.render
+
+
+def template_name(template):
+    return template.origin.template_name or template.origin.name
+
+
+class RenderRecorder:
+
+    def __init__(self):
+        # name -> [renders, seconds, seconds outside nested templates]
+        self.templates = defaultdict(lambda: [0, 0.0, 0.0])
+        self.total_time = 0.0
+        self._nested = []  # time spent in includes, one entry per template being rendered
+
+    def render(self, template, context):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            return _original_render(template, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            else:
+                self.total_time += elapsed
+            entry = self.templates[template_name(template)]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += elapsed - nested
+
+    def summary(self):
+        """The templates rendered, slowest first, as one line."""
+        parts = []
+        for name, (renders, total, own) in sorted(self.templates.items(), key=lambda item: -item[1][1]):
+            count = f' x{renders}' if renders > 1 else ''
+            parts.append(f'{name}{count} {total * 1000:.1f} ms (self {own * 1000:.1f} ms)')
+        return ', '.join(parts)
+
+
+def _render(self, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return _original_render(self, context)
+    return recorder.render(self, context)
+
+
+def install():
+    """Route ``Template.render`` through the active recorder, if any. Safe to call repeatedly."""
+    global _original_render
+    if Template.render is not _render:
+        _original_render = Template.render
+        Template.render = _render
+
+
+@contextmanager
+def record_renders():
+    install()
+    recorder = RenderRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+# template name -> {'renders', 'time', 'self_time'}
+template_stats = defaultdict(lambda: {'renders': 0, 'time': 0.0, 'self_time': 0.0})
+
+
+class TemplateTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CLINIC_TEMPLATE_TIMING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with record_renders() as recorder:
+            response = self.get_response(request)
+        return self.process(request, response, recorder)
+
+    async def __acall__(self, request):
+        with record_renders() as recorder:
+            response = await self.get_response(request)
+        return self.process(request, response, recorder)
+
+    def process(self, request, response, recorder):
+        if not recorder.templates:
+            return response
+        for name, (renders, total, own) in recorder.templates.items():
+            stats = template_stats[name]
+            stats['renders'] += renders
+            stats['time'] += total
+            stats['self_time'] += own
+
+        match = getattr(request, 'resolver_match', None)
+        logger.info('%s rendered in %.1f ms: %s', match.url_name if match else request.path,
+                    recorder.total_time * 1000, recorder.summary())
+        response['X-Template-Time'] = f'{recorder.total_time * 1000:.1f}ms'
+        return response
@@ -1,3 +1,1855 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time as clock
+from datetime import datetime, time, timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.exceptions import ValidationError
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.http import Http404
+from django.template import engines
+from django.template.loaders.cached import Loader as CachedLoader
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    analytics, assets, auth, booking, catalog, dashboards, db, directory, events, geo, ical, images, notifications, pagination, querybudget,
+    search, stats, tasks, templatetiming, urls,
+)
+from .intervals import IntervalTree
+from .models import (
+    Appointment, Availability, AvailabilityException, CalendarTombstone, Clinic, DoctorFacet, DoctorProfile, DoctorStats, Reminder,
+    SlotHold, Specialization, Task, User,
+)
+from .querybudget import QueryBudgetMixin
+from .slots import WEEKDAYS, slot_index
+
+
+# Figures from the stress tests, shown on every run (see LOGGING in settings).
+logger = logging.getLogger('clinic.tests')
+
+
+def next_slot(days=1, hour=9, minute=0):
+    day = timezone.localdate() + timedelta(days=days)
+    return timezone.make_aware(datetime(day.year, day.month, day.day, hour, minute))
+
+
+class BookingTests(TestCase):
+
+    def setUp(self):
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.alice = User.objects.create(username='alice', email='alice@example.com', name='Alice')
+        self.bob = User.objects.create(username='bob', email='bob@example.com', name='Bob')
+        self.clinic = Clinic.objects.create(name='Central')
+        self.clinic.doctors.add(self.doctor)
+        for day in WEEKDAYS:
+            Availability.objects.create(doctor=self.doctor, day=day, start_time=time(9), end_time=time(17))
+        slot_index.reset()
+
+    def test_second_booking_of_slot_is_rejected(self):
+        when = next_slot()
+        booking.book(self.alice, self.clinic, self.doctor, when, 'Checkup')
+        with self.assertRaises(booking.SlotUnavailable):
+            booking.book(self.bob, self.clinic, self.doctor, when, 'Checkup')
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_hold_blocks_other_patients_until_it_expires(self):
+        when = next_slot()
+        booking.place_hold(self.alice, self.doctor.id, when)
+        with self.assertRaises(booking.SlotUnavailable):
+            booking.place_hold(self.bob, self.doctor.id, when)
+        with self.assertRaises(booking.SlotUnavailable):
+            booking.book(self.bob, self.clinic, self.doctor, when, 'Checkup')
+
+        SlotHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        booking.place_hold(self.bob, self.doctor.id, when)
+        self.assertEqual(SlotHold.objects.get().patient, self.bob)
+
+    def test_cancelled_slot_can_be_booked_again(self):
+        when = next_slot()
+        appointment = booking.book(self.alice, self.clinic, self.doctor, when, 'Checkup')
+        appointment.status = 'Cancelled'
+        appointment.save()
+        booking.place_hold(self.bob, self.doctor.id, when)
+        booking.book(self.bob, self.clinic, self.doctor, when, 'Checkup')
+        self.assertEqual(Appointment.objects.filter(appointment_datetime=when, status='Scheduled').get().patient,
+                         self.bob)
+        # Only one appointment that is not cancelled per slot.
+        appointment.status = 'Scheduled'
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            appointment.save()
+
+    def test_holds_are_limited_to_future_slots(self):
+        for when in (next_slot(days=-1), next_slot(hour=9, minute=10), next_slot(hour=18)):
+            with self.assertRaises(booking.InvalidSlot):
+                booking.place_hold(self.alice, self.doctor.id, when)
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_holds_per_patient_are_capped(self):
+        slots = [next_slot(hour=9 + i) for i in range(booking.MAX_HOLDS + 1)]
+        for when in slots[:-1]:
+            booking.place_hold(self.alice, self.doctor.id, when)
+        with self.assertRaises(booking.TooManyHolds):
+            booking.place_hold(self.alice, self.doctor.id, slots[-1])
+        # Renewing a hold does not count against the cap, and released or expired holds free it up.
+        booking.place_hold(self.alice, self.doctor.id, slots[0])
+        booking.release_hold(self.alice, self.doctor.id, slots[0])
+        booking.place_hold(self.alice, self.doctor.id, slots[-1])
+        SlotHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        booking.place_hold(self.alice, self.doctor.id, slots[0])
+
+        self.client.force_login(self.bob)
+        response = self.client.post(reverse('hold_slot'), {
+            'doctor': self.doctor.id, 'appointment_date': next_slot().strftime('%Y-%m-%d'), 'appointment_time': '09:15'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_booking_consumes_own_hold(self):
+        when = next_slot()
+        booking.place_hold(self.alice, self.doctor.id, when)
+        booking.book(self.alice, self.clinic, self.doctor, when, 'Checkup')
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_conflicting_post_shows_message_instead_of_error(self):
+        when = next_slot()
+        booking.book(self.alice, self.clinic, self.doctor, when, 'Checkup')
+        self.client.force_login(self.bob)
+        response = self.client.post('/book-appointment/', {
+            'clinic': self.clinic.id,
+            'doctor': self.doctor.id,
+            'appointment_date': when.strftime('%Y-%m-%d'),
+            'appointment_time': when.strftime('%H:%M'),
+            'reason': 'Checkup',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('That slot has just been taken. Please choose another time.',
+                      [str(m) for m in response.context['messages']])
+
+    def test_only_real_slots_can_be_booked(self):
+        when = next_slot(hour=10)
+        booking.book(self.alice, self.clinic, self.doctor, when, 'Checkup')
+        elsewhere = Clinic.objects.create(name='Elsewhere')
+        for bad_clinic, bad_when in ((self.clinic, when + timedelta(minutes=10)),  # overlaps the 10:00 booking
+                                     (self.clinic, next_slot(hour=3, minute=17)),  # outside the doctor's hours
+                                     (self.clinic, next_slot(days=-1, hour=10)),
+                                     (elsewhere, next_slot(hour=11))):
+            with self.assertRaises(booking.InvalidSlot):
+                booking.book(self.bob, bad_clinic, self.doctor, bad_when, 'Checkup')
+        self.assertEqual(Appointment.objects.count(), 1)
+
+        self.client.force_login(self.bob)
+        response = self.client.post('/book-appointment/', {
+            'clinic': self.clinic.id, 'doctor': self.doctor.id, 'reason': 'Checkup',
+            'appointment_date': when.strftime('%Y-%m-%d'), 'appointment_time': '10:10',
+        })
+        self.assertIn('The doctor has no appointment starting at that time at this clinic.',
+                      [str(m) for m in response.context['messages']])
+
+        self.client.force_login(self.alice)
+        appointment = Appointment.objects.get()
+        data = {'clinic': self.clinic.id, 'doctor': self.doctor.id, 'reason': 'Checkup',
+                'appointment_datetime': (when + timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M')}
+        response = self.client.post(f'/update-appointment/{appointment.pk}/', data)
+        self.assertContains(response, 'The doctor has no appointment starting at that time at this clinic.')
+        data['appointment_datetime'] = (when + timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M')
+        self.assertRedirects(self.client.post(f'/update-appointment/{appointment.pk}/', data),
+                             '/my-appointments/', fetch_redirect_response=False)
+        appointment.refresh_from_db()
+        self.assertEqual(appointment.appointment_datetime, when + timedelta(minutes=30))
+
+
+class BookingStressTest(TransactionTestCase):
+    THREADS = 16
+    SLOTS = 10
+
+    def test_parallel_bookings_at_one_doctor(self):
+        doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        clinic = Clinic.objects.create(name='Central')
+        clinic.doctors.add(doctor)
+        for day in WEEKDAYS:
+            Availability.objects.create(doctor=doctor, day=day, start_time=time(9), end_time=time(17))
+        slot_index.reset()
+        patients = [
+            User.objects.create(username=f'p{i}', email=f'p{i}@example.com', name=f'Patient {i}')
+            for i in range(self.THREADS)
+        ]
+        slots = [next_slot(hour=9, minute=0) + timedelta(minutes=30 * i) for i in range(self.SLOTS)]
+        results = {'booked': 0, 'conflicts': 0, 'busy': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(self.THREADS)
+
+        def worker(patient, offset):
+            start.wait()
+            try:
+                for i in range(self.SLOTS):
+                    when = slots[(i + offset) % self.SLOTS]
+                    try:
+                        booking.book(patient, clinic, doctor, when, 'Stress test')
+                        outcome = 'booked'
+                    except booking.SlotUnavailable:
+                        outcome = 'conflicts'
+                    except booking.BookingBusy:
+                        outcome = 'busy'
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(patient, i)) for i, patient in enumerate(patients)]
+        began = clock.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = clock.perf_counter() - began
+
+        attempts = self.THREADS * self.SLOTS
+        summary = (f"{attempts} bookings in {elapsed:.2f}s ({attempts / elapsed:.0f}/s), "
+                   f"conflict rate {results['conflicts'] / attempts:.0%}, busy {results['busy']}")
+        self.assertEqual(results['booked'], self.SLOTS, summary)
+        self.assertEqual(Appointment.objects.filter(doctor=doctor).count(), self.SLOTS, summary)
+        logger.info('Booking stress test: %s', summary)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.cardiology = Specialization.objects.create(name='Cardiology')
+        self.heart = Clinic.objects.create(name='Heart Centre', specialization=self.cardiology,
+                                           description='Cardiac imaging and rehabilitation')
+        self.skin = Clinic.objects.create(name='Skin Care', description='Dermatology for the whole family')
+
+    def test_prefix_match_is_ranked_by_name_first(self):
+        Clinic.objects.create(name='Downtown', description='Walk-in heart screening')
+        results = search.search_clinics('hea')
+        self.assertEqual(results.count(), 2)
+        self.assertEqual(results[0], self.heart)
+
+    def test_index_follows_saves_and_deletes(self):
+        self.cardiology.name = 'Cardiac Surgery'
+        self.cardiology.save()
+        self.assertEqual(list(search.search_clinics('surgery')[:10]), [self.heart])
+
+        self.cardiology.delete()
+        self.assertEqual(search.search_clinics('surgery').count(), 0)
+        self.assertEqual(list(search.search_specializations('card')[:10]), [])
+
+        self.skin.delete()
+        self.assertEqual(search.search_clinics('dermatology').count(), 0)
+
+    def test_search_endpoint_paginates_and_includes_description(self):
+        for i in range(25):
+            Clinic.objects.create(name=f'Family Practice {i}')
+        data = self.client.get('/search/', {'q': 'family', 'page': 2}).json()
+        self.assertEqual(data['count'], 26)
+        self.assertEqual(data['num_pages'], 2)
+        self.assertEqual(len(data['clinics']), 6)
+        self.assertIn('description', data['clinics'][0])
+
+
+class AppointmentListingTests(TestCase):
+
+    def setUp(self):
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        clinic = Clinic.objects.create(name='Central')
+        for i in range(45):
+            Appointment.objects.create(
+                patient=self.patient, doctor=self.doctor, clinic=clinic,
+                appointment_datetime=next_slot(days=i % 15 - 7, hour=9 + i // 15), reason=f'Visit {i}',
+                status='Completed' if i % 3 == 0 else 'Scheduled',
+            )
+
+    def test_cursor_walks_every_appointment_once(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = pagination.keyset_page(Appointment.objects.all(), cursor, size=20)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual([a.id for a in seen], list(Appointment.objects.order_by('-appointment_datetime', '-id')
+                                                    .values_list('id', flat=True)))
+
+    def test_load_more_fragment_applies_filters(self):
+        self.client.force_login(self.doctor)
+        response = self.client.get('/doctor/appointments/', {'status': 'Completed'})
+        self.assertEqual(len(response.context['appointments']), 15)
+        self.assertIsNone(response.context['next_cursor'])
+
+        response = self.client.get('/doctor/appointments/')
+        more = self.client.get('/appointments/more/', {'cursor': response.context['next_cursor']})
+        self.assertEqual(more.status_code, 200)
+        self.assertEqual(more.content.count(b'<tr>'), 20)
+        self.assertNotEqual(more['X-Next-Cursor'], '')
+
+        self.assertEqual(self.client.get('/appointments/more/', {'cursor': 'bogus'}).status_code, 400)
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Every route in clinic/urls.py must stay within its declared query budget."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.specialization = Specialization.objects.create(name='Cardiology')
+        cls.doctors = [
+            User.objects.create(username=f'doc{i}', email=f'doc{i}@example.com', role='doctor', name=f'Doc {i}')
+            for i in range(3)
+        ]
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        cls.clinic = Clinic.objects.create(name='Heart Centre', specialization=cls.specialization,
+                                           host=cls.doctors[0], latitude=51.5, longitude=-0.12)
+        cls.clinic.doctors.set(cls.doctors)
+        for doctor in cls.doctors:
+            for day in ('Monday', 'Tuesday', 'Wednesday'):
+                Availability.objects.create(doctor=doctor, day=day, start_time=time(9), end_time=time(12))
+        cls.appointments = [
+            Appointment.objects.create(
+                patient=cls.patient, doctor=cls.doctors[i % 3], clinic=cls.clinic,
+                appointment_datetime=next_slot(days=i - 3, hour=10), reason='Checkup')
+            for i in range(6)
+        ]
+        directory.rebuild()
+
+    def setUp(self):
+        slot_index.reset()
+        cache.clear()
+
+    def test_every_route_declares_a_budget(self):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names - set(urls.QUERY_BUDGETS), set())
+
+    def test_budgets_are_per_method(self):
+        self.assertEqual(querybudget.budget_for('clinic', 'HEAD'), 1)
+        self.assertIsNone(querybudget.budget_for('clinic', 'POST'))
+        self.assertEqual(querybudget.budget_for('login', 'POST'), 5)
+        self.assertIsNone(querybudget.budget_for('hold_slot', 'GET'))
+
+    def test_overruns_fail_the_request(self):
+        with mock.patch.dict(urls.QUERY_BUDGETS, {'clinic': 0}):
+            with self.assertRaisesMessage(querybudget.QueryBudgetExceeded, 'GET clinic ran 1 queries (budget 0)'):
+                self.client.get(reverse('clinic', args=[self.clinic.id]))
+        self.assertGreaterEqual(querybudget.query_stats()['clinic']['requests'], 1)
+
+    def test_public_pages(self):
+        self.assertQueryBudget('login')
+        self.assertQueryBudget('register')
+        self.assertQueryBudget('home')
+        self.assertQueryBudget('home', data={'q': 'heart'})
+        self.assertQueryBudget('search', data={'q': 'heart'})
+        self.assertQueryBudget('clinic', self.clinic.id)
+        self.assertQueryBudget('nearby_clinics', data={'lat': 51.51, 'lng': -0.1})
+        # Nothing nearby: the search widens to the full radius.
+        self.assertQueryBudget('nearby_clinics', data={'lat': 10, 'lng': 10, 'radius': 500,
+                                                       'specialization': self.specialization.id})
+        self.assertQueryBudget('user-profile', self.doctors[0].id)
+        self.assertQueryBudget('cache_stats')
+        self.assertQueryBudget('doctor_calendar', ical.feed_token(self.doctors[0].id))
+        self.assertQueryBudget('logout')
+
+    def test_patient_pages(self):
+        self.client.force_login(self.patient)
+        appointment = self.appointments[-1]
+        self.assertQueryBudget('patient_dashboard')
+        self.assertQueryBudget('book_appointment')
+        self.assertQueryBudget('patient_appointments')
+        self.assertQueryBudget('appointments_more')
+        self.assertQueryBudget('patient_settings')
+        self.assertQueryBudget('update-appointment', appointment.id)
+        self.assertQueryBudget('delete-appointment', appointment.id)
+        self.assertQueryBudget('update-user')
+        self.assertQueryBudget('doctor_list')
+        self.assertQueryBudget('doctor_availability', self.doctors[1].id)
+        self.assertQueryBudget('doctor_directory')
+        self.assertQueryBudget('doctor_directory', data={'clinic': self.clinic.id, 'day': 'Monday'})
+        self.assertQueryBudget('doctor_directory', data={'specialization': self.specialization.id, 'offset': 1})
+        self.assertQueryBudget('free_slots', data={'specialization': self.specialization.id})
+        self.assertQueryBudget('slot_events', data={'doctor': self.doctors[1].id})
+        monday = timezone.localdate() + timedelta(days=1)
+        while monday.weekday() != 0:
+            monday += timedelta(days=1)
+        response = self.assertQueryBudget('hold_slot', method='post', data={
+            'doctor': self.doctors[0].id,
+            'appointment_date': monday.strftime('%Y-%m-%d'),
+            'appointment_time': '09:30',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget('logout')
+
+    def test_doctor_pages(self):
+        self.client.force_login(self.doctors[0])
+        self.assertQueryBudget('doctor_dashboard')
+        self.assertQueryBudget('doctor_appointments')
+        self.assertQueryBudget('doctor_settings')
+        self.assertQueryBudget('set_availability')
+        self.assertQueryBudget('clinic_analytics', self.clinic.id)
+        self.assertQueryBudget('create-clinic')
+        self.assertQueryBudget('update-clinic', self.clinic.id)
+        self.assertQueryBudget('export', 'appointment')
+        self.assertQueryBudget('delete-clinic', self.clinic.id)
+
+
+class QueryPlanTests(TestCase):
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' / '.join(row[-1] for row in cursor.fetchall())
+
+    def test_unindexed_filter_is_reported(self):
+        sql, params = Clinic.objects.filter(description='Walk-in').query.sql_with_params()
+        self.assertEqual(querybudget.full_scans(sql, params), ['clinic_clinic'])
+        sql, params = Specialization.objects.all().query.sql_with_params()
+        self.assertEqual(querybudget.full_scans(sql, params), [])
+
+    def test_hot_queries_use_composite_indexes(self):
+        now = timezone.now()
+        self.assertIn('appointment_patient_time_idx',
+                      self.plan(Appointment.objects.filter(patient_id=1).order_by('-appointment_datetime', '-id')))
+        self.assertIn('appointment_doctor_status_idx', self.plan(Appointment.objects.filter(
+            doctor_id=1, status='Scheduled', appointment_datetime__gte=now)))
+        self.assertIn('appointment_scheduled_idx', self.plan(Appointment.objects.filter(
+            status='Scheduled', appointment_datetime__gte=now, appointment_datetime__lt=now + timedelta(days=14))
+            .values_list('doctor_id', 'appointment_datetime')))
+        self.assertIn('user_role_active_idx', self.plan(User.objects.filter(role='doctor', is_active=True)))
+
+
+class BenchmarkToolingTests(TestCase):
+
+    def test_seed_data_and_view_benchmark(self):
+        call_command('seed_data', clinics=2, doctors=3, patients=10, appointments=60, past_days=30,
+                     future_days=14, stdout=StringIO())
+        self.assertEqual(Appointment.objects.count(), 60)
+        self.assertEqual(DoctorStats.objects.filter(doctor__email__endswith='@seed.example').count(), 3)
+        with self.assertRaises(CommandError):
+            call_command('seed_data', stdout=StringIO())
+        Reminder.objects.create(appointment=Appointment.objects.first(), kind='24h')
+        call_command('seed_data', clinics=2, doctors=3, patients=10, appointments=60, past_days=30,
+                     future_days=14, flush=True, stdout=StringIO())
+        self.assertEqual(Appointment.objects.count(), 60)
+        self.assertFalse(Reminder.objects.exists())
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'views.json')
+        call_command('benchmark_views', iterations=2, warmup=0, baseline=baseline, save_baseline=True,
+                     stdout=StringIO())
+        with open(baseline) as f:
+            results = json.load(f)
+        self.assertEqual(set(results), {pattern.name for pattern in urls.urlpatterns})
+        self.assertEqual({name for name, r in results.items() if r['status'] >= 400}, set())
+
+        results['home']['queries'] = -1
+        with open(baseline, 'w') as f:
+            json.dump(results, f)
+        stderr = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('benchmark_views', route=['home'], iterations=2, warmup=0, baseline=baseline,
+                         stdout=StringIO(), stderr=stderr)
+        self.assertIn('home: ', stderr.getvalue())
+
+
+@tasks.task(name='tests.always_fails', max_attempts=2)
+def always_fails():
+    raise RuntimeError('mail server down')
+
+
+@tasks.task(name='tests.emails_then_fails')
+def emails_then_fails():
+    mail.send_mail('Sent once', '', None, ['pat@example.com'])
+    raise OperationalError('database is locked')
+
+
+class TaskQueueTests(TestCase):
+
+    def setUp(self):
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        self.clinic = Clinic.objects.create(name='Central')
+        tasks.run_pending()  # the new doctor's directory profile
+
+    def book(self, when):
+        return Appointment.objects.create(doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+                                          appointment_datetime=when, reason='Checkup')
+
+    def test_booking_changes_and_cancellation_email_through_the_worker(self):
+        appointment = self.book(next_slot(days=3))
+        self.assertEqual(len(mail.outbox), 0)
+        # The emails, and the doctor's next free slot in the directory.
+        self.assertEqual(tasks.run_pending(), 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['doc@example.com', 'pat@example.com'])
+
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.reason = 'Just the reason'
+        appointment.save()
+        appointment.appointment_datetime = next_slot(days=4)
+        appointment.save()
+        self.assertEqual(tasks.run_pending(), 2)
+        appointment.delete()
+        self.assertEqual(tasks.run_pending(), 2)
+        self.assertEqual([m.subject for m in mail.outbox[2:]],
+                         ['Your appointment was updated', 'Your appointment was cancelled', 'Appointment cancelled'])
+        self.assertEqual(Task.objects.filter(status='done', name__startswith='clinic.notifications.').count(), 3)
+
+        self.book(next_slot(days=5))
+        User.objects.filter(pk=self.patient.pk).delete()
+        tasks.run_pending()
+        self.assertEqual(len(mail.outbox), 5)  # the booking, but no cancellation for the deleted patient
+
+    def test_failures_are_retried_with_backoff_then_given_up(self):
+        task = always_fails.enqueue()
+        with self.assertLogs('clinic.tasks', 'WARNING'):
+            self.assertEqual(tasks.run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('queued', 1))
+        self.assertIn('mail server down', task.last_error)
+        self.assertGreater(task.run_at, timezone.now())
+
+        Task.objects.filter(pk=task.pk).update(run_at=timezone.now())
+        with self.assertLogs('clinic.tasks', 'ERROR'):
+            tasks.run_pending()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('failed', 2))
+
+    def test_only_lock_waits_are_retried_at_once(self):
+        task = emails_then_fails.enqueue()
+        locked = OperationalError('database is locked')
+        with mock.patch.object(tasks, '_renew_lease', side_effect=[locked, locked, None]), \
+                self.assertLogs('clinic.tasks', 'WARNING'):
+            tasks.run_pending()
+        # The body ran once, after two waits for the lock, and its failure goes through the backoff.
+        self.assertEqual([m.subject for m in mail.outbox], ['Sent once'])
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('queued', 1))
+        self.assertIn('database is locked', task.last_error)
+
+    def test_expired_leases_are_requeued(self):
+        always_fails.enqueue()
+        [task] = tasks.claim('dead-worker', 10)
+        self.assertEqual(tasks.claim('other-worker', 10), [])
+        Task.objects.filter(pk=task.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(tasks.requeue_expired(), 1)
+        self.assertEqual([t.pk for t in tasks.claim('other-worker', 10)], [task.pk])
+
+    def test_reminders_are_queued_once_per_window(self):
+        now = timezone.now()
+        soon, tomorrow = self.book(now + timedelta(minutes=30)), self.book(now + timedelta(hours=5))
+        self.book(now + timedelta(hours=30))
+        tasks.run_pending()
+        mail.outbox.clear()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(notifications.schedule_reminders(batch_size=1), 2)
+        for query in queries.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                self.assertEqual(querybudget.full_scans(query['sql']), [], query['sql'])
+        self.assertEqual(notifications.schedule_reminders(), 0)
+        self.assertEqual(set(Reminder.objects.values_list('appointment', 'kind')),
+                         {(soon.pk, '1h'), (tomorrow.pk, '24h')})
+
+        self.assertEqual(tasks.run_pending(), 2)
+        self.assertEqual([m.subject for m in mail.outbox], ['Appointment reminder'] * 2)
+        self.assertFalse(Reminder.objects.filter(sent_at=None).exists())
+
+
+class SlotIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        cls.clinic = Clinic.objects.create(name='C')
+        cls.monday = timezone.localdate() + timedelta(days=1)
+        while cls.monday.weekday() != 0:
+            cls.monday += timedelta(days=1)
+        Availability.objects.create(doctor=cls.doctor, day='Monday', start_time=time(9), end_time=time(12))
+
+    def setUp(self):
+        slot_index.reset()
+
+    def at(self, hour, minute=0, day=None):
+        day = day or self.monday
+        return timezone.make_aware(datetime(day.year, day.month, day.day, hour, minute))
+
+    def monday_slots(self):
+        slots = slot_index.free_slots(doctor=self.doctor.id, after=self.at(0), limit=100)
+        return [(when.hour, when.minute) for when, _ in slots if when.date() == self.monday]
+
+    def book(self, hour, minute=0):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Appointment.objects.create(doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+                                              appointment_datetime=self.at(hour, minute), reason='Checkup')
+
+    def test_weekly_hours_expand_into_slots(self):
+        self.assertEqual(self.monday_slots(), [(9, 0), (9, 30), (10, 0), (10, 30), (11, 0), (11, 30)])
+        slots = slot_index.free_slots(doctor=self.doctor.id, limit=100)
+        self.assertEqual([when for when, _ in slots], sorted(when for when, _ in slots))
+        self.assertTrue(all(when.weekday() == 0 for when, _ in slots))
+        horizon = timezone.localdate() + timedelta(days=slot_index.horizon_days)
+        self.assertTrue(all(when.date() < horizon for when, _ in slots))
+        self.assertEqual(slot_index.free_slots(doctor=self.doctor.id, after=self.at(10), limit=1),
+                         [(self.at(10, 30), self.doctor.id)])
+
+    def test_bookings_and_cancellations(self):
+        appointment = self.book(10)
+        self.assertNotIn((10, 0), self.monday_slots())
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.status = 'Cancelled'
+            appointment.save()
+        self.assertIn((10, 0), self.monday_slots())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.status = 'Scheduled'
+            appointment.appointment_datetime = self.at(11)
+            appointment.save()
+        self.assertEqual(self.monday_slots(), [(9, 0), (9, 30), (10, 0), (10, 30), (11, 30)])
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.delete()
+        self.assertEqual(len(self.monday_slots()), 6)
+
+        # A booking off the slot grid blocks both slots it overlaps.
+        self.book(9, 45)
+        self.assertEqual(self.monday_slots(), [(9, 0), (10, 30), (11, 0), (11, 30)])
+
+    def test_holds(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            hold = SlotHold.objects.create(doctor=self.doctor, patient=self.patient, starts_at=self.at(9),
+                                           expires_at=timezone.now() + timedelta(minutes=5))
+        self.assertNotIn((9, 0), self.monday_slots())
+        self.assertFalse(slot_index.is_free(self.doctor.id, self.at(9)))
+        with self.captureOnCommitCallbacks(execute=True):
+            hold.expires_at = timezone.now() - timedelta(seconds=1)
+            hold.save()
+        self.assertIn((9, 0), self.monday_slots())
+        self.assertTrue(slot_index.is_free(self.doctor.id, self.at(9)))
+
+    def test_changes_made_by_another_process(self):
+        self.assertEqual(len(self.monday_slots()), 6)
+        # Without the on-commit callbacks the index is not told, as in another process.
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+                                   appointment_datetime=self.at(9), reason='Checkup')
+        SlotHold.objects.create(doctor=self.doctor, patient=self.patient, starts_at=self.at(9, 30),
+                                expires_at=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(self.monday_slots(), [(10, 0), (10, 30), (11, 0), (11, 30)])
+        # Learned once, later lookups match without further changes.
+        self.assertFalse(slot_index.is_free(self.doctor.id, self.at(9)))
+        self.assertFalse(slot_index.is_free(self.doctor.id, self.at(9, 30)))
+
+
+class AvailabilityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.north = Clinic.objects.create(name='North')
+        cls.south = Clinic.objects.create(name='South')
+        cls.north.doctors.add(cls.doctor)
+        cls.south.doctors.add(cls.doctor)
+        # A Monday far enough out that none of its slots are in the past.
+        cls.monday = timezone.localdate() + timedelta(days=1)
+        while cls.monday.weekday() != 0:
+            cls.monday += timedelta(days=1)
+        Availability.objects.create(doctor=cls.doctor, day='Monday', start_time=time(9), end_time=time(12),
+                                    clinic=cls.north)
+        Availability.objects.create(doctor=cls.doctor, day='Monday', start_time=time(13), end_time=time(15))
+
+    def setUp(self):
+        slot_index.reset()
+
+    def at(self, hour, minute=0, day=None):
+        day = day or self.monday
+        return timezone.make_aware(datetime(day.year, day.month, day.day, hour, minute))
+
+    def monday_slots(self, **filters):
+        slots = slot_index.free_slots(doctor=self.doctor.id, after=self.at(0), limit=100, **filters)
+        return [when for when, _ in slots if when.date() == self.monday]
+
+    def test_interval_tree_matches_a_linear_scan(self):
+        rng = random.Random(7)
+        starts = [rng.randint(0, 200) for _ in range(300)]
+        intervals = [(start, start + rng.randint(1, 20), i) for i, start in enumerate(starts)]
+        tree = IntervalTree(intervals)
+        for _ in range(200):
+            start = rng.randint(-10, 230)
+            end = start + rng.randint(1, 15)
+            self.assertEqual(sorted(tree.overlapping(start, end)),
+                             sorted(i for i in intervals if i[0] < end and i[1] > start))
+            self.assertEqual(sorted(tree.containing(start)),
+                             sorted(i for i in intervals if i[0] <= start < i[1]))
+        self.assertEqual(IntervalTree().overlapping(0, 10), [])
+
+    def test_split_shifts_and_clinics(self):
+        self.assertEqual(len(self.monday_slots()), 10)
+        self.assertTrue(slot_index.is_available(self.doctor.id, self.at(11, 30)))
+        self.assertFalse(slot_index.is_available(self.doctor.id, self.at(12)))
+        self.assertFalse(slot_index.is_available(self.doctor.id, self.at(11, 30), self.at(13, 30)))
+        self.assertTrue(slot_index.is_available(self.doctor.id, self.at(9), clinic=self.north.id))
+        self.assertFalse(slot_index.is_available(self.doctor.id, self.at(9), clinic=self.south.id))
+        # Hours without a clinic are offered at every clinic.
+        self.assertEqual([when.hour for when in self.monday_slots(clinic=self.south.id)], [13, 13, 14, 14])
+
+    def test_exceptions_replace_and_block_hours(self):
+        self.assertEqual(len(self.monday_slots()), 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilityException.objects.create(doctor=self.doctor, date=self.monday, start_time=time(10),
+                                                 end_time=time(11), reason='Training')
+        self.assertEqual(len(self.monday_slots()), 8)
+        self.assertFalse(slot_index.is_available(self.doctor.id, self.at(10, 30)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilityException.objects.create(doctor=self.doctor, date=self.monday, available=True,
+                                                 start_time=time(16), end_time=time(18), clinic=self.south)
+        self.assertEqual([when.hour for when in self.monday_slots()], [16, 16, 17, 17])
+        self.assertEqual(slot_index.working_hours(self.doctor.id, self.at(0), self.at(23)),
+                         [(self.at(16), self.at(18), self.south.id)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilityException.objects.create(doctor=self.doctor, date=self.monday)
+        self.assertEqual(self.monday_slots(), [])
+        # Other Mondays keep their regular hours.
+        next_monday = self.monday + timedelta(days=7)
+        self.assertTrue(slot_index.is_available(self.doctor.id, self.at(9, day=next_monday)))
+
+    def test_overlapping_extra_hours_are_rejected_and_merged(self):
+        AvailabilityException.objects.create(doctor=self.doctor, date=self.monday, available=True,
+                                             start_time=time(9), end_time=time(11))
+        overlapping = AvailabilityException(doctor=self.doctor, date=self.monday, available=True,
+                                            start_time=time(10), end_time=time(12))
+        with self.assertRaisesMessage(ValidationError, 'overlap extra hours already set'):
+            overlapping.full_clean()
+        AvailabilityException(doctor=self.doctor, date=self.monday, available=True,
+                              start_time=time(11), end_time=time(12)).full_clean()
+
+        # Rows saved without validation are merged rather than offered twice.
+        overlapping.save()
+        AvailabilityException.objects.create(doctor=self.doctor, date=self.monday, available=True,
+                                             start_time=time(11, 30), end_time=time(13), clinic=self.north)
+        slot_index.reset()
+        self.assertEqual([(when.hour, when.minute) for when in self.monday_slots()],
+                         [(9, 0), (9, 30), (10, 0), (10, 30), (11, 0), (11, 30), (12, 0), (12, 30)])
+        # The North hours start where the merged hours for every clinic end.
+        self.assertEqual([(when.hour, when.minute) for when in self.monday_slots(clinic=self.south.id)],
+                         [(9, 0), (9, 30), (10, 0), (10, 30), (11, 0), (11, 30)])
+
+    def test_set_availability_rejects_overlapping_hours(self):
+        self.client.force_login(self.doctor)
+        url = reverse('set_availability')
+        response = self.client.post(url, {'day': 'Monday', 'start_time': '11:00', 'end_time': '13:30'})
+        self.assertContains(response, 'overlap hours already set for Monday')
+        response = self.client.post(url, {'day': 'Monday', 'start_time': '16:00', 'end_time': '18:00',
+                                          'clinic': self.south.id})
+        self.assertRedirects(response, url)
+        self.assertEqual(self.doctor.availability.count(), 3)
+
+        response = self.client.post(url, {'kind': 'exception', 'exception-date': self.monday.isoformat(),
+                                          'exception-available': 'on', 'exception-clinic': ''})
+        self.assertContains(response, 'Extra hours need a start and an end time.')
+        extra = {'kind': 'exception', 'exception-date': self.monday.isoformat(), 'exception-available': 'on',
+                 'exception-start_time': '16:00', 'exception-end_time': '18:00', 'exception-clinic': self.north.id}
+        self.assertRedirects(self.client.post(url, extra), url)
+        response = self.client.post(url, dict(extra, **{'exception-start_time': '17:00', 'exception-end_time': '19:00'}))
+        self.assertContains(response, 'overlap extra hours already set')
+        response = self.client.post(url, {'kind': 'exception', 'exception-date': self.monday.isoformat(),
+                                          'exception-reason': 'Conference'})
+        self.assertRedirects(response, url)
+        self.assertContains(self.client.get(url), 'Conference')
+
+
+@skipUnless(analytics.np is not None, 'NumPy is not installed')
+class DoctorDirectoryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        cardiology = Specialization.objects.create(name='Cardiology')
+        self.dermatology = Specialization.objects.create(name='Dermatology')
+        self.heart = Clinic.objects.create(name='Heart Centre', specialization=cardiology)
+        self.vessels = Clinic.objects.create(name='Vessel Clinic', specialization=cardiology)
+        self.skin = Clinic.objects.create(name='Skin Clinic', specialization=self.dermatology)
+        self.cardiologist, self.dermatologist, self.newcomer = [
+            User.objects.create(username=f'doc{i}', email=f'doc{i}@example.com', role='doctor', name=name)
+            for i, name in enumerate(('Heart', 'Skin', 'New'))
+        ]
+        self.cardiologist.clinics.set([self.heart, self.vessels])
+        self.dermatologist.clinics.set([self.skin])
+        self.newcomer.clinics.set([self.heart])
+        Availability.objects.create(doctor=self.cardiologist, day='Monday', start_time=time(9), end_time=time(12))
+        Availability.objects.create(doctor=self.dermatologist, day='Tuesday', start_time=time(9), end_time=time(12))
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        tasks.run_pending()
+        self.client.force_login(self.patient)
+
+    def search(self, **params):
+        response = self.client.get(reverse('doctor_directory'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_profiles_copy_specialization_clinics_and_next_slot(self):
+        profile = DoctorProfile.objects.get(doctor=self.cardiologist)
+        self.assertEqual(profile.specialization_name, 'Cardiology')
+        self.assertEqual(profile.clinic_ids, [self.heart.id, self.vessels.id])
+        self.assertEqual(profile.next_available, slot_index.free_slots(doctor=self.cardiologist.id, limit=1)[0][0])
+        self.assertIsNone(DoctorProfile.objects.get(doctor=self.newcomer).next_available)
+        self.assertFalse(DoctorProfile.objects.filter(doctor=self.patient).exists())
+        self.assertContains(self.client.get(reverse('doctor_list')), 'Dermatology')
+
+    def test_facet_counts_ignore_their_own_filter(self):
+        result = self.search(clinic=self.heart.id)
+        self.assertEqual(result['count'], 2)
+        self.assertEqual([doctor['id'] for doctor in result['doctors']], [self.cardiologist.id, self.newcomer.id])
+        facets = {facet: {item['name']: item['count'] for item in items} for facet, items in result['facets'].items()}
+        self.assertEqual(facets['clinic'], {'Heart Centre': 2, 'Skin Clinic': 1, 'Vessel Clinic': 1})
+        self.assertEqual(facets['specialization'], {'Cardiology': 2})
+        self.assertEqual(facets['day'], {'Monday': 1})
+
+        result = self.search(clinic=[self.heart.id, self.skin.id], day='Tuesday')
+        self.assertEqual([doctor['name'] for doctor in result['doctors']], ['Skin'])
+        self.assertEqual(self.search(day='Monday', limit=1, offset=1)['count'], 1)
+        self.assertEqual(self.client.get(reverse('doctor_directory'), {'day': 'Someday'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('doctor_directory'), {'clinic': 'x'}).status_code, 400)
+
+    def test_counts_come_from_one_grouped_query_and_are_cached(self):
+        filters = {'clinic': [str(self.heart.id)], 'day': ['Monday']}
+        with self.assertNumQueries(1):
+            directory.facet_counts(filters)
+        with self.assertNumQueries(0):
+            directory.facet_counts(filters)
+
+    def test_changes_are_applied_by_the_worker(self):
+        self.assertEqual(len(self.search()['facets']['clinic']), 3)
+        self.cardiologist.clinics.remove(self.vessels)
+        Availability.objects.create(doctor=self.newcomer, day='Friday', start_time=time(9), end_time=time(10))
+        first = DoctorProfile.objects.get(doctor=self.cardiologist).next_available
+        Appointment.objects.create(patient=self.patient, doctor=self.cardiologist, clinic=self.heart,
+                                   appointment_datetime=first, reason='Checkup')
+        User.objects.filter(pk=self.dermatologist.pk).update(is_active=False)
+        self.dermatologist.refresh_from_db()
+        self.dermatologist.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.run_pending()
+
+        profile = DoctorProfile.objects.get(doctor=self.cardiologist)
+        self.assertEqual(profile.clinic_ids, [self.heart.id])
+        self.assertGreater(profile.next_available, first)
+        self.assertIsNotNone(DoctorProfile.objects.get(doctor=self.newcomer).next_available)
+        self.assertFalse(DoctorFacet.objects.filter(doctor=self.dermatologist).exists())
+        result = self.search()
+        self.assertEqual(result['count'], 2)
+        self.assertEqual([item['name'] for item in result['facets']['clinic']], ['Heart Centre'])
+
+        self.dermatology.name = 'Skin care'
+        self.dermatology.save()
+        self.cardiologist.clinics.add(self.skin)
+        self.heart.delete()
+        tasks.run_pending()
+        self.assertEqual(DoctorProfile.objects.get(doctor=self.cardiologist).specialization_name, 'Skin care')
+
+    def test_passed_slots_are_refreshed(self):
+        DoctorProfile.objects.filter(doctor=self.cardiologist).update(next_available=timezone.now())
+        self.assertEqual(directory.refresh_passed(), 1)
+        self.assertGreater(DoctorProfile.objects.get(doctor=self.cardiologist).next_available, timezone.now())
+
+
+class GeoSearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cardiology = Specialization.objects.create(name='Cardiology')
+        self.dermatology = Specialization.objects.create(name='Dermatology')
+        rng = random.Random(7)
+        self.clinics = [
+            Clinic.objects.create(name=f'Clinic {i}', specialization=(self.cardiology, self.dermatology)[i % 2],
+                                  latitude=rng.uniform(51, 52), longitude=rng.uniform(-0.6, 0.4))
+            for i in range(120)
+        ]
+        # Either side of the antimeridian, about 22 km apart.
+        self.east = Clinic.objects.create(name='East', specialization=self.cardiology, latitude=-17.0, longitude=179.9)
+        self.west = Clinic.objects.create(name='West', specialization=self.cardiology, latitude=-17.0,
+                                          longitude=-179.9)
+
+    def brute_force(self, latitude, longitude, k, radius_km, specialization=None):
+        found = sorted((geo.haversine(latitude, longitude, c.latitude, c.longitude), c.id)
+                       for c in Clinic.objects.filter(latitude__isnull=False)
+                       if specialization is None or c.specialization_id == specialization)
+        return [pk for distance, pk in found if distance <= radius_km][:k]
+
+    def test_cell_follows_location(self):
+        clinic = self.clinics[0]
+        self.assertEqual(clinic.geo_cell, geo.cell(clinic.latitude, clinic.longitude))
+        clinic.latitude, clinic.longitude = 40.0, 20.0
+        clinic.save(update_fields=['latitude', 'longitude'])
+        clinic.refresh_from_db()
+        self.assertEqual(clinic.geo_cell, geo.cell(40.0, 20.0))
+        self.assertIsNone(Clinic.objects.create(name='Nowhere').geo_cell)
+        self.assertEqual(geo.cell(90, 180), geo.ROWS * geo.COLUMNS - 1)
+
+    def test_bounding_box_holds_the_circle(self):
+        rng = random.Random(3)
+        for _ in range(200):
+            latitude, longitude = rng.uniform(-80, 80), rng.uniform(-180, 180)
+            radius = rng.uniform(1, 500)
+            south, north, spans = geo.bounding_box(latitude, longitude, radius)
+            ranges = geo.cell_ranges(south, north, spans)
+            bearing, fraction = rng.uniform(0, 2 * 3.14159), rng.random()
+            # A point inside the circle, projected from the centre on a sphere.
+            point = geo_point(latitude, longitude, bearing, radius * fraction)
+            cell = geo.cell(*point)
+            self.assertTrue(any(lo <= cell <= hi for lo, hi in ranges), (latitude, longitude, radius, point))
+
+    def test_antimeridian(self):
+        south, north, spans = geo.bounding_box(-17.0, 179.9, 25)
+        self.assertEqual(len(spans), 2)
+        found = geo.nearest(-17.0, 179.95, k=5, radius_km=50)
+        self.assertEqual([clinic['id'] for _, clinic in found], [self.east.id, self.west.id])
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(11)
+        for _ in range(30):
+            latitude, longitude = rng.uniform(50.8, 52.2), rng.uniform(-0.8, 0.6)
+            k, radius = rng.randint(1, 15), rng.choice((2, 10, 25, 60))
+            specialization = rng.choice((None, self.cardiology.id, self.dermatology.id))
+            found = geo.nearest(latitude, longitude, k, radius, specialization)
+            self.assertEqual([clinic['id'] for _, clinic in found],
+                             self.brute_force(latitude, longitude, k, radius, specialization))
+            self.assertEqual([distance for distance, _ in found], sorted(distance for distance, _ in found))
+
+    def test_view(self):
+        response = self.client.get(reverse('nearby_clinics'), {
+            'lat': 51.5, 'lng': -0.1, 'radius': 30, 'limit': 3, 'specialization': self.dermatology.id})
+        self.assertEqual(response.status_code, 200)
+        clinics = response.json()['clinics']
+        self.assertEqual([clinic['id'] for clinic in clinics],
+                         self.brute_force(51.5, -0.1, 3, 30, self.dermatology.id))
+        self.assertEqual({clinic['specialization'] for clinic in clinics}, {'Dermatology'})
+
+    def test_view_rejects_bad_input(self):
+        for params in ({}, {'lat': 'north', 'lng': 0}, {'lat': 91, 'lng': 0}, {'lat': 0, 'lng': 0, 'radius': 5000},
+                       {'lat': 0, 'lng': 0, 'limit': 0}, {'lat': 0, 'lng': 0, 'specialization': 'x'}):
+            self.assertEqual(self.client.get(reverse('nearby_clinics'), params).status_code, 400, params)
+
+    def test_rebuild_geo_cells(self):
+        Clinic.objects.update(geo_cell=None)
+        call_command('rebuild_geo_cells', stdout=StringIO())
+        self.assertEqual(Clinic.objects.filter(latitude__isnull=False, geo_cell__isnull=True).count(), 0)
+        self.assertEqual(len(geo.nearest(51.5, -0.1, 5, 50)), 5)
+
+
+def geo_point(latitude, longitude, bearing, distance_km):
+    """The point ``distance_km`` from a location along ``bearing`` (radians)."""
+    angle = distance_km / geo.EARTH_RADIUS_KM
+    phi, lam = math.radians(latitude), math.radians(longitude)
+    phi2 = math.asin(math.sin(phi) * math.cos(angle) + math.cos(phi) * math.sin(angle) * math.cos(bearing))
+    lam2 = lam + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(phi),
+                            math.cos(angle) - math.sin(phi) * math.sin(phi2))
+    return math.degrees(phi2), (math.degrees(lam2) + 540) % 360 - 180
+
+
+class ClinicAnalyticsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.host = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.other = User.objects.create(username='wilson', email='wilson@example.com', role='doctor', name='Wilson')
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        cls.clinic = Clinic.objects.create(name='Central', host=cls.host)
+        cls.clinic.doctors.set([cls.host, cls.other])
+        Availability.objects.create(doctor=cls.host, day='Monday', start_time=time(9), end_time=time(12),
+                                    clinic=cls.clinic)
+        Availability.objects.create(doctor=cls.other, day='Monday', start_time=time(9), end_time=time(11))
+        cls.monday = timezone.localdate() - timedelta(days=7)
+        while cls.monday.weekday() != 0:
+            cls.monday -= timedelta(days=1)
+        for doctor, hour, minute, status in ((cls.host, 9, 0, 'Completed'), (cls.host, 9, 30, 'Cancelled'),
+                                             (cls.host, 10, 0, 'Scheduled'), (cls.other, 9, 0, 'Completed')):
+            Appointment.objects.create(doctor=doctor, patient=cls.patient, clinic=cls.clinic, status=status,
+                                       appointment_datetime=next_slot((cls.monday - timezone.localdate()).days,
+                                                                      hour, minute), reason='Checkup')
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('clinic_analytics', args=[self.clinic.id])
+        self.client.force_login(self.host)
+
+    def report(self):
+        return self.client.get(self.url, {'from': self.monday, 'to': self.monday}).json()
+
+    def test_report_buckets_bookings_against_capacity(self):
+        report = self.report()
+        self.assertEqual(report['totals'], {
+            'appointments': 4, 'scheduled': 0, 'completed': 2, 'cancelled': 1, 'no_show': 1,
+            'booked_slots': 3, 'capacity_slots': 10, 'utilization': 0.3,
+            'cancellation_rate': 0.25, 'no_show_rate': 0.3333,
+        })
+        monday = report['heatmap']['weekdays'].index('Monday')
+        self.assertEqual(report['heatmap']['booked'][monday][9:12], [2, 1, 0])
+        self.assertEqual(report['heatmap']['capacity'][monday][9:12], [4, 4, 2])
+        self.assertEqual(report['heatmap']['utilization'][monday][8:12], [None, 0.5, 0.25, 0.0])
+        self.assertEqual([(d['name'], d['booked'], d['capacity'], d['no_show']) for d in report['doctors']],
+                         [('House', 2, 6, 1), ('Wilson', 1, 4, 0)])
+
+    def test_reports_are_cached_until_the_clinic_changes(self):
+        self.report()
+        with self.assertNumQueries(1):  # the session; the user is cached by clinic.auth
+            self.report()
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilityException.objects.create(doctor=self.other, date=self.monday)
+        self.assertEqual(self.report()['totals']['capacity_slots'], 6)
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.filter(status='Cancelled').get().delete()
+        self.assertEqual(self.report()['totals']['cancelled'], 0)
+
+    def test_only_hosts_and_staff_see_reports(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(self.host)
+        self.assertEqual(self.client.get(self.url, {'from': 'soon'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'from': '2024-01-01', 'to': '2026-01-01'}).status_code, 400)
+
+
+class AuthenticationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = User.objects.create_user(username='pat', email='pat@example.com', name='Pat',
+                                               password='s3cret-pass')
+
+    def setUp(self):
+        auth.user_cache.clear()
+
+    def test_login_looks_the_user_up_once_and_hides_unknown_emails(self):
+        url = reverse('login')
+        for email in ('nobody@example.com', 'pat@example.com'):
+            with mock.patch('django.contrib.auth.hashers.PBKDF2PasswordHasher.encode',
+                            autospec=True, return_value='pbkdf2_sha256$1$salt$hash') as encode:
+                response = self.client.post(url, {'email': email, 'password': 'wrong'}, follow=True)
+            self.assertContains(response, 'Invalid email or password')
+            self.assertEqual(encode.call_count, 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'email': 'pat@example.com', 'password': 's3cret-pass'})
+        self.assertRedirects(response, reverse('patient_dashboard'), fetch_redirect_response=False)
+        self.assertEqual(sum('FROM "clinic_user"' in q['sql'] for q in queries.captured_queries), 1)
+
+    def test_user_is_cached_per_session_until_it_changes(self):
+        self.client.force_login(self.patient)
+        self.client.get(reverse('patient_settings'))
+        with self.assertNumQueries(1):  # the session only
+            self.client.get(reverse('patient_settings'))
+
+        self.client.post(reverse('update-user'), {'name': 'Patricia', 'username': 'pat', 'email': 'pat@example.com'})
+        self.assertContains(self.client.get(reverse('update-user')), 'Patricia')
+
+        self.client.get(reverse('logout'))
+        self.assertEqual(self.client.get(reverse('patient_settings')).status_code, 302)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions_need_no_queries(self):
+        self.client.force_login(self.patient)
+        self.client.get(reverse('patient_settings'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('patient_settings'))
+
+
+class AsyncViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        Availability.objects.create(doctor=cls.doctor, day='Monday', start_time=time(9), end_time=time(12))
+        Appointment.objects.create(doctor=cls.doctor, patient=cls.patient, clinic=Clinic.objects.create(name='C'),
+                                   appointment_datetime=next_slot(days=2), reason='Checkup')
+
+    def setUp(self):
+        slot_index.reset()
+        cache.clear()
+
+    async def test_read_views_under_asgi(self):
+        response = await self.async_client.get(reverse('doctor_list'))
+        self.assertEqual(response.status_code, 302)
+
+        await sync_to_async(self.async_client.force_login)(self.patient)
+        response = await self.async_client.get(reverse('doctor_list'))
+        self.assertContains(response, '9:00 AM - 12:00 PM')
+        response = await self.async_client.get(reverse('doctor_availability', args=[self.doctor.id]))
+        self.assertEqual(response.json()['availability'], [{'day': 'Monday', 'start': '09:00', 'end': '12:00', 'clinic': None}])
+        response = await self.async_client.get(reverse('free_slots'), {'doctor': self.doctor.id, 'limit': 2})
+        self.assertEqual(len(response.json()['slots']), 2)
+        response = await self.async_client.get(reverse('patient_dashboard'))
+        self.assertContains(response, 'House')
+
+        await sync_to_async(self.async_client.force_login)(self.doctor)
+        response = await self.async_client.get(reverse('doctor_dashboard'))
+        self.assertContains(response, 'Pat')
+        self.assertEqual(response.context['stats'].upcoming_count, 1)
+
+    async def test_free_slot_lookups_leave_the_event_loop(self):
+        held, release = threading.Event(), threading.Event()
+
+        def rebuild():
+            with slot_index._lock:
+                held.set()
+                release.wait(5)
+
+        rebuilding = threading.Thread(target=rebuild)
+        rebuilding.start()
+        await sync_to_async(held.wait)(5)
+        lookup = asyncio.ensure_future(slot_index.afree_slots(doctor=self.doctor.id, limit=1))
+        # The loop keeps running while the lookup waits for the lock.
+        await asyncio.sleep(0.05)
+        self.assertFalse(lookup.done())
+        release.set()
+        self.assertEqual(len(await lookup), 1)
+        await sync_to_async(rebuilding.join)()
+
+
+class SlotEventTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.other = User.objects.create(username='wilson', email='wilson@example.com', role='doctor', name='Wilson')
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        cls.clinic = Clinic.objects.create(name='C')
+        cls.clinic.doctors.add(cls.doctor)
+        for day in WEEKDAYS:
+            Availability.objects.create(doctor=cls.doctor, day=day, start_time=time(9), end_time=time(17))
+
+    def setUp(self):
+        slot_index.reset()
+        self.loop = asyncio.new_event_loop()
+        self.subscription = events.hub.subscribe([self.doctor.id], loop=self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(events.hub.unsubscribe, self.subscription)
+
+    def received(self):
+        """``(event, data)`` of every frame delivered to the subscription so far."""
+        self.loop.run_until_complete(asyncio.sleep(0))
+        frames = []
+        while not self.subscription.queue.empty():
+            fields = dict(line.split(': ', 1) for line in
+                          self.subscription.queue.get_nowait().decode().strip().split('\n'))
+            frames.append((fields['event'], json.loads(fields['data'])))
+        return frames
+
+    def test_appointment_changes(self):
+        when = next_slot(days=2, hour=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment = Appointment.objects.create(doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+                                                     appointment_datetime=when, reason='Checkup')
+        [(kind, data)] = self.received()
+        self.assertEqual(kind, 'taken')
+        self.assertEqual(data['doctor'], self.doctor.id)
+        self.assertEqual((data['date'], data['time']), (timezone.localtime(when).strftime('%Y-%m-%d'), '10:00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.reason = 'Something else'
+            appointment.save()
+        self.assertEqual(self.received(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.appointment_datetime = next_slot(days=2, hour=11)
+            appointment.save()
+        self.assertEqual([(kind, data['time']) for kind, data in self.received()],
+                         [('released', '10:00'), ('taken', '11:00')])
+
+        # Moving to a doctor nobody watches only frees the old slot.
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.doctor = self.other
+            appointment.save()
+        self.assertEqual([(kind, data['time']) for kind, data in self.received()], [('released', '11:00')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.doctor = self.doctor
+            appointment.status = 'Cancelled'
+            appointment.save()
+            Appointment.objects.get(pk=appointment.pk).delete()
+        self.assertEqual(self.received(), [])
+
+    def test_holds(self):
+        when = next_slot(days=3, hour=9)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.place_hold(self.patient, self.doctor.id, when)
+        [(kind, data)] = self.received()
+        self.assertEqual((kind, data['reason']), ('taken', 'hold'))
+        self.assertIn('until', data)
+
+        # Booking the held slot removes the hold, but the slot is not free.
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.book(self.patient, self.clinic, self.doctor, when, 'Checkup')
+        self.assertEqual([(kind, data['reason']) for kind, data in self.received()], [('taken', 'appointment')])
+
+        later = next_slot(days=3, hour=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.place_hold(self.patient, self.doctor.id, later)
+            booking.release_hold(self.patient, self.doctor.id, later)
+        self.assertEqual([kind for kind, _ in self.received()], ['taken', 'released'])
+
+    def test_hub(self):
+        self.assertTrue(events.hub.watching(self.doctor.id))
+        self.assertFalse(events.hub.watching(self.other.id))
+        self.assertEqual(events.hub.publish('taken', self.other.id, {}), 0)
+
+        # Published from another thread, delivered on the subscriber's loop.
+        publisher = threading.Thread(target=events.hub.publish, args=('taken', self.doctor.id, {'n': 1}))
+        publisher.start()
+        publisher.join()
+        self.assertEqual(self.received(), [('taken', {'n': 1})])
+
+        slow = events.Subscription([self.doctor.id], self.loop, size=2)
+        for n in range(3):
+            slow.deliver(f'event: taken\ndata: {n}\n\n'.encode())
+        self.assertTrue(slow.lagging)
+
+        events.hub.unsubscribe(self.subscription)
+        self.assertFalse(events.hub.watching(self.doctor.id))
+
+    def test_stream(self):
+        stream = self.subscription.stream(events.hub)
+        self.assertTrue(self.loop.run_until_complete(anext(stream)).startswith(b'retry: '))
+        events.hub.publish('released', self.doctor.id, {'n': 1})
+        self.assertIn(b'event: released', self.loop.run_until_complete(anext(stream)))
+        with mock.patch.object(events, 'HEARTBEAT_SECONDS', 0.01):
+            stream = self.subscription.stream(events.hub)
+            self.loop.run_until_complete(anext(stream))
+            self.assertEqual(self.loop.run_until_complete(anext(stream)), events.HEARTBEAT)
+        self.loop.run_until_complete(stream.aclose())
+        self.assertFalse(events.hub.watching(self.doctor.id))
+
+    async def test_view_under_asgi(self):
+        await sync_to_async(self.async_client.force_login)(self.patient)
+        response = await self.async_client.get(reverse('slot_events'), {'doctor': self.other.id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await anext(stream)).startswith(b'retry: '))
+        self.assertTrue(events.hub.watching(self.other.id))
+        when = next_slot(days=2)
+        await sync_to_async(events.appointment_changed)((None, None, None), (self.other.id, when, 'Scheduled'))
+        self.assertIn(b'event: taken', await anext(stream))
+        await stream.aclose()
+
+    def test_view_without_asgi(self):
+        self.client.force_login(self.patient)
+        response = self.client.get(reverse('slot_events'), {'doctor': self.doctor.id})
+        self.assertEqual(response.content, f'retry: {events.WSGI_RETRY_MS}\n\n'.encode())
+        for params in ({}, {'doctor': 'x'}, {'doctor': list(range(events.MAX_DOCTORS + 1))}):
+            self.assertEqual(self.client.get(reverse('slot_events'), params).status_code, 400)
+
+    def test_close_on_disconnect(self):
+        cancelled = []
+
+        async def endless(scope, receive, send):
+            await receive()
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.append(scope['path'])
+                raise
+
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}, {'type': 'http.disconnect'}]
+
+        async def receive():
+            return messages.pop(0)
+
+        application = events.close_on_disconnect(endless, ['/slots/events/'])
+        self.loop.run_until_complete(application({'type': 'http', 'path': '/slots/events/'}, receive, None))
+        self.assertEqual(cancelled, ['/slots/events/'])
+
+
+class CatalogCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.specialization = Specialization.objects.create(name='Cardiology')
+        cls.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        cls.clinic = Clinic.objects.create(name='Heart Centre', specialization=cls.specialization, host=cls.doctor)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_repeated_page_loads_skip_catalog_queries(self):
+        url = reverse('clinic', args=[self.clinic.id])
+        self.client.get(reverse('home'))
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('home'))
+            self.assertContains(self.client.get(url), 'Heart Centre')
+
+        self.client.force_login(self.patient)
+        self.client.get(reverse('book_appointment'))
+        self.client.get(reverse('doctor_list'))
+        with self.assertNumQueries(2):  # session lookups only
+            self.assertContains(self.client.get(reverse('book_appointment')), 'House')
+            self.assertContains(self.client.get(reverse('doctor_list')), 'No availability set.')
+
+    def test_saves_invalidate_dependent_entries(self):
+        url = reverse('clinic', args=[self.clinic.id])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Clinic.objects.filter(pk=self.clinic.pk).update(name='Unchanged')  # bypasses signals
+        self.assertContains(self.client.get(url), 'Heart Centre')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.clinic.name = 'Heart Institute'
+            self.clinic.save()
+        self.assertContains(self.client.get(url), 'Heart Institute')
+
+        self.client.force_login(self.patient)
+        self.client.get(reverse('doctor_list'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Availability.objects.create(doctor=self.doctor, day='Monday', start_time=time(9), end_time=time(12))
+        self.assertContains(self.client.get(reverse('doctor_list')), '9:00 AM - 12:00 PM')
+
+    def test_login_does_not_invalidate_doctors(self):
+        catalog.doctors()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.force_login(self.doctor)
+        misses = catalog.counters['doctors']['misses']
+        catalog.doctors()
+        self.assertEqual(catalog.counters['doctors']['misses'], misses)
+
+    def test_stats_endpoint_is_staff_only(self):
+        self.client.force_login(self.patient)
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, 403)
+        staff = User.objects.create(username='admin', email='admin@example.com', is_staff=True)
+        self.client.force_login(staff)
+        catalog.specializations()
+        catalog.specializations()
+        data = self.client.get(reverse('cache_stats')).json()['catalog']
+        self.assertGreaterEqual(data['specializations']['hits'], 1)
+
+
+def jpeg_upload(name='photo.jpg', size=(400, 300)):
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 40, 40)).save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class AvatarVariantTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        override = self.settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+
+    def test_upload_writes_variants_used_by_doctor_list(self):
+        doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House',
+                                     avatar=jpeg_upload())
+        variants = User.objects.get(pk=doctor.pk).avatar_variants
+        self.assertEqual([width for width, _ in variants['webp']], list(images.AVATAR_WIDTHS))
+        storage = doctor.avatar.storage
+        with storage.open(variants['webp'][0][1]) as f:
+            self.assertEqual(Image.open(f).size, (64, 64))
+        self.assertTrue(variants['fallback'][0][1].endswith('-64.jpg'))
+
+        self.client.force_login(doctor)
+        html = self.client.get(reverse('doctor_list')).content.decode()
+        self.assertIn('<source type="image/webp" srcset="/images/avatars/', html)
+        self.assertIn('-128.jpg" srcset=', html)
+
+    def test_backfill_command_and_small_images(self):
+        doctor = User.objects.create(username='house', email='house@example.com', role='doctor')
+        name = doctor.avatar.storage.save('small.jpg', jpeg_upload(size=(100, 80)))
+        User.objects.filter(pk=doctor.pk).update(avatar=name)
+
+        call_command('generate_avatar_variants', stdout=StringIO())
+        variants = User.objects.get(pk=doctor.pk).avatar_variants
+        self.assertEqual(variants['source'], name)
+        self.assertEqual([width for width, _ in variants['webp']], [64])
+
+    def test_svg_avatars_are_left_alone(self):
+        doctor = User.objects.create(username='house', email='house@example.com', role='doctor')
+        self.assertEqual(doctor.avatar.name, 'avatar.svg')
+        self.assertEqual(User.objects.get(pk=doctor.pk).avatar_variants, {})
+
+
+class StaticAssetTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_collectstatic_writes_hashed_and_compressed_files(self):
+        storages = {'staticfiles': {'BACKEND': 'clinic.assets.CompressedManifestStaticFilesStorage'}}
+        with self.settings(STATIC_ROOT=self.root, STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            manifest = json.load(open(os.path.join(self.root, 'staticfiles.json')))['paths']
+        css = manifest['styles/main.css']
+        self.assertRegex(css, assets.HASHED_STATIC)
+        self.assertTrue(os.path.exists(os.path.join(self.root, css + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, manifest['images/logo.jpg'] + '.gz')))
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def get(self, path, **headers):
+        request = RequestFactory().get('/static/' + path, **headers)
+        return assets.serve(request, path, self.root, immutable=assets.HASHED_STATIC)
+
+    def test_serve_picks_encoding_and_cache_headers(self):
+        body = b'body { color: red; }' * 50
+        self.write('main.0123456789ab.css', body)
+        self.write('main.0123456789ab.css.gz', gzip.compress(body))
+
+        plain = self.get('main.0123456789ab.css')
+        self.assertEqual(b''.join(plain.streaming_content), body)
+        self.assertEqual(plain['Content-Type'], 'text/css')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('immutable', plain['Cache-Control'])
+        self.assertEqual(plain['Vary'], 'Accept-Encoding')
+
+        compressed = self.get('main.0123456789ab.css', HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(compressed.streaming_content)), body)
+        self.assertNotEqual(compressed['ETag'], plain['ETag'])
+        self.assertEqual(self.get('main.0123456789ab.css', HTTP_IF_NONE_MATCH=plain['ETag']).status_code, 304)
+
+        self.write('readme.txt', b'hello')
+        self.assertEqual(self.get('readme.txt')['Cache-Control'], f'public, max-age={assets.DEFAULT_MAX_AGE}')
+
+    def test_serve_stays_inside_the_root(self):
+        for path in ('../etc/passwd', 'missing.css', ''):
+            with self.assertRaises(Http404):
+                self.get(path)
+
+
+class DatabaseTuningTests(TestCase):
+
+    def test_new_connections_get_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], db.SQLITE_PRAGMAS['cache_size'])
+
+    def test_checked_in_database_keeps_its_journal_mode(self):
+        path = os.path.join(tempfile.mkdtemp(), 'clinic.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        for name, expected in ((db.CHECKED_IN_DB, 'delete'), (path, 'wal')):
+            raw = sqlite3.connect(path)
+            self.addCleanup(raw.close)
+            db.configure_connection(mock.Mock(vendor='sqlite', settings_dict={'NAME': name}, connection=raw))
+            self.assertEqual(raw.execute('PRAGMA journal_mode').fetchone()[0], expected)
+
+    def test_router_sends_opted_in_reads_to_replica_until_a_write(self):
+        router = db.ReplicaRouter()
+        with mock.patch.object(db, 'replica_configured', return_value=True):
+            self.assertEqual(router.db_for_read(Appointment), 'default')
+            with db.replica_reads():
+                self.assertEqual(router.db_for_read(Appointment), 'replica')
+                self.assertEqual(router.db_for_write(Appointment), 'default')
+                self.assertEqual(router.db_for_read(Appointment), 'default')
+            with db.replica_reads():
+                self.assertEqual(router.db_for_read(Appointment), 'replica')
+        with db.replica_reads():
+            self.assertEqual(router.db_for_read(Appointment), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'clinic'))
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        self.clinic = Clinic.objects.create(name='Heart Centre')
+        self.when = next_slot(days=3)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def import_lines(self, *records, **options):
+        path = os.path.join(self.tmpdir, 'data.jsonl')
+        with open(path, 'w') as f:
+            f.write('\n'.join(r if isinstance(r, str) else json.dumps(r) for r in records))
+        out, err = StringIO(), StringIO()
+        call_command('import_clinic_data', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_reports_bad_rows_and_refreshes_stats(self):
+        out, err = self.import_lines(
+            {'type': 'doctor', 'email': 'house@example.com', 'name': 'House'},
+            {'type': 'patient', 'email': 'pat@example.com'},
+            {'type': 'availability', 'doctor': 'house@example.com', 'day': 'Monday',
+             'start_time': '09:00', 'end_time': '12:00'},
+            {'type': 'appointment', 'doctor': 'house@example.com', 'patient': 'pat@example.com',
+             'clinic': self.clinic.id, 'appointment_datetime': self.when.isoformat(), 'reason': 'Checkup'},
+            {'type': 'appointment', 'doctor': 'pat@example.com', 'patient': 'pat@example.com',
+             'clinic': self.clinic.id, 'appointment_datetime': self.when.isoformat(), 'reason': 'Checkup'},
+            '{not json',
+            batch_size=2,
+        )
+        self.assertIn('line 5:', err)
+        self.assertIn('line 6: invalid JSON', err)
+        self.assertIn('2 rows rejected', out)
+
+        doctor = User.objects.get(email='house@example.com')
+        self.assertEqual(doctor.role, 'doctor')
+        self.assertFalse(doctor.has_usable_password())
+        self.assertEqual(Availability.objects.filter(doctor=doctor).count(), 1)
+        self.assertEqual(Appointment.objects.get().doctor, doctor)
+        self.assertEqual(doctor.stats.upcoming_count, 1)
+
+    def test_missing_file_is_a_command_error(self):
+        with self.assertRaisesMessage(CommandError, 'No such file'):
+            call_command('import_clinic_data', os.path.join(self.tmpdir, 'missing.jsonl'))
+
+    def test_import_refreshes_the_cached_doctor_list(self):
+        cache.clear()
+        doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        [cached] = async_to_sync(catalog.adoctors_with_availability)()
+        self.assertEqual(cached.weekly_availability, [])
+        self.import_lines({'type': 'availability', 'doctor': doctor.email, 'day': 'Monday',
+                           'start_time': '09:00', 'end_time': '12:00'})
+        [cached] = async_to_sync(catalog.adoctors_with_availability)()
+        self.assertEqual([(slot.day, slot.start_time) for slot in cached.weekly_availability], [('Monday', time(9))])
+
+    def test_doctors_without_hours_join_the_directory(self):
+        self.import_lines({'type': 'doctor', 'email': 'house@example.com', 'name': 'House'})
+        doctor = User.objects.get(email='house@example.com')
+        self.assertTrue(DoctorProfile.objects.filter(doctor=doctor).exists())
+
+    def test_malformed_values_are_rejected_per_row(self):
+        User.objects.create(username='taken', email='taken@example.com')
+        out, err = self.import_lines(
+            {'type': 'doctor', 'email': 'house@example.com'},
+            {'type': 'doctor', 'email': 'house@other.example.com'},
+            {'type': 'patient', 'email': 'pat@example.com', 'username': 'taken'},
+            {'type': 'availability', 'doctor': 'house@example.com', 'day': 'Monday',
+             'start_time': '25:00', 'end_time': '26:00'},
+            {'type': 'appointment', 'doctor': 'house@example.com', 'patient': 'house@other.example.com',
+             'clinic': self.clinic.id, 'appointment_datetime': '2030-02-30T10:00:00', 'reason': 'Checkup'},
+            '[1, 2]',
+            '"doctor"',
+        )
+        self.assertIn("line 3: username 'taken' is taken", err)
+        self.assertIn("line 4: invalid start_time: '25:00'", err)
+        self.assertIn("line 5: invalid appointment_datetime: '2030-02-30T10:00:00'", err)
+        self.assertIn('line 6: expected a JSON object', err)
+        self.assertIn('line 7: expected a JSON object', err)
+        self.assertIn('5 rows rejected', out)
+        self.assertEqual(dict(User.objects.filter(role='doctor').values_list('email', 'username')),
+                         {'house@example.com': 'house', 'house@other.example.com': 'house@other.example.com'})
+
+    def test_export_round_trips_through_import(self):
+        doctor = User.objects.create(username='house', email='house@example.com', role='doctor')
+        patient = User.objects.create(username='pat', email='pat@example.com')
+        Appointment.objects.create(doctor=doctor, patient=patient, clinic=self.clinic,
+                                   appointment_datetime=self.when, reason='Checkup')
+
+        self.client.force_login(doctor)
+        response = self.client.get('/export/appointment/', {'format': 'jsonl'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        Appointment.objects.all().delete()
+        out, err = self.import_lines(*lines)
+        self.assertEqual(err, '')
+        appointment = Appointment.objects.get()
+        self.assertEqual((appointment.doctor, appointment.patient, appointment.appointment_datetime),
+                         (doctor, patient, self.when))
+
+        self.client.force_login(patient)
+        self.assertEqual(self.client.get('/export/appointment/').status_code, 403)
+
+
+class DoctorStatsTests(TestCase):
+
+    def setUp(self):
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.alice = User.objects.create(username='alice', email='alice@example.com', name='Alice')
+        self.bob = User.objects.create(username='bob', email='bob@example.com', name='Bob')
+        self.clinic = Clinic.objects.create(name='Central')
+
+    def book(self, patient, when, **kwargs):
+        return Appointment.objects.create(patient=patient, doctor=self.doctor, clinic=self.clinic,
+                                          appointment_datetime=when, reason='Checkup', **kwargs)
+
+    def counters(self):
+        current = DoctorStats.objects.get(doctor=self.doctor)
+        return current.today_count, current.upcoming_count, current.total_patients
+
+    def assertMatchesRebuild(self):
+        incremental = self.counters()
+        stats.refresh(self.doctor.id)
+        self.assertEqual(incremental, self.counters())
+
+    def test_counters_follow_creates_updates_and_deletes(self):
+        first = self.book(self.alice, next_slot(days=0, hour=23, minute=59))
+        self.book(self.alice, next_slot(days=3))
+        past = self.book(self.bob, next_slot(days=-3))
+        self.assertEqual(self.counters(), (1, 2, 2))
+
+        moved = Appointment.objects.get(pk=first.pk)
+        moved.appointment_datetime = next_slot(days=5)
+        moved.save()
+        self.assertEqual(self.counters(), (0, 2, 2))
+
+        moved.status = 'Cancelled'
+        moved.save()
+        self.assertEqual(self.counters(), (0, 1, 2))
+
+        Appointment.objects.get(pk=past.pk).delete()
+        self.assertEqual(self.counters(), (0, 1, 1))
+        self.assertMatchesRebuild()
+
+    def test_dashboard_reads_counters(self):
+        self.book(self.alice, next_slot(days=2))
+        self.client.force_login(self.doctor)
+        response = self.client.get('/dashboard/doctor/')
+        self.assertEqual(response.context['stats'].upcoming_count, 1)
+        self.assertEqual(response.context['stats'].total_patients, 1)
+
+    def test_rebuild_command_fixes_drift(self):
+        self.book(self.alice, next_slot(days=2))
+        DoctorStats.objects.update(upcoming_count=40, total_patients=7)
+        call_command('rebuild_doctor_stats', stdout=StringIO())
+        self.assertEqual(self.counters(), (0, 1, 1))
+
+
+class PatientDashboardTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        self.clinic = Clinic.objects.create(name='Central')
+        for days in (-20, -10, 2, 4):
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, clinic=self.clinic,
+                                       appointment_datetime=next_slot(days=days), reason='Checkup')
+        self.client.force_login(self.patient)
+
+    def test_summary_counts_and_cache(self):
+        with self.assertNumQueries(5):
+            response = self.client.get('/dashboard/patient/')
+        summary = response.context['summary']
+        self.assertIn('<p>2</p>', summary)
+        self.assertIn('Dr. Doc', summary)
+
+        with self.assertNumQueries(1):
+            self.client.get('/dashboard/patient/')
+
+    def test_cancelled_appointments_are_not_counted(self):
+        for days in (-5, 3):
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, clinic=self.clinic, status='Cancelled',
+                                       appointment_datetime=next_slot(days=days), reason='Checkup')
+        summary = self.client.get('/dashboard/patient/').context['summary']
+        self.assertEqual(summary.count('<p>2</p>'), 2)
+        self.assertEqual(summary.count('Dr. Doc'), 2)
+
+    def test_appointment_changes_clear_cached_summary(self):
+        self.client.get('/dashboard/patient/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, clinic=self.clinic,
+                                       appointment_datetime=next_slot(days=6), reason='Follow-up')
+        self.assertIsNone(cache.get(dashboards.summary_key(self.patient.id)))
+
+
+class TemplateRenderingTests(TestCase):
+
+    def setUp(self):
+        caches['template_fragments'].clear()
+        self.doctor = User.objects.create(username='doc', email='doc@example.com', role='doctor', name='Doc')
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+
+    def test_templates_are_loaded_through_the_cached_loader(self):
+        loaders = engines['django'].engine.template_loaders
+        self.assertEqual(len(loaders), 1)
+        self.assertIsInstance(loaders[0], CachedLoader)
+
+    def test_sidebar_fragment_is_cached_per_role(self):
+        self.client.force_login(self.patient)
+        with templatetiming.record_renders() as recorder:
+            self.client.get('/dashboard/patient/')
+            response = self.client.get('/dashboard/patient/')
+        self.assertEqual(recorder.templates['clinic/sidebar.html'][0], 2)
+        self.assertContains(response, 'Doctors</a>')
+        self.assertNotContains(response, 'class="active"')
+
+        self.client.force_login(self.doctor)
+        response = self.client.get('/dashboard/doctor/')
+        self.assertContains(response, 'class="active">')
+        self.assertNotContains(response, 'Doctors</a>')
+
+    @override_settings(CLINIC_TEMPLATE_TIMING=True)
+    def test_middleware_reports_render_times(self):
+        self.client.force_login(self.patient)
+        with self.assertLogs('clinic.templates', 'INFO') as logs:
+            response = self.client.get('/dashboard/patient/')
+        self.assertIn('X-Template-Time', response)
+        self.assertIn('patient_dashboard rendered in', logs.output[0])
+        self.assertIn('clinic/sidebar.html', logs.output[0])
+        self.assertGreater(templatetiming.template_stats['clinic/dashboard_patient.html']['renders'], 0)
+
+    def test_include_time_counts_towards_its_parent(self):
+        self.client.force_login(self.patient)
+        with templatetiming.record_renders() as recorder:
+            self.client.get('/dashboard/patient/')
+        renders, total, own = recorder.templates['clinic/dashboard_patient.html']
+        self.assertEqual(renders, 1)
+        self.assertGreaterEqual(total, recorder.templates['clinic/sidebar.html'][1])
+        self.assertLess(own, total)
+        self.assertGreaterEqual(recorder.total_time, total)
+
+
+class CalendarFeedTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = User.objects.create(username='house', email='house@example.com', role='doctor', name='House')
+        self.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        self.clinic = Clinic.objects.create(name='Heart Centre, North')
+        Availability.objects.create(doctor=self.doctor, day='Tuesday', start_time=time(9), end_time=time(12))
+        self.appointment = Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+            appointment_datetime=next_slot(days=2), reason='Checkup')
+        self.url = reverse('doctor_calendar', args=[ical.feed_token(self.doctor.id)])
+
+    def test_full_feed_and_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn(f'UID:{ical.appointment_uid(self.appointment.id)}\r\n', body)
+        self.assertIn('LOCATION:Heart Centre\\, North\r\n', body)
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=TU\r\n', body)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+                         304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.appointment.reason = 'Follow-up'
+            self.appointment.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_incremental_feed_sends_changes_and_deletions(self):
+        token = self.client.get(self.url)['X-Sync-Token']
+        with self.assertNumQueries(0):
+            unchanged = self.client.get(self.url, {'since': token})
+        self.assertNotIn('BEGIN:VEVENT', unchanged.content.decode())
+
+        later = ical.decode_sync_token(token) + ical.SYNC_OVERLAP + timedelta(seconds=1)
+        Appointment.objects.filter(pk=self.appointment.pk).update(updated_at=later)
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Appointment.objects.create(
+                doctor=self.doctor, patient=self.patient, clinic=self.clinic,
+                appointment_datetime=next_slot(days=3), reason='Scan')
+            other_id = other.id
+            other.delete()
+
+        body = self.client.get(self.url, {'since': token}).content.decode()
+        self.assertIn(f'UID:{ical.appointment_uid(self.appointment.id)}', body)
+        self.assertIn(f'UID:{ical.appointment_uid(other_id)}\r\nDTSTAMP', body)
+        self.assertIn('STATUS:CANCELLED', body)
+        self.assertEqual(ical.decode_sync_token(body.split('X-SYNC-TOKEN:')[1].split()[0]), later)
+
+    def test_exceptions_reach_the_feed(self):
+        tuesday = timezone.localdate() + timedelta(days=1)
+        while tuesday.weekday() != 1:
+            tuesday += timedelta(days=1)
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            blackout = AvailabilityException.objects.create(doctor=self.doctor, date=tuesday, reason='Conference')
+            extra = AvailabilityException.objects.create(doctor=self.doctor, date=tuesday + timedelta(days=1),
+                                                         available=True, start_time=time(14), end_time=time(16))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn(f'EXDATE;TZID={settings.TIME_ZONE}:{tuesday:%Y%m%d}T090000\r\n', body)
+        self.assertIn(f'UID:{ical.exception_uid(blackout.id)}', body)
+        self.assertIn(f'DTSTART;VALUE=DATE:{tuesday:%Y%m%d}\r\n', body)
+        self.assertIn('SUMMARY:Unavailable: Conference\r\n', body)
+        self.assertIn(f'DTSTART;TZID={settings.TIME_ZONE}:{extra.date:%Y%m%d}T140000\r\n', body)
+
+        token, blackout_id = response['X-Sync-Token'], blackout.id
+        with self.captureOnCommitCallbacks(execute=True):
+            blackout.delete()
+        body = self.client.get(self.url, {'since': token}).content.decode()
+        self.assertIn(f'UID:{ical.exception_uid(blackout_id)}\r\nDTSTAMP', body)
+        self.assertIn('STATUS:CANCELLED', body)
+        # The weekly hours are resent without the EXDATE.
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=TU\r\n', body)
+        self.assertNotIn('EXDATE', body)
+
+    def test_deleting_doctors_in_bulk_leaves_no_tombstones(self):
+        User.objects.filter(role='doctor').delete()
+        self.assertFalse(CalendarTombstone.objects.exists())
+
+    def test_bad_tokens(self):
+        self.assertEqual(self.client.get('/calendar/forged.ics').status_code, 404)
+        self.assertEqual(self.client.get(self.url, {'since': 'garbage'}).status_code, 400)
+
+
+class ApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology = Specialization.objects.create(name='Cardiology')
+        cls.doctors = [
+            User.objects.create(username=f'doc{i}', email=f'doc{i}@example.com', role='doctor', name=f'Doc {i}')
+            for i in range(3)
+        ]
+        cls.patient = User.objects.create(username='pat', email='pat@example.com', name='Pat')
+        for i in range(25):
+            clinic = Clinic.objects.create(name=f'Clinic {i}', specialization=cls.cardiology)
+            clinic.doctors.set(cls.doctors)
+        Appointment.objects.create(patient=cls.patient, doctor=cls.doctors[0], clinic=clinic,
+                                   appointment_datetime=next_slot(), reason='Checkup')
+
+    def test_clinics_are_cursor_paginated_without_n_plus_one(self):
+        with self.assertNumQueries(2):
+            data = self.client.get('/api/clinics/').json()
+        self.assertEqual(len(data['results']), 20)
+        self.assertEqual(data['results'][0]['doctors'], [doctor.id for doctor in self.doctors])
+        second = self.client.get(data['next']).json()
+        self.assertEqual(len(second['results']), 5)
+        self.assertIsNone(second['next'])
+
+    def test_sparse_fieldsets(self):
+        data = self.client.get('/api/doctors/', {'fields': 'id,name'}).json()
+        self.assertEqual(set(data['results'][0]), {'id', 'name'})
+
+    def test_id_filters_reject_non_integers(self):
+        for url, name in (('/api/clinics/', 'specialization'), ('/api/doctors/', 'clinic'),
+                          ('/api/doctors/', 'specialization'), ('/api/availability/', 'doctor')):
+            response = self.client.get(url, {name: 'abc'})
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn(name, response.json())
+        data = self.client.get('/api/clinics/', {'specialization': self.cardiology.id}).json()
+        self.assertEqual(len(data['results']), 20)
+
+    def test_conditional_get_returns_304(self):
+        response = self.client.get('/api/doctors/')
+        etag = response['ETag']
+        response = self.client.get('/api/doctors/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        User.objects.filter(pk=self.doctors[0].pk).update(name='Renamed')
+        self.assertEqual(self.client.get('/api/doctors/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_appointments_are_limited_to_the_caller(self):
+        self.assertEqual(self.client.get('/api/appointments/').status_code, 403)
+        self.client.force_login(self.patient)
+        self.assertEqual(len(self.client.get('/api/appointments/').json()['results']), 1)
+        self.client.force_login(self.doctors[1])
+        self.assertEqual(self.client.get('/api/appointments/').json()['results'], [])
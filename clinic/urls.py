@@ -9,7 +9,10 @@ urlpatterns = [
     path('register/', views.registerPage, name="register"),
 
     path('', views.home, name="home"),
+    path('search/', views.search_results, name="search"),
+    path('clinics/nearby/', views.nearby_clinics, name='nearby_clinics'),
     path('clinic/<str:pk>/', views.clinic, name="clinic"),
+    path('clinic/<int:pk>/analytics/', views.clinic_analytics, name='clinic_analytics'),
     path('profile/<str:pk>/', views.userProfile, name="user-profile"),
 
     path('create-clinic/', views.createClinic, name="create-clinic"),
@@ -29,6 +32,7 @@ urlpatterns = [
     # Doctor URLs (You can create separate ones if functionality differs)
     path('doctor/appointments/', views.doctor_appointments, name='doctor_appointments'),
     path('doctor/settings/', views.doctor_settings, name='doctor_settings'),
+    path('appointments/more/', views.appointments_more, name='appointments_more'),
 
     # Appointment CRUD URLs
     path('book-appointment/', views.book_appointment, name='book_appointment'),
@@ -37,5 +41,79 @@ urlpatterns = [
 
     path('update-user/', views.update_user, name='update-user'),
     path('doctors/', views.doctor_list, name='doctor_list'),
+    path('doctors/directory/', views.doctor_directory, name='doctor_directory'),
+    path('doctors/<int:pk>/availability/', views.doctor_availability, name='doctor_availability'),
     path('set-availability/', views.set_availability, name='set_availability'),
-]
\ No newline at end of file
+    path('slots/', views.free_slots, name='free_slots'),
+    path('hold-slot/', views.hold_slot, name='hold_slot'),
+    path('slots/events/', views.slot_events, name='slot_events'),
+    path('export/<str:kind>/', views.export_data, name='export'),
+    path('calendar/<str:token>.ics', views.doctor_calendar, name='doctor_calendar'),
+    path('cache-stats/', views.cache_stats, name='cache_stats'),
+]
+
+
+# Maximum number of SQL queries each route may run, including the session and
+# user lookups done by the middleware. A number is the budget of GET (and HEAD)
+# requests; a dict gives one per method, and methods without one are not
+# checked. Enforced by clinic.tests.QueryBudgetTests and
+# clinic.querybudget.QueryBudgetMiddleware.
+QUERY_BUDGETS = {
+    # Signed-in visitors are redirected after the session and user lookups; signing in loads
+    # the user, updates last_login and writes the new session.
+    'login': {'GET': 2, 'POST': 5},
+    # Logging out a session loads it and the user, then deletes it.
+    'logout': 4,
+    'register': 0,
+
+    'home': 5,
+    'search': 4,
+    'clinic': 1,
+    # One query per widening of the search box: about 11, 44, 178 and 500 km at most.
+    'nearby_clinics': 4,
+    # On a cache miss: members, appointments, weekly hours and exceptions, plus the clinic itself.
+    'clinic_analytics': 7,
+    'user-profile': 2,
+
+    'create-clinic': 3,
+    'update-clinic': 4,
+    'delete-clinic': 3,
+
+    # Four once today's DoctorStats row exists; the first visit of the day rebuilds it
+    # (see clinic.stats.refresh) in five more.
+    'doctor_dashboard': 9,
+    # Session and user lookups plus at most three queries on a summary cache miss.
+    'patient_dashboard': 5,
+    # Booking checks that the doctor works at the clinic before writing.
+    'book_appointment': {'GET': 4, 'POST': 7},
+
+    'patient_appointments': 3,
+    'patient_settings': 2,
+    'doctor_appointments': 3,
+    'doctor_settings': 2,
+    'appointments_more': 3,
+
+    'update-appointment': 5,
+    'delete-appointment': 3,
+
+    'update-user': {'GET': 2, 'POST': 5},
+    'doctor_list': 4,
+    'doctor_availability': 4,
+    # The page, the facet counts and, past the first page, the total; names come from the catalog.
+    'doctor_directory': 6,
+    # Weekly hours, upcoming exceptions and the clinic choices of both forms; a rejected
+    # POST adds the clinic and overlap checks before showing the page again.
+    'set_availability': {'GET': 6, 'POST': 8},
+    # A cold slot index is built from six queries on the first lookup; the slots found are then
+    # checked against the appointments and holds in the database.
+    'free_slots': 10,
+    # Clearing expired holds, the appointment check, the per-patient count and the upsert.
+    'hold_slot': {'POST': 8},
+    # Events are pushed from memory; only the session and user lookups touch the database.
+    'slot_events': 2,
+    # Rows are streamed after the view returns, so only the session and user lookups count here.
+    'export': 2,
+    # On a cache miss: the doctor, appointments, weekly hours, exceptions and deletions.
+    'doctor_calendar': 5,
+    'cache_stats': 2,
+}
@@ -1,16 +1,49 @@
 
 
+from functools import wraps
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.core.handlers.asgi import ASGIRequest
+from django.core.paginator import Paginator
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth import authenticate, login, logout
-from .models import Clinic, Specialization, User, Appointment, Availability
-from .forms import ClinicForm, UserCreationForm, AppointmentForm, UserUpdateForm, AvailabilityForm
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from .models import Clinic, Specialization, User, Appointment, Availability, AvailabilityException
+from .forms import (
+    ClinicForm, UserCreationForm, AppointmentForm, UserUpdateForm, AvailabilityForm, AvailabilityExceptionForm,
+)
+from .slots import WEEKDAYS, slot_index
+from . import analytics, booking, bulk, catalog, dashboards, db, directory, events, geo, ical, pagination, querybudget, search, stats
 from datetime import date
 from datetime import datetime
 
 
+SEARCH_PAGE_SIZE = 20
+DASHBOARD_SIZE = 10
+
+
+def login_required_async(view):
+    """``login_required`` for async views, which Django 4.2's decorator does not support."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # Loading the lazy user (and its session) here keeps later request.user access off the database.
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path(), 'login')
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
 def loginPage(request):
     if request.user.is_authenticated:
         if request.user.role == 'doctor':
@@ -21,12 +54,8 @@ def loginPage(request):
     if request.method == 'POST':
         email = request.POST.get('email')
         password = request.POST.get('password')
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            messages.error(request, 'User does not exist')
-            return redirect('login')
-
+        # A single lookup. ModelBackend hashes the password for unknown emails too, so
+        # neither the timing nor the message tells whether an account exists.
         user = authenticate(request, email=email, password=password)
 
         if user is not None:
@@ -68,24 +97,92 @@ def registerPage(request):
 
 def home(request):
     q = request.GET.get('q', '')
-    
-       
-    specializations = Specialization.objects.filter(name__icontains=q)
-    clinics = Clinic.objects.filter(
-        Q(specialization__name__icontains=q) |
-        Q(name__icontains=q)
-    )
-    
-    context = {'clinics': clinics, 'specializations': specializations}
+
+    # Clinics and specializations are only listed for a search.
+    specializations, clinics = [], None
+    if q:
+        specializations = search.search_specializations(q)[:SEARCH_PAGE_SIZE]
+        clinics = Paginator(search.search_clinics(q), SEARCH_PAGE_SIZE).get_page(request.GET.get('page'))
+
+    context = {'clinics': clinics, 'specializations': specializations, 'q': q}
     return render(request, 'clinic/home.html', context)
 
 
+def search_results(request):
+    q = request.GET.get('q', '')
+    page = Paginator(search.search_clinics(q), SEARCH_PAGE_SIZE).get_page(request.GET.get('page'))
+
+    data = {
+        'clinics': [
+            {
+                'id': clinic.id,
+                'name': clinic.name,
+                'specialization': clinic.specialization.name if clinic.specialization else None,
+                'description': clinic.description,
+            }
+            for clinic in page
+        ],
+        'specializations': [
+            {'id': specialization.id, 'name': specialization.name}
+            for specialization in search.search_specializations(q)[:SEARCH_PAGE_SIZE]
+        ],
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'count': page.paginator.count,
+    }
+    return JsonResponse(data)
+
+
+def nearby_clinics(request):
+    try:
+        latitude, longitude = float(request.GET['lat']), float(request.GET['lng'])
+        radius = float(request.GET.get('radius', geo.DEFAULT_RADIUS_KM))
+        limit = int(request.GET.get('limit', 10))
+        specialization = request.GET.get('specialization') or None
+        if specialization is not None:
+            specialization = int(specialization)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': '"lat" and "lng" are required; all parameters must be numbers.'}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return JsonResponse({'error': 'The location is out of range.'}, status=400)
+    if not (0 < radius <= geo.MAX_RADIUS_KM and 0 < limit <= geo.MAX_RESULTS):
+        return JsonResponse({'error': f'"radius" must be at most {geo.MAX_RADIUS_KM} km and "limit" at most '
+                                      f'{geo.MAX_RESULTS}.'}, status=400)
+
+    names = {specialization.id: specialization.name for specialization in catalog.specializations()}
+    data = [
+        {'id': clinic['id'], 'name': clinic['name'], 'specialization': names.get(clinic['specialization_id']),
+         'latitude': clinic['latitude'], 'longitude': clinic['longitude'], 'distance_km': round(distance, 3)}
+        for distance, clinic in geo.nearest(latitude, longitude, limit, radius, specialization)
+    ]
+    return JsonResponse({'clinics': data})
+
+
 def clinic(request, pk):
-    clinic = Clinic.objects.get(id=pk)
+    clinic = catalog.clinic(pk)
     context = {'clinic': clinic}
     return render(request, 'clinic/clinic.html', context)
 
 
+@login_required(login_url='login')
+def clinic_analytics(request, pk):
+    try:
+        clinic = catalog.clinic(pk)
+    except Clinic.DoesNotExist:
+        raise Http404
+    if not (request.user.is_staff or clinic.host_id == request.user.id):
+        return HttpResponseForbidden()
+
+    try:
+        first_day, last_day = analytics.date_range(request.GET.get('from'), request.GET.get('to'))
+        report = analytics.clinic_report(clinic.id, first_day, last_day)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except analytics.AnalyticsUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=501)
+    return JsonResponse(report)
+
+
 def userProfile(request, pk):
     user = User.objects.get(id=pk)
     clinics = user.clinic_set.all()
@@ -112,7 +209,7 @@ def updateClinic(request, pk):
     clinic = Clinic.objects.get(id=pk)
     form = ClinicForm(instance=clinic)
 
-    if request.user != clinic.host:
+    if request.user.id != clinic.host_id:
         return redirect('home')
 
     if request.method == 'POST':
@@ -129,7 +226,7 @@ def updateClinic(request, pk):
 def deleteClinic(request, pk):
     clinic = Clinic.objects.get(id=pk)
 
-    if request.user != clinic.host:
+    if request.user.id != clinic.host_id:
         return redirect('home')
 
     if request.method == 'POST':
@@ -138,48 +235,25 @@ def deleteClinic(request, pk):
     return render(request, 'clinic/delete.html', {'obj': clinic})
 
 
-@login_required(login_url='login')
-def doctor_dashboard(request):
-    appointments = Appointment.objects.filter(doctor=request.user)
-    context = {'appointments': appointments}
+@login_required_async
+async def doctor_dashboard(request):
+    upcoming = Appointment.objects.filter(
+        doctor=request.user, appointment_datetime__gte=timezone.now()
+    ).select_related('patient')
+    with db.replica_reads():
+        appointments, _ = await pagination.akeyset_page(upcoming, size=DASHBOARD_SIZE, descending=False)
+    context = {'appointments': appointments, 'stats': await stats.afor_doctor(request.user.id)}
     return render(request, 'clinic/dashboard_doctor.html', context)
 
-@login_required(login_url='login')
-def patient_dashboard(request):
-    now = datetime.now()
-
-    upcoming_appointments = Appointment.objects.filter(
-        patient=request.user,
-        appointment_datetime__gte=now
-    ).order_by('appointment_datetime')
-
-    
-    completed_appointments = Appointment.objects.filter(
-        patient=request.user,
-        appointment_datetime__lt=now
-    ).order_by('-appointment_datetime') 
-
-    completed_visits_count = completed_appointments.count()
-
-    doctors = User.objects.filter(role='doctor', is_active=True)
-    doctor_count = User.objects.filter(role='doctor',is_active=True).count()
-
-    
-
-    context = {
-        'upcoming_appointments': upcoming_appointments,
-        'completed_appointments': completed_appointments, 
-        'completed_visits_count': completed_visits_count,
-        'doctor_count': doctor_count,
-        'doctors': doctors,
-    }
-    
+@login_required_async
+async def patient_dashboard(request):
+    context = {'summary': mark_safe(await dashboards.apatient_summary(request.user))}
     return render(request, 'clinic/dashboard_patient.html', context)
 
 @login_required(login_url='login')
 def book_appointment(request):
-    doctors = User.objects.filter(role='doctor')
-    clinics = Clinic.objects.all()
+    doctors = catalog.doctors()
+    clinics = catalog.clinics()
 
     if request.method == 'POST':
         clinic_id = request.POST.get('clinic')
@@ -191,41 +265,104 @@ def book_appointment(request):
       
         appointment_datetime_str = f'{date_str} {time_str}'
         try:
-            appointment_datetime = datetime.strptime(appointment_datetime_str, '%Y-%m-%d %H:%M')
+            appointment_datetime = timezone.make_aware(
+                datetime.strptime(appointment_datetime_str, '%Y-%m-%d %H:%M'))
 
-            if appointment_datetime < datetime.now():
+            if appointment_datetime < timezone.now():
                 messages.error(request, 'You cannot book an appointment in the past.')
                 return redirect('book_appointment')
             
             clinic = Clinic.objects.get(id=clinic_id)
-            doctor = User.objects.get(id=doctor_id)
+            doctor = User.objects.get(id=doctor_id, role='doctor')
 
-            
-            Appointment.objects.create(
-                patient=request.user,
-                clinic=clinic,
-                doctor=doctor,
-                appointment_datetime=appointment_datetime,
-                reason=reason,
-            )
+            booking.book(request.user, clinic, doctor, appointment_datetime, reason)
             messages.success(request, 'Appointment booked successfully!')
             return redirect('patient_dashboard')
 
+        except booking.SlotUnavailable:
+            messages.error(request, 'That slot has just been taken. Please choose another time.')
+        except booking.InvalidSlot:
+            messages.error(request, 'The doctor has no appointment starting at that time at this clinic.')
+        except booking.BookingBusy:
+            messages.error(request, 'We are handling a lot of bookings right now. Please try again in a moment.')
         except (ValueError, Clinic.DoesNotExist, User.DoesNotExist):
             messages.error(request, 'There was an error booking your appointment. Please check the details and try again.')
 
-    context = {'doctors': doctors, 'clinics': clinics}
+    context = {'doctors': doctors, 'clinics': clinics, 'hold_minutes': booking.HOLD_MINUTES}
     return render(request, 'clinic/book_appointment.html', context)
 
 
+@login_required(login_url='login')
+def hold_slot(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required.'}, status=405)
+
+    try:
+        doctor = User.objects.get(id=request.POST.get('doctor'), role='doctor')
+        when = timezone.make_aware(datetime.strptime(
+            f"{request.POST.get('appointment_date')} {request.POST.get('appointment_time')}", '%Y-%m-%d %H:%M'))
+    except (ValueError, User.DoesNotExist):
+        return JsonResponse({'error': 'Invalid doctor or time.'}, status=400)
+
+    if request.POST.get('release'):
+        booking.release_hold(request.user, doctor.id, when)
+        return JsonResponse({'released': True})
+
+    try:
+        hold = booking.place_hold(request.user, doctor.id, when)
+    except booking.InvalidSlot:
+        return JsonResponse({'error': 'The doctor has no appointment starting at that time.'}, status=400)
+    except booking.TooManyHolds:
+        return JsonResponse({'error': f'You can reserve at most {booking.MAX_HOLDS} slots at a time.'}, status=429)
+    except booking.SlotUnavailable:
+        return JsonResponse({'error': 'This slot is no longer available.'}, status=409)
+    except booking.BookingBusy:
+        return JsonResponse({'error': 'Please try again in a moment.'}, status=503)
+    return JsonResponse({'held_until': hold.expires_at.isoformat()})
+
+
+def _appointment_listing(request):
+    """Filtered, keyset-paginated appointments of the current user, for either role."""
+    if request.user.role == 'doctor':
+        queryset = Appointment.objects.filter(doctor=request.user).select_related('patient')
+    else:
+        queryset = Appointment.objects.filter(patient=request.user).select_related('doctor')
+    queryset = pagination.filter_appointments(queryset, request.GET)
+    with db.replica_reads():
+        return pagination.keyset_page(queryset, request.GET.get('cursor'))
+
+
 @login_required(login_url='login')
 def patient_appointments(request):
-    
-    appointments = Appointment.objects.filter(patient=request.user)
-    context = {'appointments': appointments}
+    try:
+        appointments, next_cursor = _appointment_listing(request)
+    except pagination.InvalidCursor:
+        return redirect('patient_appointments')
+    context = {
+        'appointments': appointments,
+        'next_cursor': next_cursor,
+        'filters': request.GET,
+        'statuses': Appointment.STATUS_CHOICES,
+    }
     return render(request, 'clinic/patient_appointments.html', context)
 
 
+@login_required(login_url='login')
+def appointments_more(request):
+    try:
+        appointments, next_cursor = _appointment_listing(request)
+    except pagination.InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor.')
+
+    if request.user.role == 'doctor':
+        template = 'clinic/appointment_rows_doctor.html'
+    else:
+        template = 'clinic/appointment_rows_patient.html'
+    response = render(request, template, {'appointments': appointments})
+    response['X-Next-Cursor'] = next_cursor or ''
+    return response
+
+
 @login_required(login_url='login')
 def patient_settings(request):
     
@@ -234,16 +371,25 @@ def patient_settings(request):
 
 @login_required(login_url='login')
 def doctor_appointments(request):
-    
-    appointments = Appointment.objects.filter(doctor=request.user)
-    context = {'appointments': appointments}
+    try:
+        appointments, next_cursor = _appointment_listing(request)
+    except pagination.InvalidCursor:
+        return redirect('doctor_appointments')
+    context = {
+        'appointments': appointments,
+        'next_cursor': next_cursor,
+        'filters': request.GET,
+        'statuses': Appointment.STATUS_CHOICES,
+    }
     return render(request, 'clinic/doctor_appointments.html', context)
 
 
 @login_required(login_url='login')
 def doctor_settings(request):
-    
-    return render(request, 'clinic/settings.html')
+    calendar_url = None
+    if request.user.role == 'doctor':
+        calendar_url = request.build_absolute_uri(reverse('doctor_calendar', args=[ical.feed_token(request.user.id)]))
+    return render(request, 'clinic/settings.html', {'calendar_url': calendar_url})
 
 
 
@@ -252,7 +398,7 @@ def update_appointment(request, pk):
     appointment = Appointment.objects.get(id=pk)
     form = AppointmentForm(instance=appointment)
 
-    if request.user != appointment.patient:
+    if request.user.id != appointment.patient_id:
         
         return redirect('patient_dashboard')
 
@@ -268,7 +414,7 @@ def update_appointment(request, pk):
 
 @login_required(login_url='login')
 def delete_appointment(request, pk):
-    appointment = Appointment.objects.get(id=pk)
+    appointment = Appointment.objects.select_related('patient', 'doctor').get(id=pk)
 
     if request.user != appointment.patient:
         return redirect('patient_dashboard')
@@ -299,31 +445,168 @@ def update_user(request):
     context = {'form': form}
     return render(request, 'clinic/update_user_form.html', context)
 
-@login_required(login_url='login')
-def doctor_list(request):
-    doctors = User.objects.filter(role='doctor', is_active=True).prefetch_related('availability')
-    context = {'doctors': doctors}
+@login_required_async
+async def doctor_list(request):
+    context = {'doctors': await catalog.adoctors_with_availability()}
     return render(request, 'clinic/doctor_list.html', context)
 
+
+def _minutes(value):
+    return value.isoformat('minutes') if value is not None else None
+
+
+@login_required_async
+async def doctor_availability(request, pk):
+    windows = [
+        {'day': day, 'start': _minutes(start_time), 'end': _minutes(end_time), 'clinic': clinic_id}
+        async for day, start_time, end_time, clinic_id in Availability.objects.filter(doctor_id=pk)
+        .order_by('id').values_list('day', 'start_time', 'end_time', 'clinic_id')
+    ]
+    exceptions = [
+        {'date': day.isoformat(), 'start': _minutes(start_time), 'end': _minutes(end_time),
+         'available': available, 'clinic': clinic_id}
+        async for day, start_time, end_time, available, clinic_id in AvailabilityException.objects
+        .filter(doctor_id=pk, date__gte=timezone.localdate())
+        .values_list('date', 'start_time', 'end_time', 'available', 'clinic_id')
+    ]
+    return JsonResponse({'doctor': pk, 'availability': windows, 'exceptions': exceptions})
+
+@login_required(login_url='login')
+def doctor_directory(request):
+    try:
+        filters = directory.parse_filters(request.GET)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', directory.PAGE_SIZE)), directory.MAX_PAGE_SIZE)
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        limit = offset = -1
+    if limit < 1 or offset < 0:
+        return JsonResponse({'error': '"limit" must be a positive and "offset" a non-negative number.'}, status=400)
+
+    with db.replica_reads():
+        return JsonResponse(directory.search(filters, limit, offset))
+
 @login_required(login_url='login')
 def set_availability(request):
     if request.user.role != 'doctor':
         return redirect('home')
 
-    if request.method == 'POST':
-        form = AvailabilityForm(request.POST)
+    form = AvailabilityForm(doctor=request.user)
+    exception_form = AvailabilityExceptionForm(doctor=request.user, prefix='exception')
+    if request.method == 'POST' and request.POST.get('kind') == 'exception':
+        exception_form = AvailabilityExceptionForm(request.POST, doctor=request.user, prefix='exception')
+        if exception_form.is_valid():
+            exception_form.save()
+            messages.success(request, 'Schedule change saved!')
+            return redirect('set_availability')
+    elif request.method == 'POST':
+        form = AvailabilityForm(request.POST, doctor=request.user)
         if form.is_valid():
-            availability = form.save(commit=False)
-            availability.doctor = request.user
-            availability.save()
+            form.save()
             messages.success(request, 'Availability set successfully!')
-            return redirect('doctor_dashboard')
-    else:
-        form = AvailabilityForm()
-    
-    context = {'form': form}
+            return redirect('set_availability')
+
+    hours = sorted(request.user.availability.select_related('clinic'),
+                   key=lambda window: (WEEKDAYS[window.day], window.start_time))
+    exceptions = request.user.availability_exceptions.filter(
+        date__gte=timezone.localdate()).select_related('clinic')
+    context = {'form': form, 'exception_form': exception_form, 'hours': hours, 'exceptions': exceptions}
     return render(request, 'clinic/set_availability.html', context)
 
-   
 
+@login_required_async
+async def free_slots(request):
+    after = request.GET.get('after')
+    if after:
+        after = parse_datetime(after)
+        if after is None:
+            return JsonResponse({'error': 'Invalid "after" datetime.'}, status=400)
+        if timezone.is_naive(after):
+            after = timezone.make_aware(after)
+
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 100)
+        slots = await slot_index.afree_slots(
+            doctor=request.GET.get('doctor') or None,
+            specialization=request.GET.get('specialization') or None,
+            clinic=request.GET.get('clinic') or None,
+            after=after,
+            limit=limit,
+        )
+    except ValueError:
+        return JsonResponse({'error': 'Invalid filter value.'}, status=400)
+
+    data = [{'doctor': doctor_id, 'start': when.isoformat()} for when, doctor_id in slots]
+    return JsonResponse({'slots': data})
+
+
+@login_required_async
+async def slot_events(request):
+    doctor_ids = request.GET.getlist('doctor')
+    if not doctor_ids or len(doctor_ids) > events.MAX_DOCTORS or not all(pk.isdigit() for pk in doctor_ids):
+        return JsonResponse({'error': f'Give between 1 and {events.MAX_DOCTORS} "doctor" ids.'}, status=400)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(f'retry: {events.WSGI_RETRY_MS}\n\n', content_type='text/event-stream', headers=headers)
+    subscription = events.hub.subscribe({int(pk) for pk in doctor_ids})
+    return StreamingHttpResponse(subscription.stream(events.hub), content_type='text/event-stream', headers=headers)
+
+
+@login_required(login_url='login')
+def export_data(request, kind):
+    if kind not in bulk.EXPORT_FIELDS:
+        return HttpResponseBadRequest('Unknown export type.')
+    if request.user.is_staff:
+        doctor = None
+    elif request.user.role == 'doctor':
+        doctor = request.user
+    else:
+        return HttpResponseForbidden()
+
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        return HttpResponseBadRequest('Unknown export format.')
+
+    rows = bulk.export_queryset(kind, doctor).iterator(chunk_size=2000)
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(bulk.export_lines(kind, rows, fmt), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+
+def doctor_calendar(request, token):
+    doctor_id = ical.doctor_for_token(token)
+    if doctor_id is None:
+        raise Http404
+
+    since = request.GET.get('since')
+    if since:
+        try:
+            feed = ical.changes_since(doctor_id, ical.decode_sync_token(since))
+        except ical.InvalidSyncToken:
+            return HttpResponseBadRequest('Invalid sync token.')
+    else:
+        feed = ical.full_feed(doctor_id)
+    if feed is None:
+        raise Http404
+
+    last_modified = int(feed.last_modified.timestamp())
+    response = get_conditional_response(request, etag=feed.etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(feed.body, content_type='text/calendar; charset=utf-8')
+    response['ETag'] = feed.etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['X-Sync-Token'] = feed.sync_token
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
+
+@login_required(login_url='login')
+def cache_stats(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return JsonResponse({'catalog': catalog.stats(), 'event_subscribers': events.hub.subscriber_count(),
+                         'queries': querybudget.query_stats()})
@@ -2,6 +2,8 @@
 ASGI config for studybud project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Live slot events (``clinic.events``) need it: serve the project with an ASGI
+server, e.g. ``uvicorn studybud.asgi:application``, for them to stream.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -13,4 +15,11 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studybud.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.urls import reverse  # noqa: E402
+
+from clinic.events import close_on_disconnect  # noqa: E402 (needs the apps loaded above)
+
+# Event streams are cancelled as soon as the browser goes away.
+application = close_on_disconnect(django_application, [reverse('slot_events')])
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 
@@ -48,13 +50,15 @@ AUTH_USER_MODEL = 'clinic.User'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'clinic.querybudget.QueryBudgetMiddleware',
+    'clinic.templatetiming.TemplateTimingMiddleware',
 
     "corsheaders.middleware.CorsMiddleware",
 
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'clinic.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -68,6 +72,8 @@ TEMPLATES = [
             BASE_DIR / 'templates'
         ],
         'APP_DIRS': True,
+        # Without an explicit 'loaders' option Django wraps these loaders in the
+        # cached loader, also under DEBUG (where it reloads edited templates).
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -84,14 +90,71 @@ WSGI_APPLICATION = 'studybud.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
+# CLINIC_DB points at another file, e.g. a database filled by `manage.py seed_data`.
 
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('CLINIC_DB', BASE_DIR / 'db.sqlite3'),
+        # Keep connections (and the PRAGMAs applied in clinic.db) between requests.
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Optional read replica: a copy of the primary file kept fresh with
+# `manage.py sync_replica`. Listing views read from it through clinic.db.ReplicaRouter.
+CLINIC_REPLICA_DB = os.environ.get('CLINIC_REPLICA_DB')
+
+if CLINIC_REPLICA_DB:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': CLINIC_REPLICA_DB,
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['clinic.db.ReplicaRouter']
+
+
+# Local memory is private to each process. When running several workers, set
+# CLINIC_CACHE_DIR to a shared directory so that catalog invalidations
+# (clinic.catalog) reach all of them.
+
+CLINIC_CACHE_DIR = os.environ.get('CLINIC_CACHE_DIR')
+
+CACHES = {
+    'default': {
+        'BACKEND': ('django.core.cache.backends.filebased.FileBasedCache' if CLINIC_CACHE_DIR
+                    else 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': CLINIC_CACHE_DIR or 'clinic',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    # {% cache %} fragments. They only depend on the code and the URLconf, so
+    # every process keeps its own copy and a deploy starts with empty ones.
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template_fragments',
+    },
+}
+
+# "db", "cached_db" or "signed_cookies". cached_db reads sessions from the cache
+# above, so it is only safe with several workers when they share CLINIC_CACHE_DIR;
+# signed_cookies never touches the database but cannot revoke a copied cookie.
+CLINIC_SESSION_ENGINE = os.environ.get('CLINIC_SESSION_ENGINE', 'cached_db' if CLINIC_CACHE_DIR else 'db')
+SESSION_ENGINE = f'django.contrib.sessions.backends.{CLINIC_SESSION_ENGINE}'
+
+# Authenticated users are kept in memory per process for this long (see clinic.auth).
+CLINIC_USER_CACHE_SECONDS = int(os.environ.get('CLINIC_USER_CACHE_SECONDS', 30))
+
+# Time every template and include a request renders (see clinic.templatetiming).
+CLINIC_TEMPLATE_TIMING = os.environ.get('CLINIC_TEMPLATE_TIMING', '') == '1'
+
+# Raise instead of logging when a request runs more queries than its budget
+# (see clinic.querybudget); always on under `manage.py test`.
+CLINIC_QUERY_BUDGET_STRICT = os.environ.get('CLINIC_QUERY_BUDGET_STRICT', '') == '1' or sys.argv[1:2] == ['test']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -141,7 +204,19 @@ STATICFILES_DIRS = [
 
 MEDIA_ROOT = BASE_DIR / 'static/images'
 
-# STATIC_ROOT =
+# collectstatic writes hashed and precompressed copies here; clinic.assets.serve
+# delivers them when DEBUG is off.
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': ('django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+                    else 'clinic.assets.CompressedManifestStaticFilesStorage'),
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -155,6 +230,10 @@ SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# Appointment emails are sent by `manage.py run_worker`; see clinic.tasks.
+EMAIL_BACKEND = os.environ.get('CLINIC_EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.environ.get('CLINIC_FROM_EMAIL', 'ClinicOnTheNet <no-reply@localhost>')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -167,4 +246,24 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'WARNING',
     },
+    'loggers': {
+        # Query budget overruns and suspected N+1 patterns, see clinic.querybudget.
+        'clinic.queries': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        # Per-template render times, when CLINIC_TEMPLATE_TIMING is on.
+        'clinic.templates': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # Throughput and conflict figures reported by the stress tests.
+        'clinic.tests': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
 }
\ No newline at end of file
@@ -1,11 +1,30 @@
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+from django.contrib.staticfiles.urls import staticfiles_urlpatterns
+
+from clinic import assets
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/', include('clinic.api.urls')),
     path('', include('clinic.urls')),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+def _prefix(url):
+    return r'^%s(?P<path>.*)$' % re.escape(url.lstrip('/'))
+
+
+if settings.DEBUG:
+    # Serve straight from STATICFILES_DIRS during development, before collectstatic has run.
+    urlpatterns += staticfiles_urlpatterns()
+
+urlpatterns += [
+    re_path(_prefix(settings.STATIC_URL), assets.serve,
+            {'document_root': settings.STATIC_ROOT, 'immutable': assets.HASHED_STATIC}),
+    re_path(_prefix(settings.MEDIA_URL), assets.serve,
+            {'document_root': settings.MEDIA_ROOT, 'immutable': assets.HASHED_MEDIA}),
+]